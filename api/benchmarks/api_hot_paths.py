@@ -0,0 +1,376 @@
+"""Measures the latency of each stage of the API hot paths, and the throughput of the endpoints, using stub models.
+
+Deterministic CPU stubs (see stubs.py) replace the captioning model and the embedders, and a local
+fixture of synthetic images replaces the flicker8k index. Runs need neither a GPU nor the Hub, so the
+results cover only the code around the models. The stages are first timed one at a time in this
+process:
+- parsing a multipart upload
+- decoding the image
+- captioning through the batcher
+- embedding and querying the vector stores
+- reading and base64-encoding the result images
+- serializing the response
+The endpoints are then served by uvicorn in a separate process and loaded end to end at each
+concurrency. Each endpoint also gets the mean of the Server-Timing stages it reports.
+
+Results are written as JSON, keyed by stage and by "endpoint@concurrency". --compare prints the ratio
+of every latency and throughput to an earlier run, e.g. one made on the previous commit. Other
+settings, such as CAPTION_MAX_BATCH_SIZE, are read from the environment as usual.
+
+Run from the api folder, e.g.:
+    python benchmarks/api_hot_paths.py --images 1000 --concurrency 1 4 16 --output hot_paths.json
+    python benchmarks/api_hot_paths.py --caption-ms 40 --compare hot_paths.json
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ic_model_api"))
+
+import chromadb  # noqa: E402
+import uvicorn  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+import main  # noqa: E402
+from config import settings  # noqa: E402
+from models import CaptionCache, ICModel, ImageDatabaseIndex  # noqa: E402
+from models.db_index import LOCAL_IMAGE_STORE_FOLDER  # noqa: E402
+from models.quantization import STORAGES  # noqa: E402
+from models.vector_store import VECTOR_STORE_BACKENDS  # noqa: E402
+from stubs import COLORS, StubCaptioner, StubEmbedder, StubImageEmbedder, build_fixture_index, make_image  # noqa: E402
+
+
+FIXTURE_INDEX_FOLDER = "flicker8k_index"
+ENDPOINTS = ("caption", "search", "search_similar", "search_similar_image", "index")
+# Seeds of the uploaded images, apart from those of the fixture index
+UPLOAD_SEED = 10 ** 7
+INDEX_SEED = 2 * 10 ** 7
+
+
+def queries(count):
+    names = list(COLORS)
+    return [f"a {names[i % len(names)]} shape on a {names[(i * 3 + 1) % len(names)]} background" for i in range(count)]
+
+
+def summarize(latencies):
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": statistics.mean(latencies),
+        "count": len(latencies),
+    }
+
+
+def measure(function, inputs, repeats):
+    # Latencies in ms of `function` on every input, after a warm-up call
+    function(inputs[0])
+    latencies = []
+    for _ in range(repeats):
+        for value in inputs:
+            start = time.perf_counter()
+            function(value)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return summarize(latencies)
+
+
+def load_components(args, build):
+    # Shares the components through the loaders of main, after building the fixture index in the
+    # current directory unless it is already there
+    if args.embedder == "stub":
+        embedding_function, image_embedder = StubEmbedder(), StubImageEmbedder()
+    else:
+        embedding_function, image_embedder = main.load_embedder(), main.load_image_embedder()
+
+    if build:
+        print(f"## Building a fixture index of {args.images} images in {os.getcwd()}")
+        client = chromadb.PersistentClient(path=FIXTURE_INDEX_FOLDER, settings=Settings(anonymized_telemetry=False))
+        build_fixture_index(client, LOCAL_IMAGE_STORE_FOLDER, embedding_function, args.images, args.seed)
+        # The image embeddings are backfilled before any vector store is exported
+        if image_embedder:
+            os.makedirs(settings.USER_INDEX_DB_DIRECTORY, exist_ok=True)
+            ImageDatabaseIndex(
+                None, settings.USER_INDEX_DB_DIRECTORY, persist_directory=FIXTURE_INDEX_FOLDER,
+                embedding_function=embedding_function, image_embedder=image_embedder
+            ).backfill_image_embeddings("flicker8k")
+
+    settings.VECTOR_STORE_BACKEND = args.vector_store_backend
+    settings.VECTOR_STORE_STORAGE = args.vector_store_storage
+    main.load_image_db_index(FIXTURE_INDEX_FOLDER, embedding_function, image_embedder)
+    main.load_ic_model(StubCaptioner(batch_ms=args.caption_ms, image_ms=args.caption_image_ms))
+
+    # Without --caption-cache every caption request reaches the batcher
+    settings.SHARED["CAPTION_CACHE"] = CaptionCache(max_entries=settings.CAPTION_CACHE_SIZE if args.caption_cache else 0)
+    return settings.SHARED["IMAGE_DB_INDEX"]
+
+
+def multipart_upload(data, fields):
+    # The body and headers of an upload, as a client sends them
+    request = httpx.Request("POST", "http://benchmark/search_similar", files={"image": ("image.jpg", data, "image/jpeg")},
+                            data=fields)
+    return request.read(), request.headers.raw
+
+
+async def parse_multipart(upload):
+    body, headers = upload
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    form = await Request({"type": "http", "method": "POST", "headers": headers}, receive).form()
+    await form.close()
+
+
+def benchmark_stages(image_db_index, uploads, texts, args):
+    stages = {}
+    num = args.num
+    fixture_images = [image_db_index.image_path(f"flicker8k/{image_id}", args.size) for image_id in
+                      image_db_index.collections["flicker8k"].get(limit=len(texts), include=[])['ids']]
+
+    loop = asyncio.new_event_loop()
+    multipart = [multipart_upload(data, {"num": str(num)}) for data in uploads]
+    stages["multipart_parse"] = measure(lambda upload: loop.run_until_complete(parse_multipart(upload)), multipart, args.repeats)
+    loop.close()
+
+    stages["decode"] = measure(lambda data: ICModel.load_image(data).convert("RGB"), uploads, args.repeats)
+    stages["caption"] = measure(settings.SHARED["CAPTION_BATCHER"].caption, uploads, args.repeats)
+
+    # The embedding function itself, since the index caches the embeddings of repeated queries
+    stages["embed"] = measure(lambda text: image_db_index.embedding_function([text]), texts, args.repeats)
+    embeddings = image_db_index.embedding_function(texts)
+    stages["vector_query"] = measure(
+        lambda embedding: image_db_index.vector_stores["flicker8k"].query([embedding], num), embeddings, args.repeats)
+    stages["lexical_query"] = measure(
+        lambda text: image_db_index.lexical_indexes["flicker8k"].search(text, num), texts, args.repeats)
+
+    if image_db_index.image_embedder:
+        stages["embed_image"] = measure(lambda data: image_db_index.image_embedder.embed([data]), uploads, args.repeats)
+        image_embeddings = image_db_index.image_embedder.embed(uploads)
+        stages["image_vector_query"] = measure(
+            lambda embedding: image_db_index.image_vector_stores["flicker8k"].query([embedding], num),
+            image_embeddings, args.repeats)
+
+    def read(path):
+        with open(path, mode='rb') as _file:
+            return _file.read()
+
+    stages["file_read"] = measure(read, fixture_images, args.repeats)
+    contents = [read(path) for path in fixture_images]
+    stages["encode"] = measure(lambda data: base64.b64encode(data).decode("utf-8"), contents, args.repeats)
+
+    # Responses as FastAPI serializes the return value of an endpoint
+    responses = [image_db_index.search(text, num, size=args.size, mode="vector") for text in texts]
+    stages["serialize"] = measure(lambda response: JSONResponse(jsonable_encoder(response)).body, responses, args.repeats)
+    return stages
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    # Serves the fixture index of the current directory from a separate process, so the load
+    # generator does not share its interpreter
+    command = [
+        sys.executable, os.path.abspath(__file__), "--serve", str(port),
+        "--embedder", args.embedder,
+        "--vector-store-backend", args.vector_store_backend,
+        "--vector-store-storage", args.vector_store_storage,
+        "--caption-ms", str(args.caption_ms),
+        "--caption-image-ms", str(args.caption_image_ms),
+    ] + (["--caption-cache"] if args.caption_cache else [])
+    server = subprocess.Popen(command)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            if httpx.get(f"{base_url}/health/live").status_code == 200:
+                return server, base_url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError("The benchmark server did not start")
+
+
+def send(client, endpoint, i, uploads, texts, index_uploads, args):
+    upload = ("image.jpg", uploads[i % len(uploads)], "image/jpeg")
+    fields = {"num": str(args.num), "size": args.size}
+    if endpoint == "caption":
+        return client.post("/caption", files={"image": upload})
+    if endpoint == "search":
+        return client.post("/search", data={"text": texts[i % len(texts)], **fields})
+    if endpoint in ("search_similar", "search_similar_image"):
+        mode = "image" if endpoint == "search_similar_image" else "caption"
+        return client.post("/search_similar", files={"image": upload}, data={"mode": mode, **fields})
+    # Every indexed image is new, so none is skipped as a duplicate
+    return client.post("/index", files=[("images", ("image.jpg", next(index_uploads), "image/jpeg"))])
+
+
+def server_timing(header):
+    # {"embed": 12.3, ...} from "embed;dur=12.3, ..."
+    timings = {}
+    for entry in filter(None, (part.strip() for part in header.split(","))):
+        name, _, duration = entry.partition(";dur=")
+        timings[name] = float(duration)
+    return timings
+
+
+def load_test(base_url, endpoint, concurrency, requests, send_request):
+    # Sends `requests` requests from `concurrency` clients, each waiting for its response before the next
+    counter = itertools.count()
+    latencies, errors, timings = [], defaultdict(int), defaultdict(list)
+
+    def client_loop():
+        with httpx.Client(base_url=base_url, timeout=300) as client:
+            send_request(client, endpoint, 0)
+            while (i := next(counter)) < requests:
+                start = time.perf_counter()
+                response = send_request(client, endpoint, i)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+                if response.status_code != 200:
+                    errors[str(response.status_code)] += 1
+                for name, duration in server_timing(response.headers.get("server-timing", "")).items():
+                    timings[name].append(duration)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client_loop) for _ in range(concurrency)]:
+            future.result()
+    seconds = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": dict(errors),
+        "throughput_rps": requests / seconds,
+        "latency_ms": summarize(latencies),
+        "server_timing_ms": {name: statistics.mean(durations) for name, durations in timings.items()},
+    }
+
+
+def git_commit():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=directory).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(previous, current):
+    # Ratios of this run to the previous one: below 1 is faster for latencies, above 1 for throughput
+    print(f"## {current['commit']} compared to {previous['commit']}")
+    print(f"{'':<48}{'previous':>12}{'current':>12}{'ratio':>8}")
+
+    def row(label, old, new):
+        print(f"{label:<48}{old:>12.2f}{new:>12.2f}{new / old if old else float('nan'):>8.2f}")
+
+    for name, result in current["stages"].items():
+        if name in previous["stages"]:
+            row(f"{name} p50 ms", previous["stages"][name]["p50"], result["p50"])
+    for key, result in current["endpoints"].items():
+        if key in previous["endpoints"]:
+            old = previous["endpoints"][key]
+            row(f"{key} p50 ms", old["latency_ms"]["p50"], result["latency_ms"]["p50"])
+            row(f"{key} p95 ms", old["latency_ms"]["p95"], result["latency_ms"]["p95"])
+            row(f"{key} requests/s", old["throughput_rps"], result["throughput_rps"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500, help="images in the fixture index")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num", type=int, default=3, help="results per collection of every search")
+    parser.add_argument("--size", default="original", help="size of the returned images")
+    parser.add_argument("--queries", type=int, default=32, help="distinct search texts")
+    parser.add_argument("--uploads", type=int, default=16, help="distinct uploaded images, besides those indexed")
+    parser.add_argument("--repeats", type=int, default=5, help="passes over the inputs of every stage")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and concurrency")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=ENDPOINTS)
+    parser.add_argument("--embedder", default="stub", choices=["stub", "real"],
+                        help="stub embedders, or the configured caption and image embedding models")
+    parser.add_argument("--vector-store-backend", default=settings.VECTOR_STORE_BACKEND, choices=VECTOR_STORE_BACKENDS)
+    parser.add_argument("--vector-store-storage", default=settings.VECTOR_STORE_STORAGE, choices=STORAGES)
+    parser.add_argument("--caption-ms", type=float, default=0.0, help="simulated latency of every caption batch")
+    parser.add_argument("--caption-image-ms", type=float, default=0.0, help="simulated latency per image of a batch")
+    parser.add_argument("--caption-cache", action="store_true", help="cache captions, so repeated uploads skip the batcher")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="print the ratios to the results of an earlier run")
+    parser.add_argument("--serve", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        load_components(args, build=False)
+        uvicorn.run(main.app, host="127.0.0.1", port=args.serve, lifespan="off", log_level="warning")
+        sys.exit()
+
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory(prefix="api-hot-paths-") as directory:
+        os.chdir(directory)
+        image_db_index = load_components(args, build=True)
+        uploads = [make_image(UPLOAD_SEED + i) for i in range(args.uploads)]
+        texts = queries(args.queries)
+
+        results = {
+            "commit": git_commit(),
+            "config": {name: value for name, value in vars(args).items() if name not in ("serve", "output", "compare")},
+            "stages": benchmark_stages(image_db_index, uploads, texts, args),
+            "endpoints": {},
+        }
+        for name, result in results["stages"].items():
+            print(json.dumps({"stage": name, **result}))
+        settings.SHARED["CAPTION_BATCHER"].close()
+
+        # Generated ahead, so the load generator only sends them
+        index_images = args.requests * len(args.concurrency) + sum(args.concurrency) if "index" in args.endpoints else 0
+        index_uploads = iter([make_image(INDEX_SEED + i) for i in range(index_images)])
+
+        server, base_url = start_server(args, free_port())
+        try:
+            # /index runs last, since it grows the user collection that the searches also query
+            for endpoint in [endpoint for endpoint in ENDPOINTS if endpoint in args.endpoints]:
+                for concurrency in args.concurrency:
+                    result = load_test(
+                        base_url, endpoint, concurrency, args.requests,
+                        lambda client, endpoint, i: send(client, endpoint, i, uploads, texts, index_uploads, args))
+                    results["endpoints"][f"{endpoint}@{concurrency}"] = result
+                    print(json.dumps({"endpoint": endpoint, **result}))
+        finally:
+            server.terminate()
+            server.wait()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if previous:
+        with open(previous) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,89 @@
+"""Compares query embedding latency of the embedding backends, and their agreement with the reference vectors.
+
+Run from the api folder, e.g.:
+    python benchmarks/embedding_backends.py --backends sentence-transformers onnx torch-int8 --device cpu
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ic_model_api"))
+
+from models.embedding import BACKENDS, load_embedding_function  # noqa: E402
+
+
+QUERIES = [
+    "a dog running on the beach",
+    "two children playing football in a park",
+    "a man riding a bicycle down a city street",
+    "Dal Baati Churma served on a plate",
+    "Konark Sun Temple at sunset",
+    "a woman wearing a red saree",
+    "a group of people hiking up a snowy mountain",
+    "a black cat sleeping on a sofa",
+]
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q))
+
+
+def benchmark(backend, device, batch_size, threads, repeats):
+    start = time.perf_counter()
+    embedding_function = load_embedding_function(backend=backend, device=device, batch_size=batch_size, threads=threads)
+    load_seconds = time.perf_counter() - start
+    embedding_function(QUERIES[:1])
+
+    single = []
+    for _ in range(repeats):
+        for query in QUERIES:
+            start = time.perf_counter()
+            embedding_function([query])
+            single.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        vectors = embedding_function(QUERIES)
+    batch_ms = (time.perf_counter() - start) * 1000 / repeats
+
+    return {
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "single_query_ms": {"p50": percentile(single, 50), "p95": percentile(single, 95), "mean": statistics.mean(single)},
+        "batch_ms": batch_ms,
+        "batch_queries_per_second": len(QUERIES) / batch_ms * 1000,
+    }, np.asarray(vectors, dtype=np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=[b for b in BACKENDS if b != "auto"], choices=BACKENDS)
+    parser.add_argument("--device", default=None, help="device for the sentence-transformers backend, detected by default")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results, reference = [], None
+    for backend in args.backends:
+        result, vectors = benchmark(backend, args.device, args.batch_size, args.threads, args.repeats)
+
+        # Vectors must stay compatible with the flicker8k index, built with the fp32 sentence-transformers
+        # model, which is the first backend by default
+        if reference is None:
+            reference = vectors
+        cosine = (vectors * reference).sum(axis=1) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1))
+        result["min_cosine_to_first_backend"] = float(cosine.min())
+
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,133 @@
+"""Deterministic CPU stand-ins for the models, and a local fixture index, used by the API benchmarks.
+
+The stubs keep the interfaces of the real components, so the API code paths around them run unchanged.
+"""
+import hashlib
+import os
+import random
+import time
+from io import BytesIO
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from PIL import Image, ImageDraw
+
+from models import ICModel
+from models.image_embedding import open_image
+from models.lexical import tokenize
+
+
+COLORS = {
+    "red": (200, 40, 40), "green": (40, 160, 60), "blue": (40, 70, 200), "yellow": (230, 210, 40),
+    "purple": (130, 50, 160), "orange": (240, 140, 30), "black": (20, 20, 20), "white": (240, 240, 240),
+}
+SHAPES = ("circle", "square")
+FIXTURE_FOLDER = "fixture"
+
+
+class StubCaptioner:
+    """Stands in for ICModel: decodes every image, and describes it by the colors of its pixels.
+
+    `batch_ms` and `image_ms` simulate the latency of a generate call, so batching can be measured.
+    """
+
+
+    def __init__(self, batch_ms=0.0, image_ms=0.0):
+        self.batch_ms = batch_ms
+        self.image_ms = image_ms
+        self.status = "Model loaded"
+
+
+    def caption(self, image):
+        return self.caption_batch([image])[0]
+
+
+    def caption_batch(self, images):
+        captions = [self._describe(ICModel.load_image(image).convert("RGB")) for image in images]
+        time.sleep((self.batch_ms + self.image_ms * len(images)) / 1000)
+        return captions
+
+
+    def caption_stream(self, image):
+        return iter(word + " " for word in self.caption(image).split(" "))
+
+
+    @staticmethod
+    def _describe(image):
+        # The two palette colors closest to the most common colors of a small thumbnail
+        pixels = np.asarray(image.resize((16, 16))).reshape(-1, 3).astype(np.float32)
+        palette = np.asarray(list(COLORS.values()), dtype=np.float32)
+        nearest = ((pixels[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        names = [list(COLORS)[i] for i in np.bincount(nearest, minlength=len(COLORS)).argsort()[::-1][:2]]
+        return f"A {names[1]} shape on a {names[0]} background."
+
+
+class StubEmbedder(EmbeddingFunction):
+    """Stands in for the caption embedder: normalized hashed bag of words, so shared words mean similar vectors."""
+
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for token in tokenize(text):
+                embeddings[row, int(hashlib.md5(token.encode("utf-8")).hexdigest(), 16) % self.dim] += 1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (embeddings / np.maximum(norms, 1e-12)).tolist()
+
+
+class StubImageEmbedder:
+    """Stands in for the CLIP image encoder: the normalized pixels of an 8x8 thumbnail."""
+
+
+    def embed(self, images):
+        embeddings = []
+        for image in images:
+            pixels = np.asarray(open_image(image).resize((8, 8)), dtype=np.float32).reshape(-1)
+            pixels -= pixels.mean()
+            embeddings.append((pixels / max(np.linalg.norm(pixels), 1e-12)).tolist())
+        return embeddings
+
+
+def make_image(seed, size=(640, 480)):
+    # A JPEG of a few shapes on a plain background, different for every seed
+    rng = random.Random(seed)
+    names = rng.sample(list(COLORS), 2)
+    image = Image.new("RGB", size, COLORS[names[0]])
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(1, 4)):
+        x, y = rng.randrange(size[0] - 120), rng.randrange(size[1] - 120)
+        box = (x, y, x + rng.randint(60, 120), y + rng.randint(60, 120))
+        shape = rng.choice(SHAPES)
+        (draw.ellipse if shape == "circle" else draw.rectangle)(box, fill=COLORS[names[1]])
+
+    # Noise, so no two images share a perceptual hash
+    noise = np.random.default_rng(seed).integers(0, 40, size=(size[1], size[0], 3), dtype=np.uint8)
+    image = Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise - 20, 0, 255).astype(np.uint8))
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def build_fixture_index(client, image_store_directory, embedding_function, images=500, seed=0):
+    # Fills a local image store and a "flicker8k" collection of the given chromadb client, like the Hub index
+    os.makedirs(os.path.join(image_store_directory, FIXTURE_FOLDER), exist_ok=True)
+    captioner = StubCaptioner()
+
+    ids, captions = [], []
+    for i in range(images):
+        data = make_image(seed * 1000003 + i)
+        image_id = f"{FIXTURE_FOLDER}/{i:06d}.jpg"
+        with open(os.path.join(image_store_directory, image_id), "wb") as f:
+            f.write(data)
+        ids.append(image_id)
+        captions.append(captioner.caption(data))
+
+    collection = client.get_or_create_collection(name="flicker8k", embedding_function=embedding_function)
+    for start in range(0, len(ids), 256):
+        collection.add(ids=ids[start:start + 256], documents=captions[start:start + 256])
+    return ids, captions
@@ -0,0 +1,155 @@
+"""Compares recall, query latency and memory of the chroma and mmap vector stores on a flicker8k collection.
+
+Each store is loaded in a fresh process, so its resident memory is measured on its own.
+Recall is measured against exact nearest neighbours, for queries made of indexed vectors
+plus some noise. The mmap store is measured with every given storage and rescoring factor,
+along with the size of the vectors or codes it scans.
+
+Run from the api folder, e.g.:
+    python benchmarks/vector_stores.py --index ic_model_api/chromadb/chromadb_index --queries 500 --num 10 \
+        --storages float32 float16 int8 pq --rescore 0 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ic_model_api"))
+
+import chromadb  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+
+from models.quantization import STORAGES  # noqa: E402
+from models.vector_store import (CODES_FILENAME, RESCORE, VECTOR_STORE_BACKENDS, VECTORS_FILENAME,  # noqa: E402
+                                 ChromaVectorStore, MmapVectorStore, export_collection)
+
+
+def memory():
+    # Resident memory in MB, split into private (anonymous) memory and pages mapped from files,
+    # which the page cache shares between processes
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                values[key] = int(value.split()[0]) / 1024
+    return values
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q))
+
+
+def open_collection(index, collection_name):
+    client = chromadb.PersistentClient(path=index, settings=Settings(anonymized_telemetry=False))
+    return client.get_collection(name=collection_name, embedding_function=None)
+
+
+def run(backend, index, collection_name, export_directory, rescore, queries, num, results):
+    before = memory()
+    start = time.perf_counter()
+    if backend == "mmap":
+        store = MmapVectorStore(export_directory, rescore)
+    else:
+        store = ChromaVectorStore(open_collection(index, collection_name))
+    load_seconds = time.perf_counter() - start
+
+    # The first query loads chroma's HNSW index, and pages in the mapped vectors
+    start = time.perf_counter()
+    store.query(queries[:1].tolist(), num)
+    first_query_ms = (time.perf_counter() - start) * 1000
+
+    latencies, hits = [], []
+    for query in queries:
+        start = time.perf_counter()
+        ids, _ = store.query([query.tolist()], num)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits.append(ids[0])
+
+    start = time.perf_counter()
+    store.query(queries.tolist(), num)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    after = memory()
+    results.put({
+        "load_seconds": load_seconds,
+        "first_query_ms": first_query_ms,
+        "query_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "mean": statistics.mean(latencies)},
+        "batch_queries_per_second": len(queries) / batch_ms * 1000,
+        "rss_mb": {key: after[key] - before.get(key, 0) for key in after},
+        "hits": hits,
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--index", required=True, help="unpacked chromadb index directory")
+    parser.add_argument("--collection", default="flicker8k")
+    parser.add_argument("--backends", nargs="+", default=list(VECTOR_STORE_BACKENDS), choices=VECTOR_STORE_BACKENDS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--num", type=int, default=10)
+    parser.add_argument("--storages", nargs="+", default=["float32"], choices=STORAGES, help="storages of the mmap store")
+    parser.add_argument("--rescore", nargs="+", type=int, default=[RESCORE], help="rescoring factors of the quantized storages")
+    parser.add_argument("--noise", type=float, default=0.05, help="standard deviation of the noise added to the query vectors")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        runs, export_seconds = [], {}
+        for storage in args.storages if "mmap" in args.backends else []:
+            export_directory = os.path.join(directory, storage)
+            start = time.perf_counter()
+            export_collection(open_collection(args.index, args.collection), export_directory, storage=storage)
+            export_seconds[storage] = time.perf_counter() - start
+
+            scanned = VECTORS_FILENAME if storage == "float32" else CODES_FILENAME
+            size_mb = os.path.getsize(os.path.join(export_directory, scanned)) / 1024 / 1024
+            for rescore in [0] if storage == "float32" else args.rescore:
+                runs.append(({"backend": "mmap", "storage": storage, "rescore": rescore, "scanned_mb": size_mb},
+                             export_directory, rescore))
+        if "chroma" in args.backends:
+            runs.insert(0, ({"backend": "chroma"}, None, 0))
+
+        # Exact nearest neighbours of the queries, as the reference for recall
+        exact_directory = os.path.join(directory, "exact")
+        export_collection(open_collection(args.index, args.collection), exact_directory)
+        exact = MmapVectorStore(exact_directory)
+        rng = np.random.default_rng(0)
+        sample = rng.choice(exact.count(), size=args.queries, replace=exact.count() < args.queries)
+        queries = np.asarray(exact.vectors[sample]) + rng.normal(0, args.noise, size=(args.queries, exact.vectors.shape[1]))
+        queries = queries.astype(np.float32)
+        truth, _ = exact.query(queries.tolist(), args.num)
+        vector_count = exact.count()
+        del exact
+
+        context = multiprocessing.get_context("spawn")
+        output = {
+            "collection": args.collection,
+            "vectors": vector_count,
+            "export_seconds": export_seconds,
+            "backends": [],
+        }
+        for setup, export_directory, rescore in runs:
+            results = context.Queue()
+            process = context.Process(
+                target=run,
+                args=(setup["backend"], args.index, args.collection, export_directory, rescore, queries, args.num, results))
+            process.start()
+            result = {**setup, **results.get()}
+            process.join()
+
+            hits = result.pop("hits")
+            result[f"recall_at_{args.num}"] = statistics.mean(
+                len(set(found) & set(expected)) / len(expected) for found, expected in zip(hits, truth))
+            output["backends"].append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
@@ -1,22 +1,34 @@
 import base64
-import tempfile
+import json
 
-from fastapi import APIRouter, Request, UploadFile, File
+from fastapi import APIRouter, HTTPException, Request, UploadFile, File
+from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
 
 from config import settings
+from models import stage
 
 
 captioning_router = APIRouter()
 templates = Jinja2Templates(directory=settings.TEMPLATES_DIRECTORY)
 
 
+def generate_caption(data: bytes):
+    cache = settings.SHARED["CAPTION_CACHE"]
+    key = cache.key(data)
+
+    caption = cache.get(key)
+    if caption is None:
+        with stage("caption"):
+            caption = settings.SHARED["CAPTION_BATCHER"].caption(data)
+        cache.put(key, caption)
+
+    return caption
+
+
 def process_image(image: UploadFile):
     data = image.file.read()
-    caption = ''
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(data)
-        caption = settings.SHARED["IC_MODEL"].caption(tmp.name)
+    caption = generate_caption(data)
     image.file.close()
 
     return data, caption
@@ -28,6 +40,53 @@ def caption(request: Request, image: UploadFile = File()):
     return [caption]
 
 
+def server_sent_event(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@captioning_router.post("/caption/stream")
+def caption_stream(request: Request, image: UploadFile = File()):
+    data = image.file.read()
+    image.file.close()
+
+    cache = settings.SHARED["CAPTION_CACHE"]
+    key = cache.key(data)
+    caption = cache.get(key)
+
+    # Fails here, before the response starts, if the model is unavailable or the caption queue is full.
+    # Streams wait for their turn in the interactive queue, like any other caption
+    tokens = None
+    if caption is None:
+        if settings.SHARED["IC_MODEL"].status != "Model loaded":
+            raise HTTPException(status_code=500, detail=settings.SHARED["IC_MODEL"].status)
+        tokens = settings.SHARED["CAPTION_BATCHER"].stream(data)
+
+    def events():
+        if caption is not None:
+            yield server_sent_event("done", {"caption": caption})
+            return
+
+        generated = []
+        try:
+            for token in tokens:
+                generated.append(token)
+                yield server_sent_event("token", {"token": token})
+        except Exception as e:
+            yield server_sent_event("error", {"detail": getattr(e, "detail", str(e))})
+            return
+
+        full_caption = "".join(generated).strip()
+        cache.put(key, full_caption)
+        yield server_sent_event("done", {"caption": full_caption})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@captioning_router.get("/caption_cache")
+def caption_cache(request: Request):
+    return settings.SHARED["CAPTION_CACHE"].stats()
+
+
 @captioning_router.get("/caption_page")
 def home(request: Request):
     return templates.TemplateResponse("ic_form.html", {"request": request})
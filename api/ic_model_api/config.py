@@ -1,4 +1,4 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from pydantic import AnyHttpUrl
 from pydantic_settings import BaseSettings
@@ -19,7 +19,82 @@ class Settings(BaseSettings):
 
     TEMPLATES_DIRECTORY: str = "templates"
 
+    # User images and their index are kept across restarts
     USER_IMAGE_DB_DIRECTORY: str = "user_images_collection"
+    USER_INDEX_DB_DIRECTORY: str = "user_images_index"
+
+    # Captions stop at the end of the first sentence ("sentence") or only at the
+    # end-of-turn token ("eot"), and are sampled unless CAPTION_GREEDY is set
+    CAPTION_MAX_NEW_TOKENS: int = 100
+    CAPTION_STOP_AT: str = "sentence"
+    CAPTION_GREEDY: bool = False
+
+    # The flicker8k index is taken from FLICKER8K_INDEX_PATH (a zip archive or an
+    # unpacked index directory) when set, and otherwise from the Hub at
+    # FLICKER8K_INDEX_REVISION. It is only unpacked again when its version or
+    # checksum changes, and FLICKER8K_INDEX_SHA256 pins the expected archive
+    FLICKER8K_INDEX_PATH: Optional[str] = None
+    FLICKER8K_INDEX_REVISION: Optional[str] = None
+    FLICKER8K_INDEX_SHA256: Optional[str] = None
+
+    # Embedding backend for captions and search queries: "auto" uses ONNX Runtime on the
+    # CPU when it is installed, and sentence-transformers otherwise. "torch-int8" is lossy,
+    # so it is never picked automatically. The device is detected unless EMBEDDING_DEVICE
+    # is set, and the ONNX export is kept in EMBEDDING_ONNX_DIRECTORY
+    EMBEDDING_BACKEND: str = "auto"
+    EMBEDDING_DEVICE: Optional[str] = None
+    EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_THREADS: Optional[int] = None
+    EMBEDDING_ONNX_DIRECTORY: str = "embedding_onnx"
+
+    # CLIP model embedding the images themselves for /search_similar with mode=image,
+    # on IMAGE_EMBEDDING_DEVICE or the detected device. An empty name disables it
+    IMAGE_EMBEDDING_MODEL: str = "clip-ViT-B-32"
+    IMAGE_EMBEDDING_DEVICE: Optional[str] = None
+    IMAGE_EMBEDDING_BATCH_SIZE: int = 32
+
+    # Vector store for the flicker8k collections: "chroma" queries their HNSW index, and
+    # "mmap" searches exact nearest neighbours in a memory-mapped export kept in
+    # VECTOR_STORE_DIRECTORY, shared by all worker processes through the page cache
+    VECTOR_STORE_BACKEND: str = "chroma"
+    VECTOR_STORE_DIRECTORY: str = "vector_store"
+
+    # Default ranking of /search: "vector" only uses the caption embeddings, "hybrid"
+    # fuses them with BM25 keyword matches, and "keyword" only uses BM25
+    SEARCH_MODE: str = "vector"
+
+    # Storage of the mmap vectors that are scanned: "float32", or "float16", "int8" or
+    # "pq" (product quantization) codes, whose VECTOR_STORE_RESCORE times more
+    # candidates than requested are re-ranked on the float32 vectors (0 skips it)
+    VECTOR_STORE_STORAGE: str = "float32"
+    VECTOR_STORE_RESCORE: int = 8
+
+    # Caption requests are collected for up to CAPTION_MAX_WAIT_MS and run
+    # through the model in batches of at most CAPTION_MAX_BATCH_SIZE images
+    CAPTION_MAX_BATCH_SIZE: int = 8
+    CAPTION_MAX_WAIT_MS: int = 10
+
+    # Pending interactive (caption, search) and bulk (index) images allowed in the
+    # caption queue before new requests are rejected with a 503 and Retry-After
+    CAPTION_INTERACTIVE_QUEUE_SIZE: int = 64
+    CAPTION_BULK_QUEUE_SIZE: int = 256
+
+    # Captions are cached by image content hash, in memory and optionally on disk
+    CAPTION_CACHE_SIZE: int = 4096
+    CAPTION_CACHE_DIRECTORY: Optional[str] = None
+    CAPTION_CACHE_MAX_DISK_BYTES: int = 64 * 1024 * 1024
+
+    # /index uploads are persisted by INDEX_PERSIST_WORKERS threads, and their
+    # captions are embedded and added to the index in chunks of INDEX_CHUNK_SIZE
+    INDEX_PERSIST_WORKERS: int = 4
+    INDEX_CHUNK_SIZE: int = 32
+
+    # Maximum Hamming distance between the perceptual hashes of two images for them
+    # to count as duplicates, at index time and in /search_similar. Negative disables it
+    PERCEPTUAL_HASH_THRESHOLD: int = 4
+
+    # Queue of /index uploads made with background=true, kept across restarts
+    INDEX_JOBS_DATABASE: str = "user_images_index/index_jobs.sqlite3"
 
     SHARED: Dict = {}
 
@@ -0,0 +1,29 @@
+import argparse
+import os
+
+from config import settings
+from models import ImageDatabaseIndex, export_collection
+from models.quantization import STORAGES
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the flicker8k vectors for the mmap vector store backend")
+    parser.add_argument("--collections", nargs="+", default=["flicker8k"], choices=["flicker8k", "flicker8k_clip"],
+                        help="collections to export")
+    parser.add_argument("--directory", default=settings.VECTOR_STORE_DIRECTORY, help="directory to export them to")
+    parser.add_argument("--storage", default=settings.VECTOR_STORE_STORAGE, choices=STORAGES,
+                        help="storage of the scanned vectors")
+    args = parser.parse_args()
+
+    image_db_index = ImageDatabaseIndex(os.environ['HF_TOKEN'], settings.USER_INDEX_DB_DIRECTORY)
+    print(image_db_index.status)
+
+    for name in args.collections:
+        # The image embeddings are kept in the user index database
+        if name == "flicker8k_clip":
+            collection = image_db_index.user_db_client.get_collection(name=name, embedding_function=None)
+        else:
+            collection = image_db_index.collections[name]
+
+        directory = export_collection(collection, os.path.join(args.directory, name), storage=args.storage)
+        print(f"## Exported {collection.count()} {name} vectors to {directory} as {args.storage}")
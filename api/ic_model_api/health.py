@@ -0,0 +1,85 @@
+import threading
+import time
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from config import settings
+
+
+health_router = APIRouter()
+
+
+class Readiness:
+    """Tracks the state and load duration of every component loaded at startup.
+
+    An optional component that fails to load is "degraded": its features are
+    unavailable, but the service is still reported as ready.
+    """
+
+
+    def __init__(self, components, optional=()):
+        self.started = time.monotonic()
+        self.ready_seconds = None
+        self.lock = threading.Lock()
+        self.components = {name: {"state": "pending"} for name in components}
+        self.optional = set(optional)
+
+
+    def run(self, name, load, *args):
+        # Runs a component loader, recording whether it succeeded and how long it took
+        start = time.monotonic()
+        with self.lock:
+            self.components[name] = {"state": "loading"}
+
+        try:
+            result = load(*args)
+        except Exception as e:
+            state = "degraded" if name in self.optional else "failed"
+            with self.lock:
+                self.components[name] = {"state": state, "error": str(e), "seconds": time.monotonic() - start}
+            raise
+
+        with self.lock:
+            self.components[name] = {"state": "ready", "seconds": time.monotonic() - start}
+        return result
+
+
+    def fail(self, name, error):
+        with self.lock:
+            self.components[name] = {"state": "failed", "error": error}
+
+
+    def finish(self):
+        self.ready_seconds = time.monotonic() - self.started
+        return self.ready_seconds
+
+
+    @property
+    def loading(self):
+        return self.ready_seconds is None
+
+
+    def report(self):
+        with self.lock:
+            return {
+                "ready": not self.loading and all(c["state"] in ("ready", "degraded") for c in self.components.values()),
+                "uptime_seconds": time.monotonic() - self.started,
+                "startup_seconds": self.ready_seconds,
+                "components": {name: dict(component) for name, component in self.components.items()},
+            }
+
+
+@health_router.get("/health/live")
+def live(request: Request):
+    return {"status": "alive"}
+
+
+@health_router.get("/health/ready")
+def ready(request: Request):
+    readiness = settings.SHARED.get("READINESS")
+    if readiness is None:
+        return JSONResponse(status_code=503, content={"ready": False})
+
+    report = readiness.report()
+    return JSONResponse(status_code=200 if report["ready"] else 503, content=report)
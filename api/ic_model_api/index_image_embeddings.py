@@ -0,0 +1,29 @@
+import argparse
+import os
+
+from config import settings
+from models import ImageDatabaseIndex, ImageEmbedder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the CLIP embeddings of indexed images that do not have one yet")
+    parser.add_argument("--collections", nargs="+", default=["flicker8k"], choices=["flicker8k", "user"],
+                        help="collections to embed the images of")
+    parser.add_argument("--batch-size", type=int, default=64, help="number of images embedded at once")
+    parser.add_argument("--workers", type=int, default=8, help="number of parallel image downloads")
+    args = parser.parse_args()
+
+    image_embedder = ImageEmbedder(
+        settings.IMAGE_EMBEDDING_MODEL,
+        device=settings.IMAGE_EMBEDDING_DEVICE,
+        batch_size=settings.IMAGE_EMBEDDING_BATCH_SIZE
+    )
+    image_db_index = ImageDatabaseIndex(
+        os.environ['HF_TOKEN'], settings.USER_INDEX_DB_DIRECTORY, image_embedder=image_embedder)
+    print(image_db_index.status)
+
+    for collection_name in args.collections:
+        print(f"## Embedding the {collection_name} images")
+        added, removed = image_db_index.backfill_image_embeddings(
+            collection_name, batch_size=args.batch_size, workers=args.workers)
+        print(f"## Added {added} {collection_name} image embeddings, removed {removed} of images no longer indexed")
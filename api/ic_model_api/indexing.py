@@ -1,13 +1,16 @@
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import os
 import random
 import string
-from typing import List
+from typing import Annotated, Dict, List
 
-from fastapi import APIRouter, Request, UploadFile
+from fastapi import APIRouter, HTTPException, Request, UploadFile, Form
 from fastapi.templating import Jinja2Templates
 
 from config import settings
+from models import BULK, SIZES, ICModel, PerceptualHashIndex, dhash_bytes, stage
+from models.renditions import image_extension, make_renditions, rendition_path
 
 
 indexing_router = APIRouter()
@@ -19,35 +22,229 @@ def randomword(length):
    return "".join(random.choice(letters) for _ in range(length))
 
 
-def index_images(images: List[UploadFile]):
+def image_filename(subfolder: str, data: bytes):
+    return f"{subfolder}/{randomword(16)}{image_extension(data)}"
+
+
+def persist_image(filename: str, data: bytes):
+    try:
+        with open(filename, "wb") as f:
+            f.write(data)
+        make_renditions(filename, ICModel.load_image(data))
+    except Exception:
+        remove_image(filename)
+        raise
+    return filename
+
+
+def remove_image(filename: str):
+    for size in SIZES:
+        path = rendition_path(filename, size)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def persist_images(image_bytes: List[bytes]):
+    # Near-duplicates of indexed images, of images being indexed, or of an earlier image of the same upload,
+    # are skipped before anything is written or captioned. The others are claimed in the index until they
+    # are indexed, so a concurrent upload of the same image is skipped as well
+    image_db_index = settings.SHARED["IMAGE_DB_INDEX"]
+    image_files, image_hashes, errors, duplicates = {}, {}, {}, {}
+    uploaded = PerceptualHashIndex(settings.PERCEPTUAL_HASH_THRESHOLD)
+
     # Create a new subfolder for every index request
     subfolder = settings.USER_IMAGE_DB_DIRECTORY + f"/{randomword(6)}"
     os.makedirs(subfolder)
-    
-    image_files, image_data, captions = [], [], []
-    for image in images:
-        filename = f"{subfolder}/{randomword(16)}.jpg"
-        with open(filename, "wb") as f:
-            data = image.file.read()
-            f.write(data)
-            image_data.append(base64.b64encode(data).decode("utf-8"))
-        
-        caption = settings.SHARED["IC_MODEL"].caption(filename)
 
-        image_files.append(filename)
-        captions.append(caption)
-    
-    msg = settings.SHARED["IMAGE_DB_INDEX"].index(image_files, captions)
+    with ThreadPoolExecutor(max_workers=settings.INDEX_PERSIST_WORKERS) as persist_executor:
+        with stage("dedup"):
+            hashing = {i: persist_executor.submit(dhash_bytes, data) for i, data in enumerate(image_bytes)}
+            for i, future in hashing.items():
+                try:
+                    image_hashes[i] = future.result()
+                    filename = image_filename(subfolder, image_bytes[i])
+                except Exception as e:
+                    errors[i] = f"Unable to read image: {e}"
+                    continue
+
+                duplicate = uploaded.find(image_hashes[i])
+                if duplicate is None:
+                    duplicate = image_db_index.claim_image(image_hashes[i], filename)
+                if duplicate is not None:
+                    duplicates[i] = duplicate
+                else:
+                    uploaded.add(image_hashes[i], i)
+                    image_files[i] = filename
+
+        with stage("persist"):
+            persisting = {
+                i: persist_executor.submit(persist_image, filename, image_bytes[i])
+                for i, filename in image_files.items()
+            }
+            for i, future in persisting.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[i] = f"Unable to read image: {e}"
+                    image_db_index.release_images([image_files.pop(i)])
+
+    return image_files, image_hashes, errors, duplicates
+
+
+def describe_duplicates(images: List[UploadFile], duplicates: Dict):
+    # Duplicates are either the id of an indexed image or the position of an earlier image of the upload
+    return [
+        {"name": images[i].filename, "duplicate_of": f"user/{d}" if isinstance(d, str) else images[d].filename}
+        for i, d in sorted(duplicates.items())
+    ]
+
+
+def caption_and_index(image_files: Dict, image_bytes: Dict, image_hashes: Dict):
+    # Captions the persisted images in GPU batches, then embeds and adds the captions to the index in
+    # chunks while the next batches are captioned. Inputs and results are keyed alike, and a failure
+    # only drops the affected images.
+    cache = settings.SHARED["CAPTION_CACHE"]
+    keys = {i: cache.key(data) for i, data in image_bytes.items()}
+    captions, errors = {}, {}
+
+    # Caption from the uploaded bytes rather than re-reading the files just written.
+    # Every uncached image is submitted at bulk priority before waiting, so they are captioned
+    # in batches without holding up interactive requests
+    captioning = {}
+    for i in image_files:
+        caption = cache.get(keys[i])
+        if caption is not None:
+            captioning[i] = Future()
+            captioning[i].set_result(caption)
+
+    uncached = [i for i in image_files if i not in captioning]
+    futures = settings.SHARED["CAPTION_BATCHER"].submit_many([image_bytes[i] for i in uncached], BULK)
+    captioning.update(zip(uncached, futures))
+    index_of = {future: i for i, future in captioning.items()}
+
+    def add_chunk(chunk):
+        try:
+            settings.SHARED["IMAGE_DB_INDEX"].index(
+                [image_files[i] for i in chunk], [captions[i] for i in chunk], [image_hashes[i] for i in chunk])
+        except Exception as e:
+            for i in chunk:
+                errors[i] = f"Unable to index image: {getattr(e, 'detail', e)}"
+
+    with ThreadPoolExecutor(max_workers=1) as index_executor:
+        with stage("caption"):
+            chunk, adding = [], []
+            for future in as_completed(captioning.values()):
+                i = index_of[future]
+                try:
+                    captions[i] = future.result()
+                    cache.put(keys[i], captions[i])
+                except Exception as e:
+                    errors[i] = f"Unable to caption image: {getattr(e, 'detail', e)}"
+                    continue
 
-    return list(zip(image_data, captions)), msg
+                chunk.append(i)
+                if len(chunk) == settings.INDEX_CHUNK_SIZE:
+                    adding.append(index_executor.submit(add_chunk, chunk))
+                    chunk = []
+
+            if chunk:
+                adding.append(index_executor.submit(add_chunk, chunk))
+
+        with stage("index"):
+            for future in adding:
+                future.result()
+
+    for i in errors:
+        remove_image(image_files[i])
+        captions.pop(i, None)
+    settings.SHARED["IMAGE_DB_INDEX"].release_images([image_files[i] for i in errors])
+
+    return captions, errors
+
+
+def index_image_files(filenames: List[str]):
+    # Used by the background index job worker, on images persisted when the job was queued
+    image_bytes = {}
+    for filename in filenames:
+        with open(filename, mode='rb') as _file:
+            image_bytes[filename] = _file.read()
+
+    image_hashes = {filename: dhash_bytes(data) for filename, data in image_bytes.items()}
+    try:
+        return caption_and_index({filename: filename for filename in filenames}, image_bytes, image_hashes)
+    except Exception as e:
+        # Images left pending by a full caption queue stay claimed until they are retried
+        if getattr(e, "status_code", None) != 503:
+            settings.SHARED["IMAGE_DB_INDEX"].release_images(filenames)
+        raise
+
+
+def index_images(images: List[UploadFile]):
+    # An upload too large for the caption queue is refused before any image is stored
+    settings.SHARED["CAPTION_BATCHER"].check_size(len(images), BULK)
+    image_bytes = [image.file.read() for image in images]
+    image_files, image_hashes, errors, duplicates = persist_images(image_bytes)
+
+    try:
+        captions, index_errors = caption_and_index(image_files, {i: image_bytes[i] for i in image_files}, image_hashes)
+    except Exception:
+        for filename in image_files.values():
+            remove_image(filename)
+        settings.SHARED["IMAGE_DB_INDEX"].release_images(image_files.values())
+        raise
+    errors.update(index_errors)
+
+    indexed = [i for i in range(len(image_bytes)) if i not in errors and i not in duplicates]
+    msg = f"Successfully indexed {len(indexed)} new images in the user image database"
+    if duplicates:
+        msg += f", skipped {len(duplicates)} duplicates: " + "; ".join(
+            f"{d['name']} of {d['duplicate_of']}" for d in describe_duplicates(images, duplicates))
+    if errors:
+        msg += f", {len(errors)} failed: " + "; ".join(
+            f"{images[i].filename}: {error}" for i, error in sorted(errors.items()))
+
+    image_data = [base64.b64encode(image_bytes[i]).decode("utf-8") for i in indexed]
+    return list(zip(image_data, [captions[i] for i in indexed])), msg
+
+
+def index_jobs():
+    # The job queue is missing when it failed to start, e.g. on an unwritable INDEX_JOBS_DATABASE
+    if "INDEX_JOBS" not in settings.SHARED:
+        raise HTTPException(status_code=503, detail="Index jobs are not available")
+    return settings.SHARED["INDEX_JOBS"]
+
+
+def queue_index_job(images: List[UploadFile]):
+    # Persists the images straight away and leaves captioning and indexing to the background worker
+    jobs = index_jobs()
+    image_bytes = [image.file.read() for image in images]
+    image_files, _, errors, duplicates = persist_images(image_bytes)
+
+    job_id = jobs.enqueue(
+        [image_files[i] for i in sorted(image_files)], [images[i].filename for i in sorted(image_files)])
+
+    return {
+        "job_id": job_id,
+        "queued": len(image_files),
+        "failed": [{"name": images[i].filename, "error": error} for i, error in sorted(errors.items())],
+        "duplicates": describe_duplicates(images, duplicates),
+    }
 
 
 @indexing_router.post("/index")
-def index(request: Request, images: List[UploadFile]):
+def index(request: Request, images: List[UploadFile], background: Annotated[bool, Form()] = False):
+    if background:
+        return queue_index_job(images)
+
     _, msg = index_images(images)
     return msg
 
 
+@indexing_router.get("/index/jobs/{job_id}")
+def index_job(request: Request, job_id: str):
+    return index_jobs().status(job_id)
+
+
 @indexing_router.get("/index_page")
 def index_home(request: Request):
     return templates.TemplateResponse("index_form.html", {"request": request})
@@ -1,37 +1,205 @@
+import asyncio
 from contextlib import asynccontextmanager
 import os
-import shutil
+import time
 from typing import Any
 
 from fastapi import APIRouter, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.templating import Jinja2Templates
+from PIL import Image
 
-from models import ICModel, ImageDatabaseIndex
+from models import (BULK, INTERACTIVE, CaptionBatcher, CaptionCache, ICModel, ImageDatabaseIndex, ImageEmbedder,
+                    IndexJobQueue, load_embedding_function, start_timings)
+from models.db_index import HF_STORE, LOCAL_CHROMA_FOLDER, ZIPPED_INDEX_FILEPATH
+from models.index_bootstrap import ensure_index
 
 from config import settings
 from captioning import captioning_router
-from indexing import indexing_router
+from indexing import index_image_files, indexing_router
 from search import search_router
+from health import Readiness, health_router
+from metrics import metrics_router, observe_request
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("## Loading the Image Captioning model")
-    settings.SHARED["IC_MODEL"] = ICModel()
-    
+def load_ic_model(ic_model=None):
+    # A model can be given instead, e.g. the stand-in of the benchmarks, and is shared the same way
+    if ic_model is None:
+        ic_model = ICModel(
+            max_new_tokens=settings.CAPTION_MAX_NEW_TOKENS,
+            stop_at=settings.CAPTION_STOP_AT,
+            greedy=settings.CAPTION_GREEDY
+        )
+    settings.SHARED["IC_MODEL"] = ic_model
+    settings.SHARED["CAPTION_BATCHER"] = CaptionBatcher(
+        settings.SHARED["IC_MODEL"].caption_batch,
+        max_batch_size=settings.CAPTION_MAX_BATCH_SIZE,
+        max_wait_ms=settings.CAPTION_MAX_WAIT_MS,
+        max_queue_size={
+            INTERACTIVE: settings.CAPTION_INTERACTIVE_QUEUE_SIZE,
+            BULK: settings.CAPTION_BULK_QUEUE_SIZE
+        },
+        prepare=ICModel.decode_image,
+        caption_stream=settings.SHARED["IC_MODEL"].caption_stream
+    )
+
+    if settings.SHARED["IC_MODEL"].status != "Model loaded":
+        raise RuntimeError(settings.SHARED["IC_MODEL"].status)
+
+
+def bootstrap_index():
+    return ensure_index(
+        LOCAL_CHROMA_FOLDER,
+        HF_STORE,
+        ZIPPED_INDEX_FILEPATH,
+        hf_token=os.environ.get('HF_TOKEN'),
+        path=settings.FLICKER8K_INDEX_PATH,
+        revision=settings.FLICKER8K_INDEX_REVISION,
+        sha256=settings.FLICKER8K_INDEX_SHA256
+    )
+
+
+def load_embedder():
+    embedding_function = load_embedding_function(
+        backend=settings.EMBEDDING_BACKEND,
+        device=settings.EMBEDDING_DEVICE,
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+        threads=settings.EMBEDDING_THREADS,
+        cache_directory=settings.EMBEDDING_ONNX_DIRECTORY
+    )
+    # The first call initialises the model on its device, so real queries do not pay for it
+    embedding_function(["warm up"])
+    return embedding_function
+
+
+def load_image_embedder():
+    if not settings.IMAGE_EMBEDDING_MODEL:
+        return None
+
+    image_embedder = ImageEmbedder(
+        settings.IMAGE_EMBEDDING_MODEL,
+        device=settings.IMAGE_EMBEDDING_DEVICE,
+        batch_size=settings.IMAGE_EMBEDDING_BATCH_SIZE
+    )
+    image_embedder.embed([Image.new("RGB", (224, 224))])
+    return image_embedder
+
+
+def load_image_db_index(persist_directory, embedding_function, image_embedder):
+    os.makedirs(settings.USER_IMAGE_DB_DIRECTORY, exist_ok=True)
+    os.makedirs(settings.USER_INDEX_DB_DIRECTORY, exist_ok=True)
+
+    settings.SHARED["IMAGE_DB_INDEX"] = ImageDatabaseIndex(
+        os.environ.get('HF_TOKEN'),
+        settings.USER_INDEX_DB_DIRECTORY,
+        persist_directory=persist_directory,
+        embedding_function=embedding_function,
+        hash_threshold=settings.PERCEPTUAL_HASH_THRESHOLD,
+        image_embedder=image_embedder,
+        vector_store_backend=settings.VECTOR_STORE_BACKEND,
+        vector_store_directory=settings.VECTOR_STORE_DIRECTORY,
+        vector_store_storage=settings.VECTOR_STORE_STORAGE,
+        vector_store_rescore=settings.VECTOR_STORE_RESCORE
+    )
+
+    if settings.SHARED["IMAGE_DB_INDEX"].status != "Successfully loaded image database index":
+        raise RuntimeError(settings.SHARED["IMAGE_DB_INDEX"].status)
+
+
+def start_index_jobs():
+    settings.SHARED["INDEX_JOBS"] = IndexJobQueue(
+        settings.INDEX_JOBS_DATABASE,
+        index_image_files,
+        chunk_size=settings.INDEX_CHUNK_SIZE
+    )
+
+    # Images of unfinished index jobs are read before the index, so an image whose job completes
+    # in between is still seen as indexed
+    print("## Reconciling the user images with their index")
+    pending_files = settings.SHARED["INDEX_JOBS"].pending_files()
+    print(settings.SHARED["IMAGE_DB_INDEX"].reconcile_user_images(settings.USER_IMAGE_DB_DIRECTORY, keep=pending_files))
+
+
+async def retry(readiness: Readiness, name, load):
+    # Runs a loader that failed once more, returning its error if it fails again
+    try:
+        return await asyncio.to_thread(readiness.run, name, load)
+    except Exception as e:
+        return e
+
+
+async def load_components(readiness: Readiness):
+    print("## Loading the Image Captioning model, the Image Database index and the embedders")
+    ic_model, persist_directory, embedding_function, image_embedder = await asyncio.gather(
+        asyncio.to_thread(readiness.run, "ic_model", load_ic_model),
+        asyncio.to_thread(readiness.run, "index_bootstrap", bootstrap_index),
+        asyncio.to_thread(readiness.run, "embedder", load_embedder),
+        asyncio.to_thread(readiness.run, "image_embedder", load_image_embedder),
+        return_exceptions=True
+    )
+
     print("## Building the Image Database index")
-    if os.path.exists(settings.USER_IMAGE_DB_DIRECTORY):
-        shutil.rmtree(settings.USER_IMAGE_DB_DIRECTORY)
-    os.makedirs(settings.USER_IMAGE_DB_DIRECTORY)
+    # The index archive and the embedder are retried once on their own, e.g. after a Hub timeout,
+    # with the same pinned index version, and whichever loaded is kept
+    if isinstance(persist_directory, Exception):
+        persist_directory = await retry(readiness, "index_bootstrap", bootstrap_index)
+    if isinstance(embedding_function, Exception):
+        embedding_function = await retry(readiness, "embedder", load_embedder)
+    if isinstance(image_embedder, Exception):
+        # Still serve caption-based search, while readiness reports the image embedder as degraded
+        image_embedder = None
+
+    image_db_index_loaded = False
+    if isinstance(persist_directory, Exception) or isinstance(embedding_function, Exception):
+        readiness.fail("image_db_index", "Requires the flicker8k index and the embedder")
+    else:
+        try:
+            await asyncio.to_thread(
+                readiness.run, "image_db_index", load_image_db_index, persist_directory, embedding_function,
+                image_embedder)
+            image_db_index_loaded = True
+        except Exception:
+            pass
+
+    print("## Starting the background index job worker")
+    if isinstance(ic_model, Exception) or not image_db_index_loaded:
+        readiness.fail("index_jobs", "Requires the Image Captioning model and the Image Database index")
+    else:
+        try:
+            await asyncio.to_thread(readiness.run, "index_jobs", start_index_jobs)
+        except Exception:
+            pass
 
-    settings.SHARED["IMAGE_DB_INDEX"] = ImageDatabaseIndex(os.environ['HF_TOKEN'])
+    print(f"## Startup finished in {readiness.finish():.1f}s: {readiness.report()['components']}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Components load in the background so /health/live answers straight away,
+    # and /health/ready reports their progress. The service is still ready without the image embedder,
+    # which only /search_similar by image embedding needs
+    readiness = Readiness(
+        ["ic_model", "index_bootstrap", "embedder", "image_embedder", "image_db_index", "index_jobs"],
+        optional=["image_embedder"]
+    )
+    settings.SHARED["READINESS"] = readiness
+    settings.SHARED["CAPTION_CACHE"] = CaptionCache(
+        max_entries=settings.CAPTION_CACHE_SIZE,
+        directory=settings.CAPTION_CACHE_DIRECTORY,
+        max_disk_bytes=settings.CAPTION_CACHE_MAX_DISK_BYTES
+    )
+    loading = asyncio.create_task(load_components(readiness))
 
     yield
 
     print("## Cleaning up the Image Captioning model & Image Database index and releasing resources")
+    await asyncio.gather(loading, return_exceptions=True)
+    if "INDEX_JOBS" in settings.SHARED:
+        settings.SHARED["INDEX_JOBS"].close()
+    if "CAPTION_BATCHER" in settings.SHARED:
+        settings.SHARED["CAPTION_BATCHER"].close()
     settings.SHARED.clear()
-    shutil.rmtree(settings.USER_IMAGE_DB_DIRECTORY)
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -40,6 +208,33 @@ app = FastAPI(
 )
 
 
+@app.middleware("http")
+async def wait_for_startup(request: Request, call_next):
+    # Until every component has been loaded, only the health checks, metrics, docs and home page are served
+    readiness = settings.SHARED.get("READINESS")
+    if readiness is not None and readiness.loading and \
+            not request.url.path.startswith(("/health", "/metrics", "/docs", settings.API_V1_STR)) and request.url.path != "/":
+        return JSONResponse(status_code=503, content={"detail": "Service is starting"}, headers={"Retry-After": "10"})
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    # Reports the duration of every instrumented stage of the request, e.g. "embed;dur=12.3", and
+    # of the whole request, including parsing the body and serializing the response. Durations of
+    # all requests also go to the /metrics histograms
+    start = time.perf_counter()
+    timings = start_timings()
+    response = await call_next(request)
+    seconds = time.perf_counter() - start
+    observe_request(request, response.status_code, seconds)
+    if timings:
+        timings["total"] = seconds
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+    return response
+
+
 root_router = APIRouter()
 templates = Jinja2Templates(directory=settings.TEMPLATES_DIRECTORY)
 
@@ -49,6 +244,8 @@ def index(request: Request) -> Any:
 
 
 app.include_router(root_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
 app.include_router(captioning_router)
 app.include_router(indexing_router)
 app.include_router(search_router)
@@ -0,0 +1,86 @@
+from fastapi import APIRouter, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from config import settings
+from models.batcher import PRIORITY_NAMES
+from models.timing import LATENCY_BUCKETS
+
+
+metrics_router = APIRouter()
+
+REQUEST_SECONDS = Histogram(
+    "ic_model_api_request_seconds", "Duration of HTTP requests, up to their response headers",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+# Labelled histograms by (method, route, status), looked up without the lock of `labels`
+_request_histograms = {}
+
+
+def observe_request(request: Request, status: int, seconds: float):
+    # Requests are labelled by route template, e.g. "/images/{image_id:path}", so image ids do not add series
+    route = request.scope.get("route")
+    key = (request.method, route.path if route is not None else "unmatched", str(status))
+    histogram = _request_histograms.get(key)
+    if histogram is None:
+        histogram = _request_histograms.setdefault(key, REQUEST_SECONDS.labels(*key))
+    histogram.observe(seconds)
+
+
+class SharedComponentsCollector:
+    """Reads the queue depths, cache counters and readiness of the shared components when scraped.
+
+    These are kept by the components anyway, so recording them costs nothing on the request path.
+    """
+
+
+    def collect(self):
+        batcher = settings.SHARED.get("CAPTION_BATCHER")
+        if batcher is not None:
+            depth = GaugeMetricFamily(
+                "ic_model_api_caption_queue_depth", "Images waiting to be captioned", labels=["priority"])
+            for priority, pending in batcher.depth().items():
+                depth.add_metric([PRIORITY_NAMES.get(priority, str(priority))], pending)
+            yield depth
+
+        cache = settings.SHARED.get("CAPTION_CACHE")
+        if cache is not None:
+            stats = cache.stats()
+            hits = CounterMetricFamily("ic_model_api_caption_cache_hits", "Captions found in the cache", labels=["tier"])
+            hits.add_metric(["memory"], stats["memory_hits"])
+            hits.add_metric(["disk"], stats["disk_hits"])
+            yield hits
+            yield CounterMetricFamily(
+                "ic_model_api_caption_cache_misses", "Captions not found in the cache", value=stats["misses"])
+
+            entries = GaugeMetricFamily("ic_model_api_caption_cache_entries", "Cached captions", labels=["tier"])
+            entries.add_metric(["memory"], stats["memory_entries"])
+            entries.add_metric(["disk"], stats["disk_entries"])
+            yield entries
+            yield GaugeMetricFamily(
+                "ic_model_api_caption_cache_disk_bytes", "Size of the on-disk caption cache", value=stats["disk_bytes"])
+
+        image_db_index = settings.SHARED.get("IMAGE_DB_INDEX")
+        if image_db_index is not None and image_db_index.status == "Successfully loaded image database index":
+            stats = image_db_index.query_embedding_stats()
+            yield CounterMetricFamily(
+                "ic_model_api_query_embedding_cache_hits", "Search queries found in the embedding cache", value=stats["hits"])
+            yield CounterMetricFamily(
+                "ic_model_api_query_embedding_cache_misses", "Search queries embedded by the model", value=stats["misses"])
+            yield GaugeMetricFamily(
+                "ic_model_api_query_embedding_cache_entries", "Cached query embeddings", value=stats["entries"])
+
+        readiness = settings.SHARED.get("READINESS")
+        if readiness is not None:
+            ready = GaugeMetricFamily(
+                "ic_model_api_component_ready", "Whether every component loaded at startup is ready", labels=["component"])
+            for name, component in readiness.report()["components"].items():
+                ready.add_metric([name], float(component["state"] == "ready"))
+            yield ready
+
+
+REGISTRY.register(SharedComponentsCollector())
+
+
+@metrics_router.get("/metrics")
+def metrics(request: Request):
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -1,2 +1,12 @@
 from .ic_model import ICModel
-from .db_index import ImageDatabaseIndex
\ No newline at end of file
+from .db_index import ImageDatabaseIndex
+from .batcher import CaptionBatcher, INTERACTIVE, BULK
+from .caption_cache import CaptionCache
+from .image_store import ImageStore
+from .renditions import SIZES
+from .timing import stage, start_timings
+from .index_jobs import IndexJobQueue
+from .embedding import load_embedding_function
+from .image_embedding import ImageEmbedder
+from .vector_store import ChromaVectorStore, MmapVectorStore, export_collection
+from .dedup import PerceptualHashIndex, dhash, dhash_bytes
@@ -0,0 +1,230 @@
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import SimpleQueue
+
+from fastapi import HTTPException
+from prometheus_client import Counter, Histogram
+
+
+# Priority classes, served in this order
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+CAPTION_BATCH_SIZE = Histogram(
+    "ic_model_api_caption_batch_size", "Images captioned per generate call", buckets=(1, 2, 4, 8, 16, 32, 64))
+CAPTION_REJECTED = Counter(
+    "ic_model_api_caption_rejected_total", "Images turned away because their caption queue was full", ["priority"])
+
+
+class CaptionBatcher:
+    """Collects concurrent caption requests into batches for a single generate call.
+
+    Callers block on their own future while a dedicated worker thread waits up
+    to `max_wait_ms` for more requests to arrive, then runs `caption_batch` once
+    over at most `max_batch_size` images. Interactive requests are always taken
+    before bulk ones, and each priority class has its own bounded queue: when it
+    is full, new requests are rejected straight away with a 503 and a
+    Retry-After estimate instead of waiting behind the backlog.
+
+    Each image goes through `prepare` (e.g. decoding) on its own before joining
+    the batch, so an invalid upload only fails its own request. Streamed
+    captions are admitted and queued like the others, and then generated on
+    their own with `caption_stream` in their turn, so they never compete with
+    batches for the model.
+    """
+
+
+    def __init__(self, caption_batch, max_batch_size=8, max_wait_ms=10, max_queue_size=None, prepare=None,
+                 caption_stream=None):
+        self.caption_batch = caption_batch
+        self.prepare = prepare
+        self.caption_stream = caption_stream
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size or {INTERACTIVE: 64, BULK: 256}
+
+        self.queues = {priority: deque() for priority in sorted(self.max_queue_size)}
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # Moving average of the batch latency, used for the Retry-After estimate
+        self.batch_seconds = 1.0
+
+        self.worker = threading.Thread(target=self._run, name="caption-batcher", daemon=True)
+        self.worker.start()
+
+
+    def submit(self, image, priority=INTERACTIVE):
+        return self.submit_many([image], priority)[0]
+
+
+    def submit_many(self, images, priority=INTERACTIVE):
+        return self._admit(images, priority)
+
+
+    def stream(self, image, priority=INTERACTIVE):
+        # Returns an iterator over the caption text as it is generated, which raises the error of a failed caption
+        if self.caption_stream is None:
+            raise HTTPException(status_code=500, detail="Streamed captions are not enabled")
+
+        texts = SimpleQueue()
+        future = self._admit([image], priority, texts)[0]
+
+        def stream_texts():
+            while (text := texts.get()) is not None:
+                yield text
+            future.result()
+
+        return stream_texts()
+
+
+    def check_size(self, count, priority=INTERACTIVE):
+        # Uploads larger than the queue itself could never be admitted, so they are refused for good
+        # rather than retried. Called before the images are stored, as well as on admission
+        if count > self.max_queue_size[priority]:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Too many images to caption at once: {count}, at most {self.max_queue_size[priority]}"
+            )
+
+
+    def _admit(self, images, priority, texts=None):
+        # Either all images are admitted or none, so a bulk upload never half-runs
+        self.check_size(len(images), priority)
+
+        futures = [Future() for _ in images]
+        with self.condition:
+            queue = self.queues[priority]
+            if self.closed:
+                raise HTTPException(status_code=503, detail="Caption worker is shutting down")
+            if len(queue) + len(images) > self.max_queue_size[priority]:
+                CAPTION_REJECTED.labels(PRIORITY_NAMES.get(priority, str(priority))).inc(len(images))
+                raise HTTPException(
+                    status_code=503,
+                    detail="Caption queue is full, please retry later",
+                    headers={"Retry-After": str(self._retry_after())}
+                )
+
+            queue.extend((image, future, texts) for image, future in zip(images, futures))
+            self.condition.notify()
+
+        return futures
+
+
+    def caption(self, image, priority=INTERACTIVE):
+        return self.submit(image, priority).result()
+
+
+    def depth(self):
+        with self.condition:
+            return {priority: len(queue) for priority, queue in self.queues.items()}
+
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._pending() / self.max_batch_size * self.batch_seconds))
+
+
+    def _pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+    def _take(self, batch):
+        # A streamed caption is always generated on its own
+        for queue in self.queues.values():
+            while queue and len(batch) < self.max_batch_size:
+                if batch and (self._streamed(batch) or queue[0][2] is not None):
+                    return
+                batch.append(queue.popleft())
+
+
+    @staticmethod
+    def _streamed(batch):
+        return batch[0][2] is not None
+
+
+    def _collect(self):
+        with self.condition:
+            while not self._pending():
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            batch = []
+            self._take(batch)
+
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size and not self.closed and not self._streamed(batch):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.condition.wait(timeout)
+                self._take(batch)
+
+            return batch
+
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if self.prepare is not None:
+                batch = self._prepare(batch)
+            if not batch:
+                continue
+            if self._streamed(batch):
+                self._stream(*batch[0])
+                continue
+
+            CAPTION_BATCH_SIZE.observe(len(batch))
+            start = time.monotonic()
+            try:
+                captions = self.caption_batch([image for image, _, _ in batch])
+                if len(captions) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} captions, got {len(captions)}")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.batch_seconds = 0.8 * self.batch_seconds + 0.2 * (time.monotonic() - start)
+
+            for (_, future, _), caption in zip(batch, captions):
+                future.set_result(caption)
+
+
+    def _prepare(self, batch):
+        prepared = []
+        for image, future, texts in batch:
+            try:
+                prepared.append((self.prepare(image), future, texts))
+            except Exception as e:
+                future.set_exception(e)
+                if texts is not None:
+                    texts.put(None)
+        return prepared
+
+
+    def _stream(self, image, future, texts):
+        # Generates the whole caption before the next batch, handing its text over as it comes
+        try:
+            for text in self.caption_stream(image):
+                texts.put(text)
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            texts.put(None)
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class CaptionCache:
+    """Caption cache keyed by the SHA-256 of the image bytes.
+
+    Entries live in an in-memory LRU and, when `directory` is given, in an
+    on-disk tier that survives restarts and is evicted oldest-first once it
+    grows past `max_disk_bytes`.
+    """
+
+
+    def __init__(self, max_entries=4096, directory=None, max_disk_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_disk_entries()
+
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+
+        caption = self._read_disk(key)
+
+        with self.lock:
+            if caption is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self._put_memory(key, caption)
+            return caption
+
+
+    def put(self, key, caption):
+        with self.lock:
+            self._put_memory(key, caption)
+        self._write_disk(key, caption)
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "max_memory_entries": self.max_entries,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes if self.directory else 0,
+            }
+
+
+    def _put_memory(self, key, caption):
+        self.memory[key] = caption
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".txt")
+
+
+    def _load_disk_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".txt"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name[:-len(".txt")], stat.st_size))
+
+        # Oldest entries first, so they are the first to be evicted
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                caption = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+        return caption
+
+
+    def _write_disk(self, key, caption):
+        if not self.directory:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(caption)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.disk_bytes += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+
+            evicted = []
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                old_key, old_size = self.disk.popitem(last=False)
+                self.disk_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
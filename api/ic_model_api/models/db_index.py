@@ -1,47 +1,116 @@
 import base64
+import hashlib
 import os
-import shutil
-import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import chromadb
 from chromadb.config import Settings
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 
 from fastapi import HTTPException
-from huggingface_hub import hf_hub_download
+
+from .dedup import PerceptualHashIndex, hamming
+from .embedding import load_embedding_function
+from .ic_model import ICModel
+from .image_store import ImageStore
+from .index_bootstrap import ensure_index
+from .lexical import BM25Index, reciprocal_rank_fusion
+from .pagination import decode_cursor, encode_cursor, query_key
+from .renditions import RENDITIONS, SIZES, ensure_rendition, is_rendition, rendition_path
+from .timing import stage
+from .vector_store import RESCORE, ChromaVectorStore, load_vector_store, similarity
 
 
 LOCAL_CHROMA_FOLDER = "chromadb"
+LOCAL_IMAGE_STORE_FOLDER = "flicker8k_images"
 HF_STORE = "AIMLOps-C4-G16/indexing_api_store"
 ZIPPED_INDEX_FILEPATH = "chromadb_index.zip"
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+SEARCH_MODES = ("caption", "image")
+TEXT_SEARCH_MODES = ("hybrid", "vector", "keyword")
+COLLECTIONS = ("user", "flicker8k")
+# Hits taken from each ranking for a hybrid ranking, bounding how far its results can be paged
+FUSION_DEPTH = 100
 
 
 class ImageDatabaseIndex:
 
 
-    def __init__(self, hf_token):
+    def __init__(self, hf_token, user_db_directory="user_images_index", index_path=None, index_revision=None, index_sha256=None,
+                 persist_directory=None, embedding_function=None, hash_threshold=4, image_embedder=None,
+                 vector_store_backend="chroma", vector_store_directory="vector_store", vector_store_storage="float32",
+                 vector_store_rescore=RESCORE):
         try:
             self.hf_token = hf_token
+            self.image_store = ImageStore(LOCAL_IMAGE_STORE_FOLDER, HF_STORE, hf_token)
 
-            if not os.path.exists(LOCAL_CHROMA_FOLDER):
-                os.makedirs(LOCAL_CHROMA_FOLDER)
-            
-            zipped_index_file = hf_hub_download(
-                repo_id=HF_STORE,
-                filename=ZIPPED_INDEX_FILEPATH,
-                repo_type="dataset",
-                cache_dir=LOCAL_CHROMA_FOLDER,
-                local_dir_use_symlinks=False,
-                token=self.hf_token
+            # The index and embedder can be loaded beforehand, e.g. in parallel at startup
+            persist_directory = persist_directory or ensure_index(
+                LOCAL_CHROMA_FOLDER,
+                HF_STORE,
+                ZIPPED_INDEX_FILEPATH,
+                hf_token=self.hf_token,
+                path=index_path,
+                revision=index_revision,
+                sha256=index_sha256
             )
-            shutil.unpack_archive(zipped_index_file, LOCAL_CHROMA_FOLDER, 'zip')
-
-            persist_directory = LOCAL_CHROMA_FOLDER + "/chromadb_index"
             self.db_client = chromadb.PersistentClient(path=persist_directory, settings=Settings(anonymized_telemetry=False))
+            # User images are indexed in their own database, which is kept across restarts
+            # instead of being overwritten with the flicker8k index
+            self.user_db_client = chromadb.PersistentClient(path=user_db_directory, settings=Settings(anonymized_telemetry=False))
 
-            self.embedding_function = SentenceTransformerEmbeddingFunction(model_name="all-mpnet-base-v2", device="cuda")
+            self.embedding_function = embedding_function or load_embedding_function()
             # If this throws an error, there was an error loading the flicker8k database index:
-            self.db_client.get_collection(name="flicker8k", embedding_function=self.embedding_function)
+            self.collections = {
+                "user": self.user_db_client.get_or_create_collection(name="user", embedding_function=self.embedding_function),
+                "flicker8k": self.db_client.get_collection(name="flicker8k", embedding_function=self.embedding_function),
+            }
+
+            # CLIP embeddings of the images themselves, for /search_similar without captioning. The flicker8k
+            # ones are kept next to the user index, so they survive updates of the flicker8k index
+            self.image_embedder = image_embedder
+            self.image_collections = {
+                name: self.user_db_client.get_or_create_collection(
+                    name=f"{name}_clip", embedding_function=None, metadata={"hnsw:space": "cosine"})
+                for name in COLLECTIONS
+            } if image_embedder else {}
+
+            # Nearest-neighbour queries go through a vector store. The flicker8k collections rarely change,
+            # on startup or when their image embeddings are backfilled, so they can be served from
+            # memory-mapped exports shared by all worker processes, exported again when they change.
+            # The user collections are always queried in chromadb
+            store_options = {"backend": vector_store_backend, "storage": vector_store_storage, "rescore": vector_store_rescore}
+            self.vector_stores = {
+                "user": ChromaVectorStore(self.collections["user"]),
+                "flicker8k": load_vector_store(
+                    self.collections["flicker8k"], directory=os.path.join(vector_store_directory, "flicker8k"), **store_options),
+            }
+            self.image_vector_stores = {
+                "user": ChromaVectorStore(self.image_collections["user"]),
+                "flicker8k": load_vector_store(
+                    self.image_collections["flicker8k"], directory=os.path.join(vector_store_directory, "flicker8k_clip"),
+                    **store_options),
+            } if image_embedder else {}
+
+            # BM25 indexes over the captions, for exact names that embeddings rank poorly
+            self.lexical_indexes = {name: self._load_lexical_index(name) for name in COLLECTIONS}
+
+            # Perceptual hashes of the user images, to find near-duplicates without captioning them
+            self.hash_threshold = hash_threshold
+            self._load_image_hashes()
+            # Hashes of the images being captioned, claimed under a lock so that concurrent uploads of an
+            # image cannot both be indexed
+            self.pending_hashes = {}
+            self.dedup_lock = threading.Lock()
+
+            # Each query is embedded once and then looked up in both collections concurrently
+            self.query_embeddings = OrderedDict()
+            self.query_embeddings_lock = threading.Lock()
+            self.query_embedding_hits = 0
+            self.query_embedding_misses = 0
+            self.executor = ThreadPoolExecutor(max_workers=len(self.collections), thread_name_prefix="collection-query")
 
             self.status = "Successfully loaded image database index"
 
@@ -49,10 +118,75 @@ class ImageDatabaseIndex:
             self.status = "Unable to load image database index: " + str(e)
     
 
-    def index(self, image_files, captions):
+    def _load_image_hashes(self):
+        image_hashes = PerceptualHashIndex(self.hash_threshold)
+        stored = self.collections["user"].get(include=["metadatas"])
+        for image_id, metadata in zip(stored['ids'], stored['metadatas']):
+            if metadata and "dhash" in metadata:
+                image_hashes.add(int(metadata["dhash"], 16), image_id)
+        self.image_hashes = image_hashes
+
+
+    def _load_lexical_index(self, collection_name):
+        lexical_index = BM25Index()
+        stored = self.collections[collection_name].get(include=["documents"])
+        for image_id, caption in zip(stored['ids'], stored['documents']):
+            lexical_index.add(image_id, caption)
+        return lexical_index
+
+
+    def find_duplicate(self, image_hash):
+        return self.image_hashes.find(image_hash)
+
+
+    def claim_image(self, image_hash, image_file):
+        # Returns the id of a near-duplicate, indexed or still being indexed, or else reserves the hash
+        # for `image_file` until it is indexed or released
+        with self.dedup_lock:
+            duplicate = self.image_hashes.find(image_hash)
+            if duplicate is None and self.hash_threshold >= 0:
+                duplicate = next((other for other, pending in self.pending_hashes.items()
+                                  if hamming(image_hash, pending) <= self.hash_threshold), None)
+            if duplicate is None:
+                self.pending_hashes[image_file] = image_hash
+            return duplicate
+
+
+    def release_images(self, image_files):
+        # Drops the claims of images that will not be indexed
+        with self.dedup_lock:
+            for image_file in image_files:
+                self.pending_hashes.pop(image_file, None)
+
+
+    def caption_of(self, image_id):
+        documents = self.collections["user"].get(ids=[image_id], include=["documents"])['documents']
+        return documents[0] if documents else None
+
+
+    def index(self, image_files, captions, image_hashes=None):
         try:
-            collection = self.db_client.get_or_create_collection(name="user", embedding_function=self.embedding_function)
-            collection.add(ids=image_files, documents=captions)
+            metadatas = [{"dhash": f"{h:016x}"} for h in image_hashes] if image_hashes else None
+            if self.image_collections:
+                with stage("embed_image"):
+                    image_embeddings = self.image_embedder.embed([ensure_rendition(f, "preview") for f in image_files])
+
+            # Upsert, so images re-submitted by a resumed index job are not duplicated. Chroma embeds the captions
+            with stage("index_upsert"):
+                self.collections["user"].upsert(ids=image_files, documents=captions, metadatas=metadatas)
+                if self.image_collections:
+                    self.image_collections["user"].upsert(ids=image_files, embeddings=image_embeddings)
+            self.vector_stores["user"].changed()
+            if self.image_collections:
+                self.image_vector_stores["user"].changed()
+
+            for image_file, caption in zip(image_files, captions):
+                self.lexical_indexes["user"].add(image_file, caption)
+            with self.dedup_lock:
+                for image_file, image_hash in zip(image_files, image_hashes or []):
+                    self.image_hashes.add(image_hash, image_file)
+                for image_file in image_files:
+                    self.pending_hashes.pop(image_file, None)
 
             return f"Successfully indexed {len(image_files)} new images in the user image database"
         
@@ -60,52 +194,397 @@ class ImageDatabaseIndex:
             raise HTTPException(status_code=500, detail=str(e))
 
 
-    def search(self, text: str, num: int):
+    def search(self, text: str, num: int, refs: bool = False, size: str = "original", mode: str = "vector",
+               min_similarity: Optional[float] = None):
+        return self.search_batch([(text, num)], refs, size, mode, min_similarity)[0]
+
+
+    def search_batch(self, queries, refs: bool = False, size: str = "original", mode: str = "vector",
+                     min_similarity: Optional[float] = None):
+        # Searches (text, num) queries together, returning their results in the same order. "vector" ranks
+        # by caption embedding, "keyword" by BM25 alone without embedding the queries, and "hybrid" fuses both
+        self._check_search(size, mode)
+        if not queries:
+            return []
+
+        try:
+            rankings = self._text_rankings([text for text, _ in queries], [self._depth(mode, n) or n for _, n in queries], mode)
+
+            with stage("read_images"):
+                return [
+                    [
+                        self._results(name, *self._cut(name, ids[:n], distances[:n], min_similarity), refs, size)
+                        for name, (ids, distances) in ranking.items()
+                    ]
+                    for ranking, (_, n) in zip(rankings, queries)
+                ]
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+    def search_page(self, text: str, num: int, refs: bool = False, size: str = "original", mode: str = "vector",
+                    cursor: Optional[str] = None, min_similarity: Optional[float] = None):
+        # One page of `search` results per collection, with their distances and the cursor of the next page
+        self._check_search(size, mode)
+        key = query_key("text", mode, text, size, min_similarity)
+        offsets, depth = self._open_cursor(cursor, key, self._depth(mode, num))
+
+        try:
+            fetch = depth or max(offset for offset in offsets if offset is not None) + num
+            ranking = self._text_rankings([text], [fetch], mode)[0]
+
+            with stage("read_images"):
+                return self._page(ranking, offsets, num, depth, key, refs, size, min_similarity, ordered=mode == "vector")
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+    def _check_search(self, size, mode=None):
         if self.status != "Successfully loaded image database index":
             raise HTTPException(status_code=500, detail=self.status)
+        if size not in SIZES:
+            raise HTTPException(status_code=422, detail=f"Unknown image size: {size}, expected one of {', '.join(SIZES)}")
+        if mode is not None and mode not in TEXT_SEARCH_MODES:
+            raise HTTPException(
+                status_code=422, detail=f"Unknown search mode: {mode}, expected one of {', '.join(TEXT_SEARCH_MODES)}")
+
+
+    def _depth(self, mode, num):
+        # Fused rankings are always made from the same number of hits of each ranking, so that every
+        # page of a query slices the same ranking
+        return max(FUSION_DEPTH, num) if mode == "hybrid" else None
 
+
+    def _open_cursor(self, cursor, key, depth):
+        if cursor is None:
+            return [0] * len(COLLECTIONS), depth
         try:
-            result = []
+            return decode_cursor(cursor, key, len(COLLECTIONS))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+
+    def _text_rankings(self, texts, fetches, mode):
+        # The `fetch` best (ids, distances) of every text in each collection
+        num = max(fetches)
 
-            # Get results from user database
-            collection = self.db_client.get_or_create_collection(name="user", embedding_function=self.embedding_function)
-            ids = collection.query(query_texts=[text], n_results=num)['ids'][0]
+        vector_hits = {name: ([[] for _ in texts], [[] for _ in texts]) for name in COLLECTIONS}
+        if mode != "keyword":
+            with stage("embed"):
+                embeddings = self.embed(texts)
 
-            images_data = []
-            for img_file in ids:
-                with open(img_file, mode='rb') as _file:
-                    data = _file.read()
-                    images_data.append(base64.b64encode(data).decode("utf-8"))
+            # Get results from the user and flicker8k databases, with enough hits for the largest query
+            with stage("vector_query"):
+                futures = [self.executor.submit(self._query, name, embeddings, num) for name in COLLECTIONS]
+                for future in futures:
+                    name, ids, distances = future.result()
+                    vector_hits[name] = (ids, distances)
 
-            result.append(images_data)
+        lexical_hits = {name: [[] for _ in texts] for name in COLLECTIONS}
+        if mode != "vector":
+            with stage("lexical_query"):
+                for name in COLLECTIONS:
+                    lexical_hits[name] = [
+                        [image_id for image_id, _ in self.lexical_indexes[name].search(text, num)] for text in texts
+                    ]
 
-            # Get results from flicker8k database
-            result.append(self._search_flicker8k(text, num))
+        return [
+            {name: self._rank(vector_hits[name], lexical_hits[name], i, fetch) for name in COLLECTIONS}
+            for i, fetch in enumerate(fetches)
+        ]
 
-            return result
 
+    def _rank(self, vector_hits, lexical_hits, i, num):
+        # Fuses the vector and lexical rankings of query i by reciprocal rank. Images only found by
+        # their caption's keywords have no vector distance
+        ids, distances = vector_hits[0][i], vector_hits[1][i]
+        if not lexical_hits[i]:
+            return ids[:num], distances[:num]
+
+        distance_of = dict(zip(ids, distances))
+        ranked = reciprocal_rank_fusion([ids[:num], lexical_hits[i][:num]])[:num]
+        return ranked, [distance_of.get(image_id) for image_id in ranked]
+
+
+    def search_by_image(self, image, num: int, refs: bool = False, size: str = "original",
+                        min_similarity: Optional[float] = None):
+        # Nearest images by CLIP embedding, returned like the results of `search`
+        self._check_search(size)
+        if not self.image_collections:
+            raise HTTPException(status_code=400, detail="Image embedding search is not enabled")
+
+        try:
+            ranking = self._image_ranking(image, num)
+            with stage("read_images"):
+                return [
+                    self._results(name, *self._cut(name, ids, distances, min_similarity, self.image_vector_stores), refs, size)
+                    for name, (ids, distances) in ranking.items()
+                ]
+
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
-    
 
-    def _search_flicker8k(self, text: str, num: int):
-        collection = self.db_client.get_collection(name="flicker8k", embedding_function=self.embedding_function)
-        ids = collection.query(query_texts=[text], n_results=num)['ids'][0]
-
-        images_data = []
-        with tempfile.TemporaryDirectory() as tmpdir:
-            for f in ids:
-                img_file = hf_hub_download(
-                    repo_id=HF_STORE,
-                    filename=f,
-                    repo_type="dataset",
-                    cache_dir=tmpdir,
-                    local_dir_use_symlinks=False,
-                    token=self.hf_token
-                )
-
-                with open(img_file, mode='rb') as _file:
-                    data = _file.read()
-                    images_data.append(base64.b64encode(data).decode("utf-8"))
-        
-        return images_data
+
+    def search_by_image_page(self, image, num: int, refs: bool = False, size: str = "original",
+                             cursor: Optional[str] = None, min_similarity: Optional[float] = None):
+        self._check_search(size)
+        if not self.image_collections:
+            raise HTTPException(status_code=400, detail="Image embedding search is not enabled")
+        key = query_key("image", hashlib.sha256(image).hexdigest(), size, min_similarity)
+        offsets, _ = self._open_cursor(cursor, key, None)
+
+        try:
+            ranking = self._image_ranking(image, max(offset for offset in offsets if offset is not None) + num)
+            with stage("read_images"):
+                return self._page(
+                    ranking, offsets, num, None, key, refs, size, min_similarity, ordered=True,
+                    vector_stores=self.image_vector_stores)
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+    def _image_ranking(self, image, num):
+        # An upload that is not an image is rejected with a 422 rather than failing in the embedder
+        image = ICModel.decode_image(image)
+        with stage("embed_image"):
+            embeddings = self.image_embedder.embed([image])
+
+        with stage("vector_query"):
+            futures = [
+                self.executor.submit(self._query, name, embeddings, num, self.image_vector_stores)
+                for name in COLLECTIONS
+            ]
+            return {name: (ids[0], distances[0]) for name, ids, distances in (future.result() for future in futures)}
+
+
+    def _page(self, ranking, offsets, num, depth, key, refs, size, min_similarity, ordered, vector_stores=None):
+        results, next_offsets = [], []
+        for name, offset in zip(COLLECTIONS, offsets):
+            if offset is None:
+                results.append([])
+                next_offsets.append(None)
+                continue
+
+            ids, distances = ranking[name][0][offset:offset + num], ranking[name][1][offset:offset + num]
+            end = offset + len(ids)
+            exhausted = len(ids) < num or (depth is not None and end >= depth)
+
+            kept_ids, kept_distances = self._cut(name, ids, distances, min_similarity, vector_stores)
+            # Hits ranked by distance only get further away on later pages
+            if ordered and len(kept_ids) < len(ids):
+                exhausted = True
+
+            results.append(self._hits(name, kept_ids, kept_distances, refs, size))
+            next_offsets.append(None if exhausted else end)
+
+        next_cursor = encode_cursor(key, next_offsets, depth) if any(o is not None for o in next_offsets) else None
+        return {"results": results, "next_cursor": next_cursor}
+
+
+    def _cut(self, collection_name, ids, distances, min_similarity, vector_stores=None):
+        # Drops hits less similar than `min_similarity`. Keyword-only hits have no distance and are kept
+        if min_similarity is None:
+            return ids, distances
+
+        space = (vector_stores or self.vector_stores)[collection_name].space
+        kept = [(i, d) for i, d in zip(ids, distances) if d is None or similarity(d, space) >= min_similarity]
+        return [i for i, _ in kept], [d for _, d in kept]
+
+
+    def embed(self, texts):
+        # Embeds all uncached texts in a single call, keeping recent query embeddings in an LRU cache
+        with self.query_embeddings_lock:
+            embeddings = {text: self.query_embeddings[text] for text in texts if text in self.query_embeddings}
+            for text in embeddings:
+                self.query_embeddings.move_to_end(text)
+            hits = sum(1 for text in texts if text in embeddings)
+            self.query_embedding_hits += hits
+            self.query_embedding_misses += len(texts) - hits
+
+        missing = list(dict.fromkeys(text for text in texts if text not in embeddings))
+        if missing:
+            computed = dict(zip(missing, self.embedding_function(missing)))
+            with self.query_embeddings_lock:
+                self.query_embeddings.update(computed)
+                while len(self.query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                    self.query_embeddings.popitem(last=False)
+            embeddings.update(computed)
+
+        return [embeddings[text] for text in texts]
+
+
+    def query_embedding_stats(self):
+        with self.query_embeddings_lock:
+            return {
+                "hits": self.query_embedding_hits,
+                "misses": self.query_embedding_misses,
+                "entries": len(self.query_embeddings),
+            }
+
+
+    def _query(self, collection_name, embeddings, num, vector_stores=None):
+        # The `num` nearest hits of every embedding, ordered by (distance, id). Hits tied with the farthest
+        # one fetched are only kept once all of them are known, so the hits of a query are always a prefix
+        # of those of the same query with a larger `num`, and pages neither repeat nor skip hits
+        store = (vector_stores or self.vector_stores)[collection_name]
+        results = [None] * len(embeddings)
+        pending, fetch = list(range(len(embeddings))), num + 1
+        while pending:
+            ids, distances = store.query([embeddings[i] for i in pending], fetch)
+            retry = []
+            for i, row_ids, row_distances in zip(pending, ids, distances):
+                hits = sorted(zip(row_distances, row_ids))
+                # Fewer hits than fetched means the whole collection was ranked
+                if len(hits) == fetch:
+                    hits = [hit for hit in hits if hit[0] < hits[-1][0]]
+                    if len(hits) < num:
+                        retry.append(i)
+                        continue
+                results[i] = [image_id for _, image_id in hits[:num]], [distance for distance, _ in hits[:num]]
+            pending, fetch = retry, fetch * 2
+
+        return collection_name, [ids for ids, _ in results], [distances for _, distances in results]
+
+
+    def _results(self, collection_name, ids, distances, refs, size):
+        # Either references to be fetched from /images/{id}, or the inline base64-encoded images
+        if refs:
+            return [{"id": f"{collection_name}/{i}", "distance": d} for i, d in zip(ids, distances)]
+
+        return [self._read_image(collection_name, i, size) for i in ids]
+
+
+    def _hits(self, collection_name, ids, distances, refs, size):
+        # Like `_results`, but inline images also come with their id and distance
+        hits = [{"id": f"{collection_name}/{i}", "distance": d} for i, d in zip(ids, distances)]
+        if not refs:
+            for hit, i in zip(hits, ids):
+                hit["image"] = self._read_image(collection_name, i, size)
+        return hits
+
+
+    def _read_image(self, collection_name, image_id, size):
+        with stage("file_read"):
+            with open(self._image_file(collection_name, image_id, size), mode='rb') as _file:
+                data = _file.read()
+        with stage("encode"):
+            return base64.b64encode(data).decode("utf-8")
+
+
+    def _image_file(self, collection_name, image_id, size="original"):
+        if collection_name == "flicker8k":
+            return self.image_store.path(image_id, size)
+        return ensure_rendition(image_id, size)
+
+
+    def image_path(self, image_ref: str, size: str = "original"):
+        # Only images present in one of the collections can be fetched by reference
+        if self.status != "Successfully loaded image database index":
+            raise HTTPException(status_code=500, detail=self.status)
+        if size not in SIZES:
+            raise HTTPException(status_code=422, detail=f"Unknown image size: {size}, expected one of {', '.join(SIZES)}")
+
+        collection_name, _, image_id = image_ref.partition("/")
+        if collection_name not in COLLECTIONS:
+            raise HTTPException(status_code=404, detail=f"Unknown image: {image_ref}")
+
+        try:
+            if not self.collections[collection_name].get(ids=[image_id], include=[])['ids']:
+                raise HTTPException(status_code=404, detail=f"Unknown image: {image_ref}")
+
+            return self._image_file(collection_name, image_id, size)
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+    def reconcile_user_images(self, directory, keep=()):
+        # Drops index entries whose image file is gone, and deletes image files that are neither
+        # indexed nor in `keep` (e.g. images still waiting in an index job). Ids are paths relative to
+        # the working directory they were indexed from, so paths are compared once resolved
+        if self.status != "Successfully loaded image database index":
+            return self.status
+
+        collection = self.collections["user"]
+        indexed = {os.path.realpath(image_id): image_id for image_id in collection.get(include=[])['ids']}
+
+        missing = [image_id for path, image_id in indexed.items() if not os.path.exists(path)]
+        if indexed and len(missing) == len(indexed):
+            # Most likely started from another working directory or with another image directory,
+            # rather than every image file having been deleted
+            return f"Skipped reconciling the user images: none of the {len(indexed)} indexed images " \
+                   f"was found from {os.getcwd()}"
+
+        if missing:
+            collection.delete(ids=missing)
+            self.vector_stores["user"].changed()
+            if self.image_collections:
+                self.image_collections["user"].delete(ids=missing)
+                self.image_vector_stores["user"].changed()
+            for image_id in missing:
+                self.lexical_indexes["user"].remove(image_id)
+                # The renditions of a deleted original would otherwise be left behind for good
+                for size in RENDITIONS:
+                    if os.path.exists(rendition_path(image_id, size)):
+                        os.remove(rendition_path(image_id, size))
+            self._load_image_hashes()
+
+        keep = {os.path.realpath(path) for path in keep}
+        orphans = 0
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if is_rendition(path) or os.path.realpath(path) in indexed or os.path.realpath(path) in keep:
+                    continue
+                for size in SIZES:
+                    if os.path.exists(rendition_path(path, size)):
+                        os.remove(rendition_path(path, size))
+                orphans += 1
+
+        for root, dirs, files in os.walk(directory, topdown=False):
+            if root != directory and not dirs and not files:
+                os.rmdir(root)
+
+        return f"Kept {len(indexed) - len(missing)} indexed user images, removed {len(missing)} index entries " \
+               f"without an image file and {orphans} image files without an index entry"
+
+
+    def flicker8k_ids(self):
+        return self.collections["flicker8k"].get(include=[])['ids']
+
+
+    def backfill_image_embeddings(self, collection_name, batch_size=64, workers=8):
+        # Adds the CLIP embeddings of every image of the collection that does not have one yet, e.g. all
+        # of flicker8k, and drops those of images no longer in it. Safe to interrupt and run again
+        if not self.image_collections:
+            raise ValueError("Image embedding search is not enabled")
+
+        ids = self.collections[collection_name].get(include=[])['ids']
+        image_collection = self.image_collections[collection_name]
+        embedded = set(image_collection.get(include=[])['ids'])
+
+        stale = list(embedded - set(ids))
+        if stale:
+            image_collection.delete(ids=stale)
+            self.image_vector_stores[collection_name].changed()
+
+        missing = [image_id for image_id in ids if image_id not in embedded]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                # The preview renditions are plenty for the encoder, and much faster to decode
+                paths = list(executor.map(lambda image_id: self._image_file(collection_name, image_id, "preview"), batch))
+                image_collection.upsert(ids=batch, embeddings=self.image_embedder.embed(paths))
+                self.image_vector_stores[collection_name].changed()
+                print(f"## Embedded {start + len(batch)}/{len(missing)} {collection_name} images")
+
+        return len(missing), len(stale)
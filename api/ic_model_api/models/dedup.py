@@ -0,0 +1,98 @@
+from io import BytesIO
+import threading
+
+from PIL import Image
+
+
+def dhash(image, size=8):
+    # Difference hash: one bit per pair of horizontally adjacent pixels of a small grayscale thumbnail
+    pixels = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left, right = pixels[row * (size + 1) + col], pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def dhash_bytes(data, size=8):
+    with Image.open(BytesIO(data)) as image:
+        # Lets JPEGs decode straight to a reduced size, which is all the hash needs
+        image.draft("L", (size * 8, size * 8))
+        return dhash(image, size)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes, for nearest-neighbour lookups in Hamming distance."""
+
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+
+    def add(self, value, item):
+        node = [value, item, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+
+    def search(self, value, threshold):
+        # All (distance, item) pairs within `threshold` of `value`, closest first
+        if self.root is None:
+            return []
+
+        matches, candidates = [], [self.root]
+        while candidates:
+            node_value, item, children = candidates.pop()
+            distance = hamming(value, node_value)
+            if distance <= threshold:
+                matches.append((distance, item))
+            for child_distance, child in children.items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    candidates.append(child)
+
+        return sorted(matches, key=lambda match: match[0])
+
+
+class PerceptualHashIndex:
+    """Thread-safe index from perceptual hashes to image ids."""
+
+
+    def __init__(self, threshold=4):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+
+
+    def add(self, value, image_id):
+        with self.lock:
+            self.tree.add(value, image_id)
+
+
+    def find(self, value):
+        # Id of the closest stored image within the threshold, if any
+        if self.threshold < 0:
+            return None
+        with self.lock:
+            matches = self.tree.search(value, self.threshold)
+        return matches[0][1] if matches else None
+
+
+    def __len__(self):
+        return self.tree.size
@@ -0,0 +1,125 @@
+import fcntl
+import os
+import shutil
+import tempfile
+
+import torch
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from sentence_transformers import SentenceTransformer
+
+
+MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+BACKENDS = ("auto", "sentence-transformers", "onnx", "torch-int8")
+
+
+def select_device(device=None):
+    if device:
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+class SentenceTransformerBackend(EmbeddingFunction):
+    """all-mpnet-base-v2 through sentence-transformers, optionally int8-quantized for the CPU."""
+
+
+    def __init__(self, device="cpu", batch_size=32, quantize=False):
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(MODEL_NAME, device=device)
+        if quantize:
+            # Dynamic int8 quantization of the linear layers, which hold nearly all the compute
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+    def __call__(self, input: Documents) -> Embeddings:
+        with torch.inference_mode():
+            return self.model.encode(list(input), batch_size=self.batch_size, convert_to_numpy=True).tolist()
+
+
+class OnnxBackend(EmbeddingFunction):
+    """all-mpnet-base-v2 exported to ONNX Runtime, with the same mean pooling and normalization as sentence-transformers.
+
+    The exported model is kept in `cache_directory`, so it is only exported on the first start.
+    """
+
+
+    def __init__(self, batch_size=32, threads=None, cache_directory="embedding_onnx"):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            export_onnx(ORTModelForFeatureExtraction, cache_directory), provider="CPUExecutionProvider",
+            session_options=session_options)
+
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = []
+        texts = list(input)
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True, max_length=384, return_tensors="pt")
+            token_embeddings = self.model(**inputs).last_hidden_state
+
+            mask = inputs["attention_mask"].unsqueeze(-1).to(token_embeddings.dtype)
+            pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            embeddings.extend(torch.nn.functional.normalize(pooled, p=2, dim=1).tolist())
+
+        return embeddings
+
+
+def export_onnx(model_class, cache_directory):
+    # Path of the ONNX export of the model, exported once. The lock keeps concurrent worker processes
+    # from exporting it more than once, and the export is swapped in with a rename when complete
+    directory = os.path.join(os.path.abspath(cache_directory), MODEL_NAME.replace("/", "--"))
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    with open(directory + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(directory):
+            print(f"## Exporting {MODEL_NAME} to ONNX in {directory}")
+            staging = tempfile.mkdtemp(prefix=".export-", dir=os.path.dirname(directory))
+            try:
+                model_class.from_pretrained(MODEL_NAME, export=True).save_pretrained(staging)
+                os.replace(staging, directory)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    return directory
+
+
+def load_embedding_function(backend="auto", device=None, batch_size=32, threads=None, cache_directory="embedding_onnx"):
+    # Produces vectors compatible with the all-mpnet-base-v2 flicker8k index on any device
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}, expected one of {', '.join(BACKENDS)}")
+
+    device = select_device(device)
+    if threads:
+        torch.set_num_threads(threads)
+
+    if backend == "auto":
+        # Only the lossless backends are picked automatically. torch-int8 shifts the embeddings away from
+        # those of the index, so it has to be chosen explicitly, after checking its recall
+        backend = "sentence-transformers"
+        if device == "cpu":
+            try:
+                import onnxruntime  # noqa: F401
+                import optimum.onnxruntime  # noqa: F401
+                backend = "onnx"
+            except ImportError:
+                pass
+
+    if backend == "onnx":
+        return OnnxBackend(batch_size=batch_size, threads=threads, cache_directory=cache_directory)
+    if backend == "torch-int8":
+        return SentenceTransformerBackend(device="cpu", batch_size=batch_size, quantize=True)
+    return SentenceTransformerBackend(device=device, batch_size=batch_size)
@@ -1,17 +1,53 @@
+from io import BytesIO
+import string
+import threading
+
 import torch
-import PIL
+from PIL import Image
 
 from fastapi import HTTPException
-from unsloth import FastLanguageModel
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from .timing import stage
+
+
+def ends_sentence(text):
+    # Text made only of punctuation, with at least one sentence-ending mark, e.g. ".", "!" or '."'
+    text = text.strip()
+    return bool(text) and all(char in string.punctuation for char in text) and any(char in ".!?" for char in text)
+
+
+class StopOnTokens(StoppingCriteria):
+    """Marks each sequence in the batch as finished once it emits one of `stop_ids`."""
+
+
+    def __init__(self, stop_ids):
+        self.stop_ids = torch.tensor(sorted(stop_ids))
+
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.stop_ids.device != input_ids.device:
+            self.stop_ids = self.stop_ids.to(input_ids.device)
+        return torch.isin(input_ids[:, -1], self.stop_ids)
 
 
 class ICModel:
 
 
-    def __init__(self):
+    def __init__(self, max_new_tokens=100, stop_at="sentence", greedy=False):
         self.name = "unsloth/Llama-3.2-11B-Vision-Instruct"
 
+        self.max_new_tokens = max_new_tokens
+        # Greedy decoding makes captions deterministic, so they can be cached and benchmarked reproducibly
+        self.generation_kwargs = {"do_sample": False} if greedy else {"do_sample": True, "temperature": 0.8, "top_p": 0.9}
+
+        # Batched and streamed generation share the GPU, one generate call at a time
+        self.lock = threading.Lock()
+
         if torch.cuda.is_available():
+            # unsloth needs a GPU even to be imported, so the module stays importable on CPU-only hosts
+            from unsloth import FastLanguageModel
+
             # Load tokenizer and model
             self.model, self.tokenizer = FastLanguageModel.from_pretrained(
                 model_name=self.name,
@@ -20,6 +56,8 @@ class ICModel:
             )
 
             FastLanguageModel.for_inference(self.model)
+            # Batched generation needs the prompts aligned on the right
+            self.tokenizer.tokenizer.padding_side = "left"
             self.status = "Model loaded"
 
             self.messages = [
@@ -29,28 +67,134 @@ class ICModel:
                 ]}
             ]
 
+            # The prompt never changes, so the chat template is only rendered once
+            self.input_text = self.tokenizer.apply_chat_template(self.messages, add_generation_prompt=True)
+            self.stopping_criteria = StoppingCriteriaList([StopOnTokens(self._stop_ids(stop_at))])
+
         else:
             self.status = "Unable to load model: CUDA not available"
 
 
-    def caption(self, image_file):
+    @staticmethod
+    def load_image(image):
+        # Accepts a decoded PIL image, raw bytes, a binary buffer or a file path
+        if isinstance(image, Image.Image):
+            return image
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = BytesIO(image)
+        return Image.open(image)
+
+
+    @classmethod
+    def decode_image(cls, image):
+        # Decodes the whole image up front, so an invalid upload fails on its own instead of in its batch
+        with stage("decode"):
+            try:
+                image = cls.load_image(image)
+                image.load()
+                return image
+            except Exception as e:
+                raise HTTPException(status_code=422, detail=f"Unable to decode image: {e}")
+
+
+    def caption(self, image):
+        return self.caption_batch([image])[0]
+
+
+    def caption_batch(self, images):
+        if self.status != "Model loaded":
+            raise HTTPException(status_code=500, detail=self.status)
+
+        try:
+            inputs = self._prepare_inputs(images)
+            outputs = self._generate(**inputs)
+
+            # Only decode the generated tokens, the prompt is the same for every row
+            generated = outputs[:, inputs["input_ids"].shape[1]:]
+            with stage("detokenize"):
+                return [caption.strip() for caption in self.tokenizer.batch_decode(generated, skip_special_tokens=True)]
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+    def caption_stream(self, image):
+        # Returns an iterator over the caption text as it is generated
         if self.status != "Model loaded":
             raise HTTPException(status_code=500, detail=self.status)
 
         try:
-            image = PIL.Image.open(image_file)
+            inputs = self._prepare_inputs([image])
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        streamer = TextIteratorStreamer(self.tokenizer.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                self._generate(**inputs, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
 
-            input_text = self.tokenizer.apply_chat_template(self.messages, add_generation_prompt=True)
-            inputs = self.tokenizer(
-                image,
-                input_text,
+        def tokens():
+            for text in streamer:
+                if text:
+                    yield text
+            thread.join()
+            if errors:
+                raise errors[0]
+
+        return tokens()
+
+
+    def _prepare_inputs(self, images):
+        images = [[self.decode_image(image)] for image in images]
+
+        with stage("tokenize"):
+            return self.tokenizer(
+                images,
+                [self.input_text] * len(images),
                 add_special_tokens = False,
+                padding = True,
                 return_tensors = "pt",
             ).to("cuda")
 
-            with torch.no_grad():
-                outputs = self.model.generate(**inputs, max_new_tokens=100, do_sample=True, temperature=0.8, top_p=0.9)
-                return self.tokenizer.decode(outputs[0]).split('assistant<|end_header_id|>')[1].split('<|eot_id|>')[0].strip()
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    def _generate(self, **kwargs):
+        # Waiting for another generate call is timed on its own, so that "generate" is the GPU time only
+        with stage("model_lock_wait"):
+            self.lock.acquire()
+        try:
+            with torch.no_grad(), stage("generate"):
+                return self.model.generate(
+                    **kwargs,
+                    **self.generation_kwargs,
+                    max_new_tokens=self.max_new_tokens,
+                    stopping_criteria=self.stopping_criteria
+                )
+        finally:
+            self.lock.release()
+
+
+    def _stop_ids(self, stop_at):
+        tokenizer = self.tokenizer.tokenizer
+        stop_ids = {tokenizer.convert_tokens_to_ids("<|eot_id|>"), tokenizer.eos_token_id}
+
+        if stop_at == "sentence":
+            # Any token that ends a sentence, computed once over the vocabulary. Words carrying a period,
+            # e.g. "Dr." or "St.", would cut captions short
+            texts = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+            stop_ids.update(i for i, text in enumerate(texts) if ends_sentence(text))
+        elif stop_at != "eot":
+            raise ValueError(f"Unknown stopping rule: {stop_at}")
+
+        return {i for i in stop_ids if i is not None}
@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from huggingface_hub import hf_hub_download
+
+from .renditions import ensure_rendition
+from .timing import stage
+
+
+class ImageStore:
+    """Persistent local copy of the images of a Hub dataset, keyed by their path in the dataset.
+
+    Images are downloaded once, on first use or ahead of time with `prefetch`,
+    and then always served from the local directory.
+    """
+
+
+    def __init__(self, directory, repo_id, hf_token=None):
+        self.directory = os.path.abspath(directory)
+        self.repo_id = repo_id
+        self.hf_token = hf_token
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def path(self, image_id, size="original"):
+        path = os.path.normpath(os.path.join(self.directory, image_id))
+        if not path.startswith(self.directory + os.sep):
+            raise ValueError(f"Invalid image id: {image_id}")
+
+        if not os.path.exists(path):
+            with stage("hub_download"):
+                hf_hub_download(
+                    repo_id=self.repo_id,
+                    filename=image_id,
+                    repo_type="dataset",
+                    local_dir=self.directory,
+                    token=self.hf_token
+                )
+
+        return ensure_rendition(path, size)
+
+
+    def read(self, image_id, size="original"):
+        with open(self.path(image_id, size), mode='rb') as _file:
+            return _file.read()
+
+
+    def contains(self, image_id):
+        return os.path.exists(os.path.join(self.directory, image_id))
+
+
+    def prefetch(self, image_ids, workers=8, sizes=("original",)):
+        missing = [image_id for image_id in image_ids if not self.contains(image_id)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for size in sizes:
+                for _ in executor.map(lambda image_id: self.path(image_id, size), image_ids):
+                    pass
+        return len(missing)
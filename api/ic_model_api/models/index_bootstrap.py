@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from huggingface_hub import get_hf_file_metadata, hf_hub_download, hf_hub_url
+
+from .timing import stage
+
+
+MANIFEST_FILENAME = "manifest.json"
+INDEX_DIRNAME = "chromadb_index"
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as _file:
+        for block in iter(lambda: _file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # A manifest is only valid together with the index it describes
+    return manifest if os.path.isdir(os.path.join(directory, INDEX_DIRNAME)) else None
+
+
+def write_manifest(directory, manifest):
+    tmp_path = os.path.join(directory, MANIFEST_FILENAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_FILENAME))
+
+
+def unpack_index(archive, directory):
+    # Unpacks next to the current index and swaps it in with renames, so a crash never leaves a half-unpacked index
+    staging = tempfile.mkdtemp(prefix=".unpack-", dir=directory)
+    try:
+        shutil.unpack_archive(archive, staging, 'zip')
+        unpacked = os.path.join(staging, INDEX_DIRNAME)
+        if not os.path.isdir(unpacked):
+            unpacked = staging
+
+        target = os.path.join(directory, INDEX_DIRNAME)
+        previous = None
+        if os.path.exists(target):
+            previous = tempfile.mkdtemp(prefix=".previous-", dir=directory)
+            os.replace(target, os.path.join(previous, INDEX_DIRNAME))
+        try:
+            os.replace(unpacked, target)
+        except BaseException:
+            # Puts the previous index back, so a failed swap leaves the index as it was
+            if previous:
+                os.replace(os.path.join(previous, INDEX_DIRNAME), target)
+            raise
+        finally:
+            if previous:
+                shutil.rmtree(previous, ignore_errors=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return target
+
+
+def ensure_index(directory, repo_id, filename, hf_token=None, path=None, revision=None, sha256=None):
+    """Returns the path of an unpacked index that matches the requested version, unpacking it only when needed.
+
+    The index comes from `path` when given, either an unpacked index directory
+    used as is or a zip archive, and otherwise from `filename` in the Hub
+    dataset `repo_id` at `revision`. The version and checksum of the unpacked
+    archive are kept in a manifest, and nothing is downloaded or unpacked when
+    it already matches. If the Hub cannot be reached, the index already on
+    disk is used.
+    """
+    if path and os.path.isdir(path):
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+
+    if path:
+        stat = os.stat(path)
+        version = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if manifest and manifest["version"] == version and sha256 in (None, manifest["sha256"]):
+            return os.path.join(directory, INDEX_DIRNAME)
+        archive = path
+
+    else:
+        try:
+            metadata = get_hf_file_metadata(
+                hf_hub_url(repo_id=repo_id, filename=filename, repo_type="dataset", revision=revision), token=hf_token)
+        except Exception:
+            if manifest:
+                return os.path.join(directory, INDEX_DIRNAME)
+            raise
+
+        # The Hub etag of a file stored with LFS is its sha256
+        version = f"{repo_id}@{metadata.commit_hash}:{metadata.etag}"
+        if manifest and manifest["version"] == version and sha256 in (None, manifest["sha256"]):
+            return os.path.join(directory, INDEX_DIRNAME)
+        sha256 = sha256 or (metadata.etag if len(metadata.etag or "") == 64 else None)
+
+        with stage("hub_download"):
+            archive = hf_hub_download(
+                repo_id=repo_id,
+                filename=filename,
+                repo_type="dataset",
+                revision=metadata.commit_hash,
+                cache_dir=directory,
+                token=hf_token
+            )
+
+    checksum = sha256sum(archive)
+    if sha256 and checksum != sha256:
+        raise ValueError(f"Checksum mismatch for index archive {archive}: expected {sha256}, got {checksum}")
+
+    target = unpack_index(archive, directory)
+    write_manifest(directory, {"version": version, "sha256": checksum})
+    return target
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+
+
+class IndexJobQueue:
+    """Durable queue of images waiting to be captioned and indexed, stored in SQLite.
+
+    A worker thread takes pending images in order, `chunk_size` at a time, and
+    hands their file paths to `process`, which returns `(captions, errors)`
+    dicts keyed by file path. Progress is written back after every chunk, so
+    unfinished images are picked up again after a restart.
+    """
+
+
+    def __init__(self, database, process, chunk_size=32, poll_seconds=5):
+        self.database = database
+        self.process = process
+        self.chunk_size = chunk_size
+        self.poll_seconds = poll_seconds
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Set on close, ending any back-off of the worker
+        self.stopping = threading.Event()
+        self.closed = False
+
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    created REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS items (
+                    job_id TEXT NOT NULL REFERENCES jobs(id),
+                    position INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    name TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    caption TEXT,
+                    error TEXT,
+                    PRIMARY KEY (job_id, position)
+                );
+                CREATE INDEX IF NOT EXISTS items_status ON items(status);
+            """)
+
+        self.worker = threading.Thread(target=self._run, name="index-jobs", daemon=True)
+        self.worker.start()
+
+
+    def enqueue(self, filenames, names):
+        job_id = uuid.uuid4().hex
+        with self.lock, self._connect() as db:
+            db.execute("INSERT INTO jobs (id, created) VALUES (?, ?)", (job_id, time.time()))
+            db.executemany(
+                "INSERT INTO items (job_id, position, filename, name) VALUES (?, ?, ?, ?)",
+                [(job_id, position, filename, name) for position, (filename, name) in enumerate(zip(filenames, names))]
+            )
+        self.wakeup.set()
+        return job_id
+
+
+    def status(self, job_id):
+        with self._connect() as db:
+            if db.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone() is None:
+                raise HTTPException(status_code=404, detail=f"Unknown index job: {job_id}")
+            rows = db.execute(
+                "SELECT filename, name, status, caption, error FROM items WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+
+        counts = {state: sum(1 for row in rows if row[2] == state) for state in ("pending", "done", "failed")}
+        if not counts["pending"]:
+            state = "completed"
+        elif counts["done"] or counts["failed"]:
+            state = "running"
+        else:
+            state = "queued"
+
+        return {
+            "job_id": job_id,
+            "status": state,
+            "total": len(rows),
+            **counts,
+            "images": [
+                {"id": f"user/{filename}", "name": name, "status": status, "caption": caption, "error": error}
+                for filename, name, status, caption, error in rows
+            ],
+        }
+
+
+    def pending(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM items WHERE status = 'pending'").fetchone()[0]
+
+
+    def pending_files(self):
+        with self._connect() as db:
+            return [row[0] for row in db.execute("SELECT filename FROM items WHERE status = 'pending'")]
+
+
+    def close(self):
+        self.closed = True
+        self.stopping.set()
+        self.wakeup.set()
+        self.worker.join()
+
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.database, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+    def _next_chunk(self):
+        with self._connect() as db:
+            return db.execute(
+                """SELECT items.job_id, items.position, items.filename FROM items JOIN jobs ON jobs.id = items.job_id
+                   WHERE items.status = 'pending' ORDER BY jobs.created, items.position LIMIT ?""",
+                (self.chunk_size,)
+            ).fetchall()
+
+
+    def _run(self):
+        while not self.closed:
+            try:
+                self._run_chunk()
+            except Exception as e:
+                # e.g. a locked or unwritable database: the chunk stays pending and is tried again
+                print(f"## Unable to process the next index job chunk: {e}")
+                self.stopping.wait(self.poll_seconds)
+
+
+    def _run_chunk(self):
+        chunk = self._next_chunk()
+        if not chunk:
+            self.wakeup.wait(self.poll_seconds)
+            self.wakeup.clear()
+            return
+
+        filenames = [filename for _, _, filename in chunk if os.path.exists(filename)]
+        try:
+            captions, errors = self.process(filenames)
+        except HTTPException as e:
+            if e.status_code == 503:
+                # The caption queue is full, leave the images pending and try again later
+                self.stopping.wait(int((e.headers or {}).get("Retry-After", self.poll_seconds)))
+                return
+            captions, errors = {}, {filename: str(e.detail) for filename in filenames}
+        except Exception as e:
+            captions, errors = {}, {filename: str(e) for filename in filenames}
+
+        updates = []
+        for job_id, position, filename in chunk:
+            if filename in captions:
+                updates.append(("done", captions[filename], None, job_id, position))
+            else:
+                updates.append(("failed", None, errors.get(filename, "Image file is missing"), job_id, position))
+
+        with self.lock, self._connect() as db:
+            db.executemany("UPDATE items SET status = ?, caption = ?, error = ? WHERE job_id = ? AND position = ?", updates)
@@ -0,0 +1,136 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+# Words too common in captions to tell them apart
+STOPWORDS = frozenset("""
+a an and are as at be by for from has in is it its of on or that the their there this to was were with
+""".split())
+# Constant of reciprocal rank fusion, damping the weight of the top ranks
+RRF_K = 60
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """In-memory inverted index over captions, ranking them by Okapi BM25.
+
+    A query only touches the postings of its own terms, so exact names like
+    "Konark Sun Temple" are found in microseconds without embedding the query.
+    The frequencies and caption lengths of a posting list are gathered once and
+    kept as arrays until a caption with that term changes, and weighted by the
+    current average caption length on every query, so scores stay exact.
+    """
+
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        # term -> {document id: term frequency}
+        self.postings = defaultdict(dict)
+        # document id -> its terms, its length in terms, and its position in the score arrays
+        self.terms = {}
+        self.lengths = {}
+        self.slots = {}
+        self.doc_ids = []
+        self.free_slots = []
+        self.total_length = 0
+
+        # term -> (slots, frequencies, lengths) of its postings
+        self.postings_arrays = {}
+
+
+    def add(self, doc_id, text):
+        # Re-adding a document replaces it
+        with self.lock:
+            self._remove(doc_id)
+            terms = Counter(tokenize(text or ""))
+            for term, frequency in terms.items():
+                self.postings[term][doc_id] = frequency
+                self.postings_arrays.pop(term, None)
+
+            self.slots[doc_id] = self.free_slots.pop() if self.free_slots else len(self.doc_ids)
+            if self.slots[doc_id] == len(self.doc_ids):
+                self.doc_ids.append(doc_id)
+            self.doc_ids[self.slots[doc_id]] = doc_id
+
+            self.terms[doc_id] = list(terms)
+            self.lengths[doc_id] = sum(terms.values())
+            self.total_length += self.lengths[doc_id]
+
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove(doc_id)
+
+
+    def _remove(self, doc_id):
+        if doc_id not in self.lengths:
+            return
+        self.total_length -= self.lengths.pop(doc_id)
+        for term in self.terms.pop(doc_id):
+            del self.postings[term][doc_id]
+            self.postings_arrays.pop(term, None)
+            if not self.postings[term]:
+                del self.postings[term]
+
+        slot = self.slots.pop(doc_id)
+        self.doc_ids[slot] = None
+        self.free_slots.append(slot)
+
+
+    def search(self, query, num):
+        # The `num` best (document id, score) pairs, best first
+        with self.lock:
+            count = len(self.lengths)
+            if not count or num <= 0:
+                return []
+
+            average_length = self.total_length / count
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            for term in set(tokenize(query)):
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                slots, frequencies, lengths = self._postings_arrays(term, docs)
+                norms = self.k1 * (1 - self.b + self.b * lengths / average_length)
+                scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + norms)
+
+            matched = np.flatnonzero(scores)
+            if len(matched) > num:
+                # Everything tied with the num-th best is kept, and ties are then broken by id, so that the
+                # results are always a prefix of those of the same query with a larger `num`
+                kth = np.partition(scores[matched], len(matched) - num)[len(matched) - num]
+                matched = matched[scores[matched] >= kth]
+            ranked = sorted(matched, key=lambda slot: (-scores[slot], self.doc_ids[slot]))[:num]
+            return [(self.doc_ids[slot], float(scores[slot])) for slot in ranked]
+
+
+    def _postings_arrays(self, term, docs):
+        if term not in self.postings_arrays:
+            slots = np.fromiter((self.slots[doc_id] for doc_id in docs), dtype=np.int64, count=len(docs))
+            frequencies = np.fromiter(docs.values(), dtype=np.float32, count=len(docs))
+            lengths = np.fromiter((self.lengths[doc_id] for doc_id in docs), dtype=np.float32, count=len(docs))
+            self.postings_arrays[term] = (slots, frequencies, lengths)
+        return self.postings_arrays[term]
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # Merges ranked id lists by the sum of 1 / (k + rank) of every id, best first
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] += 1 / (k + rank)
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
@@ -0,0 +1,32 @@
+import base64
+import binascii
+import hashlib
+import json
+
+
+def query_key(*parts):
+    # Ties a cursor to the query it was issued for
+    return hashlib.sha256("\0".join(map(str, parts)).encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(key, offsets, depth=None):
+    # Opaque to clients: the offset reached in each collection, and the depth of a fused ranking
+    state = json.dumps({"k": key, "o": offsets, "d": depth}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(state.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, key, collections):
+    # A collection whose results are exhausted has a null offset. No cursor is issued once all of them are
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offsets, depth = state["o"], state["d"]
+        valid = state["k"] == key and isinstance(offsets, list) and len(offsets) == collections and \
+            all(offset is None or (isinstance(offset, int) and offset >= 0) for offset in offsets) and \
+            any(offset is not None for offset in offsets) and \
+            (depth is None or (isinstance(depth, int) and depth > 0))
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        valid = False
+
+    if not valid:
+        raise ValueError("Invalid cursor, or a cursor of another query")
+    return offsets, depth
@@ -0,0 +1,154 @@
+import numpy as np
+
+
+STORAGES = ("float32", "float16", "int8", "pq")
+# Dimensions per product quantization subvector, e.g. 96 one-byte codes for a 768-dim vector
+PQ_SUBVECTOR_DIM = 8
+PQ_CENTROIDS = 256
+PQ_TRAINING_SAMPLE = 20000
+PQ_ITERATIONS = 20
+# Vectors whose scores are computed at once, bounding the float32 copy of their codes
+SCORE_CHUNK_SIZE = 4096
+
+
+class Float16Quantizer:
+    """Half precision vectors: half the memory, with nearly no loss in ranking."""
+
+    storage = "float16"
+
+
+    @classmethod
+    def train(cls, vectors):
+        return cls()
+
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16)
+
+
+    def scores(self, queries, codes):
+        return chunked_scores(queries, codes, lambda chunk: chunk.astype(np.float32))
+
+
+    def params(self):
+        return {}
+
+
+class ScalarQuantizer:
+    """Maps every dimension linearly from its range in the corpus onto one byte."""
+
+    storage = "int8"
+
+
+    def __init__(self, offset, scale):
+        self.offset = offset
+        self.scale = scale
+
+
+    @classmethod
+    def train(cls, vectors):
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        return cls(low, np.maximum(high - low, 1e-12) / 255)
+
+
+    def encode(self, vectors):
+        return np.clip(np.rint((vectors - self.offset) / self.scale), 0, 255).astype(np.uint8)
+
+
+    def scores(self, queries, codes):
+        # q·(offset + scale * code) without dequantizing the vectors themselves
+        return queries @ self.offset[:, None] + chunked_scores(
+            queries * self.scale, codes, lambda chunk: chunk.astype(np.float32))
+
+
+    def params(self):
+        return {"offset": self.offset, "scale": self.scale}
+
+
+class ProductQuantizer:
+    """Splits vectors into subvectors, each encoded as the index of its nearest k-means centroid.
+
+    Inner products with a query are looked up in a per-query table of the query
+    subvectors' products with every centroid, so the corpus is never decoded.
+    """
+
+    storage = "pq"
+
+
+    def __init__(self, centroids):
+        # (subspaces, centroids, subvector dim)
+        self.centroids = centroids
+
+
+    @classmethod
+    def train(cls, vectors, subvector_dim=PQ_SUBVECTOR_DIM, seed=0):
+        if vectors.shape[1] % subvector_dim:
+            raise ValueError(f"Vector dimension {vectors.shape[1]} is not a multiple of {subvector_dim}")
+
+        rng = np.random.default_rng(seed)
+        if len(vectors) > PQ_TRAINING_SAMPLE:
+            vectors = vectors[rng.choice(len(vectors), PQ_TRAINING_SAMPLE, replace=False)]
+
+        subspaces = vectors.shape[1] // subvector_dim
+        centroids = np.stack([
+            kmeans(vectors[:, s * subvector_dim:(s + 1) * subvector_dim], min(PQ_CENTROIDS, len(vectors)), rng)
+            for s in range(subspaces)
+        ])
+        return cls(centroids)
+
+
+    def encode(self, vectors):
+        subspaces, _, subvector_dim = self.centroids.shape
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+        for s in range(subspaces):
+            codes[:, s] = nearest(vectors[:, s * subvector_dim:(s + 1) * subvector_dim], self.centroids[s])
+        return codes
+
+
+    def scores(self, queries, codes):
+        subspaces, _, subvector_dim = self.centroids.shape
+        # (queries, subspaces, centroids) inner products of every query subvector with every centroid
+        tables = np.einsum("qsd,scd->qsc", queries.reshape(len(queries), subspaces, subvector_dim), self.centroids)
+
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for s in range(subspaces):
+            scores += tables[:, s, codes[:, s]]
+        return scores
+
+
+    def params(self):
+        return {"centroids": self.centroids}
+
+
+QUANTIZERS = {quantizer.storage: quantizer for quantizer in (Float16Quantizer, ScalarQuantizer, ProductQuantizer)}
+
+
+def load_quantizer(storage, params):
+    return QUANTIZERS[storage](**params)
+
+
+def chunked_scores(queries, codes, decode):
+    return np.concatenate([
+        queries @ decode(codes[start:start + SCORE_CHUNK_SIZE]).T
+        for start in range(0, len(codes), SCORE_CHUNK_SIZE)
+    ], axis=1)
+
+
+def nearest(vectors, centroids):
+    distances = (centroids * centroids).sum(axis=1)[None, :] - 2 * vectors @ centroids.T
+    return distances.argmin(axis=1)
+
+
+def kmeans(vectors, k, rng, iterations=PQ_ITERATIONS):
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # Empty clusters are re-seeded with random vectors
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    return centroids
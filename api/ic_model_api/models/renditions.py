@@ -0,0 +1,69 @@
+import mimetypes
+import os
+import tempfile
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+# Longest side in pixels of every stored rendition, next to the original upload
+RENDITIONS = {"thumbnail": 160, "preview": 640}
+SIZES = ("original", *RENDITIONS)
+
+RENDITION_FORMAT = "WEBP"
+RENDITION_QUALITY = 80
+
+mimetypes.add_type("image/webp", ".webp")
+
+
+def image_extension(data):
+    # File extension matching the actual format of the image bytes, e.g. ".png"
+    with Image.open(BytesIO(data)) as image:
+        extension = mimetypes.guess_extension(Image.MIME.get(image.format, ""))
+    return ".jpg" if extension in (None, ".jpe", ".jpeg") else extension
+
+
+def rendition_path(path, size):
+    if size == "original":
+        return path
+    if size not in RENDITIONS:
+        raise ValueError(f"Unknown image size: {size}, expected one of {', '.join(SIZES)}")
+    return f"{os.path.splitext(path)[0]}.{size}.webp"
+
+
+def is_rendition(path):
+    return path.endswith(tuple(f".{size}.webp" for size in RENDITIONS))
+
+
+def make_renditions(path, image=None):
+    # Writes every rendition of the image stored at `path`, decoding it only once
+    if image is None:
+        with Image.open(path) as original:
+            return make_renditions(path, original)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    for size, max_side in RENDITIONS.items():
+        rendition = image.copy()
+        rendition.thumbnail((max_side, max_side))
+
+        # A temporary file of its own, so concurrent writers of the same rendition never publish a torn file
+        target = rendition_path(path, size)
+        fd, tmp_path = tempfile.mkstemp(prefix=".rendition-", suffix=".tmp", dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                rendition.save(tmp_file, format=RENDITION_FORMAT, quality=RENDITION_QUALITY)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def ensure_rendition(path, size):
+    # Path of the requested rendition, created on first use for images stored before renditions existed
+    target = rendition_path(path, size)
+    if not os.path.exists(target):
+        make_renditions(path)
+    return target
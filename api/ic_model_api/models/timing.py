@@ -0,0 +1,41 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Histogram
+
+
+# From half a millisecond for keyword queries up to a minute for a large generate call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "ic_model_api_stage_seconds", "Duration of every instrumented stage", ["stage"], buckets=LATENCY_BUCKETS)
+
+_timings = ContextVar("timings", default=None)
+# Labelled histograms by stage, looked up without the lock of `labels`
+_stage_histograms = {}
+
+
+def start_timings():
+    # Starts collecting stage durations for the current request, returned as {stage: seconds}
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+@contextmanager
+def stage(name):
+    # Every stage is also recorded in a histogram, whether or not it runs as part of a request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        histogram = _stage_histograms.get(name)
+        if histogram is None:
+            histogram = _stage_histograms.setdefault(name, STAGE_SECONDS.labels(name))
+        histogram.observe(seconds)
+
+        timings = _timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
@@ -0,0 +1,323 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from config import settings
+
+from .quantization import STORAGES, QUANTIZERS, load_quantizer
+
+
+VECTOR_STORE_BACKENDS = ("chroma", "mmap")
+META_FILENAME = "meta.json"
+IDS_FILENAME = "ids.json"
+VECTORS_FILENAME = "vectors.f32"
+NORMS_FILENAME = "norms.f32"
+CODES_FILENAME = "codes.npy"
+QUANTIZER_FILENAME = "quantizer.npz"
+EXPORT_BATCH_SIZE = 1024
+# Embeddings hashed into a collection's fingerprint along with its ids, to notice a re-embedded index
+FINGERPRINT_SAMPLE_SIZE = 16
+# How long the size of a chromadb collection is cached, to see writes made by other processes
+COUNT_TTL_SECONDS = 5
+# How often the collection of an mmap export is checked for changes, e.g. by a backfill of its embeddings
+REFRESH_SECONDS = 60
+# Candidates re-ranked on their float32 vectors per requested hit, when scanning quantized codes
+RESCORE = settings.VECTOR_STORE_RESCORE
+
+
+class ChromaVectorStore:
+    """Nearest-neighbour queries on a chromadb collection, through its HNSW index."""
+
+
+    def __init__(self, collection, count_ttl=COUNT_TTL_SECONDS):
+        self.collection = collection
+        self.space = (collection.metadata or {}).get("hnsw:space", "l2")
+        self.count_ttl = count_ttl
+        self._count = None
+        self._counted = 0.0
+
+
+    def count(self):
+        # Every query needs the size of the collection, so it is cached rather than read on each one
+        now = time.monotonic()
+        if self._count is None or now - self._counted > self.count_ttl:
+            self._count, self._counted = self.collection.count(), now
+        return self._count
+
+
+    def changed(self):
+        # Called after writing to the collection
+        self._count = None
+
+
+    def query(self, embeddings, num):
+        # Empty collections, e.g. image embeddings before their backfill, have no HNSW index to query
+        num = min(num, self.count())
+        if not num:
+            return [[] for _ in embeddings], [[] for _ in embeddings]
+
+        hits = self.collection.query(query_embeddings=embeddings, n_results=num, include=["distances"])
+        return hits['ids'], hits['distances']
+
+
+class MmapVectorStore:
+    """Nearest-neighbour queries over a read-only float32 matrix mapped from disk.
+
+    The vectors are written by `export_collection`. Since they are mapped rather
+    than read into memory, loading is instant and every worker process on the
+    host shares one copy through the page cache. Distances match chromadb's for
+    the collection's space, so results from both stores are interchangeable.
+
+    With float32 storage every vector is scanned. Otherwise, only the compact
+    float16, int8 or product-quantized codes are scanned, and the `rescore`
+    times `num` best candidates are re-ranked on their float32 vectors, so only
+    those rows are ever read from the full matrix.
+    """
+
+
+    def __init__(self, directory, rescore=RESCORE):
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, IDS_FILENAME)) as f:
+            self.ids = json.load(f)
+
+        self.space = self.meta["space"]
+        self.storage = self.meta.get("storage", "float32")
+        self.rescore = rescore
+        count, dim = len(self.ids), self.meta["dim"]
+        if count:
+            self.vectors = np.memmap(os.path.join(directory, VECTORS_FILENAME), dtype=np.float32, mode="r", shape=(count, dim))
+            self.norms = np.memmap(os.path.join(directory, NORMS_FILENAME), dtype=np.float32, mode="r", shape=(count,))
+            if self.storage != "float32":
+                self.codes = np.load(os.path.join(directory, CODES_FILENAME), mmap_mode="r")
+                with np.load(os.path.join(directory, QUANTIZER_FILENAME)) as params:
+                    self.quantizer = load_quantizer(self.storage, dict(params))
+
+
+    def count(self):
+        return len(self.ids)
+
+
+    def changed(self):
+        # The export is read-only, and only changes when the collection is exported again
+        pass
+
+
+    def query(self, embeddings, num):
+        num = min(num, self.count())
+        if not num:
+            return [[] for _ in embeddings], [[] for _ in embeddings]
+
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if self.storage == "float32":
+            distances = self.distances(queries, queries @ self.vectors.T, self.norms)
+            nearest = top(distances, num)
+            return self._hits(nearest, np.take_along_axis(distances, nearest, axis=1))
+
+        distances = self.distances(queries, self.quantizer.scores(queries, self.codes), self.norms)
+        if not self.rescore:
+            nearest = top(distances, num)
+            return self._hits(nearest, np.take_along_axis(distances, nearest, axis=1))
+
+        candidates = top(distances, min(num * self.rescore, self.count()))
+        nearest, exact = [], []
+        for query, rows in zip(queries, candidates):
+            # Sorted rows read the full matrix front to back
+            rows = np.sort(rows)
+            rescored = self.distances(query[None, :], query[None, :] @ self.vectors[rows].T, self.norms[rows])[0]
+            order = rescored.argsort()[:num]
+            nearest.append(rows[order])
+            exact.append(rescored[order])
+        return self._hits(nearest, exact)
+
+
+    def _hits(self, nearest, distances):
+        return [[self.ids[j] for j in row] for row in nearest], [list(map(float, row)) for row in distances]
+
+
+    def distances(self, queries, scores, norms):
+        # Same distances as chromadb, from the inner products of the queries with the vectors:
+        # squared L2, cosine distance, or 1 - inner product
+        if self.space == "cosine":
+            query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            return 1 - scores / np.maximum(query_norms * norms[None, :], 1e-12)
+        if self.space == "ip":
+            return 1 - scores
+        return (queries * queries).sum(axis=1, keepdims=True) - 2 * scores + norms[None, :]
+
+
+class RefreshingVectorStore:
+    """Serves a collection from its memory-mapped export, exported again when the collection changes.
+
+    The fingerprint of the collection is compared with the export's at most
+    every `refresh_seconds`, including writes by other processes such as
+    index_image_embeddings.py, and a new export is made in the background
+    while queries keep using the current one.
+    """
+
+
+    def __init__(self, collection, directory, storage="float32", rescore=RESCORE, refresh_seconds=REFRESH_SECONDS):
+        self.collection = collection
+        self.directory = directory
+        self.storage = storage
+        self.rescore = rescore
+        self.refresh_seconds = refresh_seconds
+
+        self.store = ensure_mmap_store(collection, directory, storage, rescore)
+        self.space = self.store.space
+        self.refreshing = threading.Lock()
+        self.checked = time.monotonic()
+
+
+    def count(self):
+        return self.store.count()
+
+
+    def changed(self):
+        # Writes are picked up by the next check, rather than exporting the collection after every one
+        pass
+
+
+    def query(self, embeddings, num):
+        if time.monotonic() - self.checked > self.refresh_seconds and self.refreshing.acquire(blocking=False):
+            self.checked = time.monotonic()
+            threading.Thread(target=self._refresh, name="vector-store-refresh", daemon=True).start()
+        return self.store.query(embeddings, num)
+
+
+    def _refresh(self):
+        try:
+            # Same check as ensure_mmap_store, so re-embedded vectors are noticed as well as added ones
+            if collection_fingerprint(self.collection) != self.store.meta.get("fingerprint"):
+                self.store = ensure_mmap_store(self.collection, self.directory, self.storage, self.rescore)
+        except Exception as e:
+            print(f"## Unable to refresh the {self.collection.name} vectors in {self.directory}: {e}")
+        finally:
+            self.refreshing.release()
+
+
+def top(distances, num):
+    # Partial sort: only the `num` nearest vectors of each query are ordered
+    nearest = np.argpartition(distances, num - 1, axis=1)[:, :num]
+    return np.take_along_axis(nearest, np.take_along_axis(distances, nearest, axis=1).argsort(axis=1), axis=1)
+
+
+def similarity(distance, space):
+    # Cosine similarity from a distance, assuming normalized embeddings as produced by all our encoders
+    if space == "l2":
+        return 1 - distance / 2
+    return 1 - distance
+
+
+def collection_fingerprint(collection):
+    ids = sorted(collection.get(include=[])['ids'])
+    digest = hashlib.sha256()
+    digest.update("\n".join(ids).encode("utf-8"))
+
+    if ids:
+        sample = collection.get(ids=ids[:FINGERPRINT_SAMPLE_SIZE], include=["embeddings"])
+        sample = dict(zip(sample['ids'], sample['embeddings']))
+        for image_id in ids[:FINGERPRINT_SAMPLE_SIZE]:
+            digest.update(np.asarray(sample[image_id], dtype=np.float32).tobytes())
+
+    return digest.hexdigest()
+
+
+def export_collection(collection, directory, fingerprint=None, storage="float32"):
+    # Writes next to the current export and swaps it in with renames, so readers never see a partial one
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown vector storage: {storage}, expected one of {', '.join(STORAGES)}")
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".export-", dir=parent)
+    try:
+        ids = collection.get(include=[])['ids']
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+
+        vectors, norms, dim = None, None, 0
+        for start in range(0, len(ids), EXPORT_BATCH_SIZE):
+            batch = collection.get(ids=ids[start:start + EXPORT_BATCH_SIZE], include=["embeddings"])
+            embeddings = dict(zip(batch['ids'], batch['embeddings']))
+            matrix = np.asarray([embeddings[i] for i in ids[start:start + EXPORT_BATCH_SIZE]], dtype=np.float32)
+
+            if vectors is None:
+                dim = matrix.shape[1]
+                vectors = np.memmap(os.path.join(staging, VECTORS_FILENAME), dtype=np.float32, mode="w+", shape=(len(ids), dim))
+                norms = np.memmap(os.path.join(staging, NORMS_FILENAME), dtype=np.float32, mode="w+", shape=(len(ids),))
+
+            vectors[start:start + len(matrix)] = matrix
+            # Squared norms for L2, plain norms for cosine
+            squared = (matrix * matrix).sum(axis=1)
+            norms[start:start + len(matrix)] = np.sqrt(squared) if space == "cosine" else squared
+
+        if vectors is not None:
+            vectors.flush()
+            norms.flush()
+            if storage != "float32":
+                quantizer = QUANTIZERS[storage].train(np.asarray(vectors))
+                np.save(os.path.join(staging, CODES_FILENAME), quantizer.encode(np.asarray(vectors)))
+                np.savez(os.path.join(staging, QUANTIZER_FILENAME), **quantizer.params())
+            del vectors, norms
+
+        with open(os.path.join(staging, IDS_FILENAME), "w") as f:
+            json.dump(ids, f)
+        with open(os.path.join(staging, META_FILENAME), "w") as f:
+            json.dump({
+                "space": space,
+                "dim": dim,
+                "storage": storage,
+                "fingerprint": fingerprint or collection_fingerprint(collection)
+            }, f)
+
+        previous = None
+        if os.path.exists(directory):
+            previous = tempfile.mkdtemp(prefix=".previous-", dir=parent)
+            os.replace(directory, os.path.join(previous, os.path.basename(directory)))
+        os.replace(staging, directory)
+
+        if previous:
+            shutil.rmtree(previous, ignore_errors=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return directory
+
+
+def read_meta(directory):
+    try:
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def ensure_mmap_store(collection, directory, storage="float32", rescore=RESCORE):
+    # Exports the collection only when it or the storage changed since the last export. The lock keeps
+    # concurrent worker processes from exporting it more than once
+    os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+    with open(os.path.abspath(directory) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        fingerprint = collection_fingerprint(collection)
+        meta = read_meta(directory)
+        if meta.get("fingerprint") != fingerprint or meta.get("storage", "float32") != storage:
+            print(f"## Exporting the {collection.name} vectors to {directory} as {storage}")
+            export_collection(collection, directory, fingerprint, storage)
+
+    return MmapVectorStore(directory, rescore)
+
+
+def load_vector_store(collection, backend="chroma", directory=None, storage="float32", rescore=RESCORE):
+    if backend not in VECTOR_STORE_BACKENDS:
+        raise ValueError(f"Unknown vector store backend: {backend}, expected one of {', '.join(VECTOR_STORE_BACKENDS)}")
+
+    if backend == "mmap":
+        return RefreshingVectorStore(collection, directory, storage, rescore)
+    return ChromaVectorStore(collection)
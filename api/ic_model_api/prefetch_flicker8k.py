@@ -0,0 +1,25 @@
+import argparse
+import os
+
+from models import SIZES, ImageDatabaseIndex
+
+
+def prefetch_flicker8k(image_db_index, workers=8, renditions=False):
+    # Downloads every image of the flicker8k index missing from the local image store, returning their number
+    ids = image_db_index.flicker8k_ids()
+    print(f"## Prefetching {len(ids)} Flickr8k images into {image_db_index.image_store.directory}")
+    sizes = SIZES if renditions else ("original",)
+    return image_db_index.image_store.prefetch(ids, workers=workers, sizes=sizes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download every Flickr8k image in the index into the local image store")
+    parser.add_argument("--workers", type=int, default=8, help="number of parallel downloads")
+    parser.add_argument("--renditions", action="store_true", help="also generate the thumbnail and preview renditions")
+    args = parser.parse_args()
+
+    image_db_index = ImageDatabaseIndex(os.environ['HF_TOKEN'])
+    print(image_db_index.status)
+
+    downloaded = prefetch_flicker8k(image_db_index, workers=args.workers, renditions=args.renditions)
+    print(f"## Downloaded {downloaded} missing images")
@@ -1,10 +1,17 @@
-import tempfile
-from typing import Annotated
+import mimetypes
+import os
+import re
+from typing import Annotated, List, Optional
 
-from fastapi import APIRouter, Request, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Form
+from fastapi.responses import FileResponse, Response
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel, Field
 
 from config import settings
+from captioning import generate_caption
+from models import dhash_bytes, stage
+from models.db_index import SEARCH_MODES
 
 
 search_router = APIRouter()
@@ -12,17 +19,48 @@ templates = Jinja2Templates(directory=settings.TEMPLATES_DIRECTORY)
 
 
 def caption_image(image: UploadFile):
-    caption = ''
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(image.file.read())
-        image.file.close()
-        caption = settings.SHARED["IC_MODEL"].caption(tmp.name)
-    return caption
+    data = image.file.read()
+    image.file.close()
+
+    # An image matching an indexed one reuses its caption instead of running the model
+    try:
+        with stage("dedup"):
+            duplicate = settings.SHARED["IMAGE_DB_INDEX"].find_duplicate(dhash_bytes(data))
+            caption = settings.SHARED["IMAGE_DB_INDEX"].caption_of(duplicate) if duplicate else None
+    except Exception:
+        caption = None
+
+    return caption or generate_caption(data)
 
 
 @search_router.post("/search")
-def search(request: Request, text: Annotated[str, Form()], num: Annotated[int, Form()] = 3):
-    return settings.SHARED["IMAGE_DB_INDEX"].search(text, num)
+def search(request: Request, text: Annotated[str, Form()], num: Annotated[int, Form()] = 3,
+           refs: Annotated[bool, Form()] = False, size: Annotated[str, Form()] = "original",
+           mode: Annotated[str, Form()] = settings.SEARCH_MODE, min_similarity: Annotated[Optional[float], Form()] = None,
+           paginate: Annotated[bool, Form()] = False, cursor: Annotated[Optional[str], Form()] = None):
+    # With paginate or a cursor, returns one page of hits with their ids and distances, and the next cursor
+    if paginate or cursor:
+        return settings.SHARED["IMAGE_DB_INDEX"].search_page(text, num, refs, size, mode, cursor, min_similarity)
+    return settings.SHARED["IMAGE_DB_INDEX"].search(text, num, refs, size, mode, min_similarity)
+
+
+class SearchQuery(BaseModel):
+    text: str
+    num: int = 3
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchQuery] = Field(max_length=256)
+    refs: bool = False
+    size: str = "original"
+    mode: str = settings.SEARCH_MODE
+    min_similarity: Optional[float] = None
+
+
+@search_router.post("/search/batch")
+def search_batch(request: Request, body: BatchSearchRequest):
+    queries = [(query.text, query.num) for query in body.queries]
+    return settings.SHARED["IMAGE_DB_INDEX"].search_batch(queries, body.refs, body.size, body.mode, body.min_similarity)
 
 
 @search_router.get("/search_page")
@@ -32,15 +70,34 @@ def search_home(request: Request):
 
 @search_router.post("/search_page")
 def search_page(request: Request, text: Annotated[str, Form()], num: Annotated[int, Form()] = 3):
-    imgs_list = settings.SHARED["IMAGE_DB_INDEX"].search(text, num)
+    imgs_list = settings.SHARED["IMAGE_DB_INDEX"].search(text, num, mode=settings.SEARCH_MODE)
     return templates.TemplateResponse(
         "search_form.html", {"request": request,  "imgs_list": imgs_list})
 
 
 @search_router.post("/search_similar")
-def search_similar(request: Request, image: UploadFile = File(), num: Annotated[int, Form()] = 3):
+def search_similar(request: Request, image: UploadFile = File(), num: Annotated[int, Form()] = 3,
+                   refs: Annotated[bool, Form()] = False, size: Annotated[str, Form()] = "original",
+                   mode: Annotated[str, Form()] = "caption", min_similarity: Annotated[Optional[float], Form()] = None,
+                   paginate: Annotated[bool, Form()] = False, cursor: Annotated[Optional[str], Form()] = None):
+    # "caption" searches by the caption of the image, "image" by its CLIP embedding without captioning it.
+    # Pages are requested again with the same image and the cursor
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=422, detail=f"Unknown search mode: {mode}, expected one of {', '.join(SEARCH_MODES)}")
+    image_db_index = settings.SHARED["IMAGE_DB_INDEX"]
+    paginate = paginate or bool(cursor)
+
+    if mode == "image":
+        data = image.file.read()
+        image.file.close()
+        if paginate:
+            return image_db_index.search_by_image_page(data, num, refs, size, cursor, min_similarity)
+        return image_db_index.search_by_image(data, num, refs, size, min_similarity)
+
     caption = caption_image(image)
-    return settings.SHARED["IMAGE_DB_INDEX"].search(caption, num)
+    if paginate:
+        return image_db_index.search_page(caption, num, refs, size, cursor=cursor, min_similarity=min_similarity)
+    return image_db_index.search(caption, num, refs, size, min_similarity=min_similarity)
 
 
 @search_router.get("/search_similar_page")
@@ -54,3 +111,46 @@ def search_similar_page(request: Request, image: UploadFile = File(), num: Annot
     imgs_list = settings.SHARED["IMAGE_DB_INDEX"].search(caption, num)
     return templates.TemplateResponse(
         "search_similar_form.html", {"request": request,  "imgs_list": imgs_list, "caption": caption})
+
+
+@search_router.get("/images/{image_id:path}")
+def image(request: Request, image_id: str, size: str = "original"):
+    path = settings.SHARED["IMAGE_DB_INDEX"].image_path(image_id, size)
+    return file_response(request, path)
+
+
+def file_response(request: Request, path: str):
+    stat = os.stat(path)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=86400",
+    }
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header is None:
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    # A single byte range, e.g. "bytes=0-1023", "bytes=1024-" or "bytes=-1024"
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}"})
+
+    start, end = match.groups()
+    if start:
+        start, end = int(start), min(int(end) if end else stat.st_size - 1, stat.st_size - 1)
+    else:
+        start, end = max(stat.st_size - int(end), 0), stat.st_size - 1
+    if start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}"})
+
+    with open(path, mode='rb') as _file:
+        _file.seek(start)
+        data = _file.read(end - start + 1)
+
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    return Response(content=data, status_code=206, media_type=media_type, headers=headers)
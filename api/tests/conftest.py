@@ -0,0 +1,74 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The API modules import each other from their own folder, as when uvicorn runs there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ic_model_api"))
+
+
+class HashingEmbedder:
+    """Normalized hashed bag of words: identical captions get identical embeddings, shared words similar ones."""
+
+
+    def __init__(self, dim=64):
+        self.dim = dim
+
+
+    def __call__(self, input):
+        from models.lexical import tokenize
+
+        embeddings = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for token in tokenize(text):
+                embeddings[row, int(hashlib.md5(token.encode("utf-8")).hexdigest(), 16) % self.dim] += 1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return list(embeddings / np.maximum(norms, 1e-12))
+
+
+    @staticmethod
+    def name():
+        return "hashing"
+
+
+    def is_legacy(self):
+        return False
+
+
+    def default_space(self):
+        return "l2"
+
+
+    def supported_spaces(self):
+        return ["l2", "cosine", "ip"]
+
+
+@pytest.fixture
+def make_index(tmp_path, monkeypatch):
+    # Builds an ImageDatabaseIndex over a local flicker8k collection of the given {id: caption},
+    # with the image store and user index in the temporary directory
+    import chromadb
+    from chromadb.config import Settings
+
+    from models import ImageDatabaseIndex
+
+    monkeypatch.chdir(tmp_path)
+
+    def make_index(captions, **options):
+        client = chromadb.PersistentClient(
+            path=str(tmp_path / "flicker8k_index"), settings=Settings(anonymized_telemetry=False))
+        collection = client.get_or_create_collection(name="flicker8k", embedding_function=HashingEmbedder())
+        if captions:
+            collection.upsert(ids=list(captions), documents=list(captions.values()))
+
+        image_db_index = ImageDatabaseIndex(
+            None, str(tmp_path / "user_images_index"), persist_directory=str(tmp_path / "flicker8k_index"),
+            embedding_function=HashingEmbedder(), **options)
+        assert image_db_index.status == "Successfully loaded image database index", image_db_index.status
+        return image_db_index
+
+    yield make_index
+    # Clients are cached by path, and the next test may reuse the same temporary path
+    chromadb.api.client.SharedSystemClient.clear_system_cache()
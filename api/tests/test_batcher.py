@@ -0,0 +1,219 @@
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from models.batcher import BULK, INTERACTIVE, CaptionBatcher
+
+
+class StubModel:
+    """Captions images by their value, recording every batch it is called with."""
+
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+
+    def caption_stream(self, image):
+        self.batches.append(("stream", image))
+        if image == "failing":
+            raise RuntimeError("stream failed")
+        return iter(["caption ", "of ", image])
+
+
+    def caption_batch(self, images):
+        self.batches.append(list(images))
+        self.started.set()
+        self.release.wait()
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("model failed")
+        return [f"caption of {image}" for image in images]
+
+
+def decode(image):
+    if image == "corrupt":
+        raise HTTPException(status_code=422, detail="Unable to decode image")
+    return image
+
+
+@pytest.fixture
+def make_batcher():
+    batchers = []
+
+    def make(model, **kwargs):
+        batchers.append(CaptionBatcher(model.caption_batch, caption_stream=model.caption_stream, **kwargs))
+        return batchers[-1]
+
+    yield make
+    for batcher in batchers:
+        batcher.close()
+
+
+def test_concurrent_requests_are_captioned_in_one_batch(make_batcher):
+    model = StubModel()
+    batcher = make_batcher(model, max_batch_size=8, max_wait_ms=200)
+
+    futures = [batcher.submit(i) for i in range(5)]
+
+    assert [future.result(timeout=5) for future in futures] == [f"caption of {i}" for i in range(5)]
+    assert model.batches == [[0, 1, 2, 3, 4]]
+
+
+def test_batches_are_bounded_by_max_batch_size(make_batcher):
+    model = StubModel()
+    batcher = make_batcher(model, max_batch_size=3, max_wait_ms=200)
+
+    futures = batcher.submit_many(list(range(7)))
+
+    assert [future.result(timeout=5) for future in futures] == [f"caption of {i}" for i in range(7)]
+    assert [len(batch) for batch in model.batches] == [3, 3, 1]
+
+
+def test_a_lone_request_waits_at_most_max_wait(make_batcher):
+    model = StubModel()
+    batcher = make_batcher(model, max_batch_size=8, max_wait_ms=50)
+
+    start = time.monotonic()
+    assert batcher.caption("image") == "caption of image"
+    assert time.monotonic() - start < 1
+
+
+def test_an_undecodable_image_only_fails_its_own_request(make_batcher):
+    model = StubModel()
+    batcher = make_batcher(model, max_batch_size=8, max_wait_ms=200, prepare=decode)
+
+    futures = batcher.submit_many(["a", "corrupt", "b"])
+
+    assert futures[0].result(timeout=5) == "caption of a"
+    assert futures[2].result(timeout=5) == "caption of b"
+    with pytest.raises(HTTPException) as error:
+        futures[1].result(timeout=5)
+    assert error.value.status_code == 422
+    assert model.batches == [["a", "b"]]
+
+
+def test_a_model_failure_fails_every_request_of_the_batch(make_batcher):
+    batcher = make_batcher(StubModel(fail=True), max_batch_size=8, max_wait_ms=200)
+
+    futures = batcher.submit_many(["a", "b"])
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="model failed"):
+            future.result(timeout=5)
+
+
+def test_a_wrong_number_of_captions_fails_the_batch(make_batcher):
+    model = StubModel()
+    model.caption_batch = lambda images: ["only one"]
+    batcher = make_batcher(model, max_batch_size=8, max_wait_ms=200)
+
+    futures = batcher.submit_many(["a", "b"])
+
+    with pytest.raises(RuntimeError, match="Expected 2 captions"):
+        futures[0].result(timeout=5)
+
+
+def test_interactive_requests_are_taken_before_bulk_ones(make_batcher):
+    model = StubModel()
+    model.release.clear()
+    batcher = make_batcher(model, max_batch_size=2, max_wait_ms=0)
+
+    # Holds the worker in a first batch while both queues fill up
+    first = batcher.submit("first")
+    assert model.started.wait(5)
+    bulk = batcher.submit_many(["bulk 1", "bulk 2"], BULK)
+    interactive = batcher.submit_many(["interactive 1", "interactive 2"], INTERACTIVE)
+    model.release.set()
+
+    for future in [first] + bulk + interactive:
+        future.result(timeout=5)
+    assert model.batches[1:] == [["interactive 1", "interactive 2"], ["bulk 1", "bulk 2"]]
+
+
+def test_a_full_queue_rejects_requests_with_retry_after(make_batcher):
+    model = StubModel()
+    model.release.clear()
+    batcher = make_batcher(model, max_batch_size=1, max_wait_ms=0, max_queue_size={INTERACTIVE: 2, BULK: 2})
+
+    first = batcher.submit("first")
+    assert model.started.wait(5)
+    batcher.submit_many(["a", "b"])
+
+    with pytest.raises(HTTPException) as error:
+        batcher.submit("c")
+    assert error.value.status_code == 503
+    assert int(error.value.headers["Retry-After"]) >= 1
+
+    # Bulk requests have their own queue
+    batcher.submit("bulk", BULK)
+    model.release.set()
+    first.result(timeout=5)
+
+
+def test_closed_batcher_rejects_requests():
+    batcher = CaptionBatcher(StubModel().caption_batch)
+    batcher.close()
+
+    with pytest.raises(HTTPException) as error:
+        batcher.submit("image")
+    assert error.value.status_code == 503
+
+
+def test_an_upload_larger_than_the_queue_is_refused_for_good(make_batcher):
+    batcher = make_batcher(StubModel(), max_queue_size={INTERACTIVE: 2, BULK: 3})
+
+    with pytest.raises(HTTPException) as error:
+        batcher.submit_many(["a", "b", "c", "d"], BULK)
+    assert error.value.status_code == 413
+
+
+def test_streams_are_generated_on_their_own_in_queue_order(make_batcher):
+    model = StubModel()
+    model.release.clear()
+    batcher = make_batcher(model, max_batch_size=8, max_wait_ms=0)
+
+    first = batcher.submit("first")
+    assert model.started.wait(5)
+    before = batcher.submit("before")
+    stream = batcher.stream("streamed")
+    after = batcher.submit_many(["after 1", "after 2"])
+    model.release.set()
+
+    assert "".join(stream) == "caption of streamed"
+    for future in [first, before] + after:
+        future.result(timeout=5)
+    assert model.batches == [["first"], ["before"], ("stream", "streamed"), ["after 1", "after 2"]]
+
+
+def test_a_failed_stream_raises_from_its_iterator(make_batcher):
+    model = StubModel()
+    batcher = make_batcher(model, prepare=decode)
+
+    with pytest.raises(RuntimeError, match="stream failed"):
+        list(batcher.stream("failing"))
+    with pytest.raises(HTTPException):
+        list(batcher.stream("corrupt"))
+    assert batcher.submit("image").result(timeout=5) == "caption of image"
+
+
+def test_streams_count_against_the_queue_size(make_batcher):
+    model = StubModel()
+    model.release.clear()
+    batcher = make_batcher(model, max_batch_size=1, max_wait_ms=0, max_queue_size={INTERACTIVE: 1, BULK: 1})
+
+    first = batcher.submit("first")
+    assert model.started.wait(5)
+    batcher.stream("streamed")
+
+    with pytest.raises(HTTPException) as error:
+        batcher.stream("another")
+    assert error.value.status_code == 503
+    model.release.set()
+    first.result(timeout=5)
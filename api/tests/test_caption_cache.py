@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+import pytest
+
+from models.caption_cache import CaptionCache
+
+
+def test_key_is_the_sha256_of_the_image_bytes():
+    assert CaptionCache.key(b"image") == hashlib.sha256(b"image").hexdigest()
+    assert CaptionCache.key(b"image") != CaptionCache.key(b"other image")
+
+
+def test_memory_entries_are_evicted_least_recently_used_first():
+    cache = CaptionCache(max_entries=2)
+    cache.put("a", "caption a")
+    cache.put("b", "caption b")
+    assert cache.get("a") == "caption a"
+
+    cache.put("c", "caption c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "caption a"
+    assert cache.get("c") == "caption c"
+
+
+def test_disk_entries_survive_a_restart_and_are_promoted_to_memory(tmp_path):
+    CaptionCache(directory=str(tmp_path)).put("ab12", "a dog on the grass")
+
+    cache = CaptionCache(directory=str(tmp_path))
+    assert cache.stats()["disk_entries"] == 1
+    assert cache.stats()["memory_entries"] == 0
+
+    assert cache.get("ab12") == "a dog on the grass"
+    assert cache.get("ab12") == "a dog on the grass"
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["memory_entries"]) == (1, 1, 1)
+    assert os.path.exists(tmp_path / "ab" / "ab12.txt")
+
+
+def test_disk_tier_evicts_the_oldest_entries_past_its_size(tmp_path):
+    cache = CaptionCache(directory=str(tmp_path), max_disk_bytes=25)
+    for key in ("k1", "k2", "k3"):
+        cache.put(key, "ten bytes!")
+
+    assert cache.stats()["disk_entries"] == 2
+    assert cache.stats()["disk_bytes"] == 20
+    assert not os.path.exists(tmp_path / "k1" / "k1.txt")
+    assert CaptionCache(directory=str(tmp_path)).get("k1") is None
+    assert CaptionCache(directory=str(tmp_path)).get("k3") == "ten bytes!"
+
+
+def test_replacing_an_entry_counts_its_size_once(tmp_path):
+    cache = CaptionCache(directory=str(tmp_path))
+    cache.put("k1", "short")
+    cache.put("k1", "a longer caption")
+    assert (cache.stats()["disk_entries"], cache.stats()["disk_bytes"]) == (1, len("a longer caption"))
+    assert [name for name in os.listdir(tmp_path / "k1") if name.endswith(".tmp")] == []
+
+
+def test_stats_count_hits_and_misses():
+    cache = CaptionCache(max_entries=4)
+    assert cache.stats()["hit_rate"] == 0.0
+
+    cache.put("a", "caption a")
+    cache.get("a")
+    cache.get("a")
+    cache.get("missing")
+
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (2, 0, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+    assert (stats["memory_entries"], stats["max_memory_entries"]) == (1, 4)
+    # Without a directory there is no disk tier
+    assert (stats["disk_entries"], stats["disk_bytes"], stats["max_disk_bytes"]) == (0, 0, 0)
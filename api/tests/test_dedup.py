@@ -0,0 +1,91 @@
+import random
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageFilter
+
+from models.dedup import BKTree, PerceptualHashIndex, dhash, dhash_bytes, hamming
+
+
+def photo(seed, size=(640, 480)):
+    # Smooth random blobs, standing in for a photo
+    rng = random.Random(seed)
+    small = Image.new("L", (16, 12))
+    small.putdata([rng.randrange(256) for _ in range(16 * 12)])
+    return small.resize(size, Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(8)).convert("RGB")
+
+
+def encode(image, format="JPEG", **options):
+    buffer = BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def test_hamming():
+    assert hamming(0, 0) == 0
+    assert hamming(0b1011, 0b0010) == 2
+    assert hamming(0, 2 ** 64 - 1) == 64
+
+
+def test_dhash_is_a_64_bit_value():
+    value = dhash(photo(0))
+    assert 0 <= value < 2 ** 64
+    assert dhash(photo(0), size=4) < 2 ** 16
+
+
+def test_reencoded_and_resized_copies_hash_close():
+    original = photo(0)
+    value = dhash_bytes(encode(original, format="PNG"))
+    assert value == dhash(original)
+
+    copies = [
+        encode(original, quality=40),
+        encode(original.resize((320, 240)), quality=85),
+        encode(original.resize((1280, 960)), format="PNG"),
+    ]
+    assert all(hamming(value, dhash_bytes(copy)) <= 4 for copy in copies)
+
+
+def test_different_images_hash_far_apart():
+    values = [dhash(photo(seed)) for seed in range(5)]
+    assert all(hamming(a, b) > 10 for i, a in enumerate(values) for b in values[i + 1:])
+
+
+def test_bktree_radius_query_matches_a_linear_scan():
+    rng = random.Random(0)
+    values = [rng.getrandbits(16) for _ in range(500)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    assert tree.size == len(values)
+
+    for query in [rng.getrandbits(16) for _ in range(20)] + values[:5]:
+        for threshold in (0, 2, 5):
+            matches = tree.search(query, threshold)
+            expected = sorted((hamming(query, value), i) for i, value in enumerate(values) if hamming(query, value) <= threshold)
+            assert sorted(matches) == expected
+            assert [distance for distance, _ in matches] == sorted(distance for distance, _ in matches)
+
+
+def test_empty_bktree():
+    assert BKTree().search(0, 64) == []
+
+
+def test_index_finds_the_closest_image_within_the_threshold():
+    index = PerceptualHashIndex(threshold=4)
+    index.add(0b0000, "zero")
+    index.add(0b0111, "three")
+    assert len(index) == 2
+
+    assert index.find(0b0001) == "zero"
+    assert index.find(0b1111) == "three"
+    assert index.find(2 ** 64 - 1) is None
+
+
+@pytest.mark.parametrize("threshold, expected", [(0, None), (-1, None), (1, "zero")])
+def test_index_threshold(threshold, expected):
+    index = PerceptualHashIndex(threshold=threshold)
+    index.add(0, "zero")
+    assert index.find(1) == expected
+    # A negative threshold turns detection off altogether
+    assert index.find(0) == (None if threshold < 0 else "zero")
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from fastapi import HTTPException
+
+from models.ic_model import ICModel, StopOnTokens, ends_sentence
+
+
+class FixtureTokenizer:
+    """A tiny vocabulary decoding ids one at a time, like a Hugging Face tokenizer."""
+
+    vocabulary = ["<|eot_id|>", "<|end_of_text|>", " A", " dog", ".", " Dr.", "!\n", '."', " St", "?", "...", " ,", "1.5"]
+    eos_token_id = 1
+
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+
+    def convert_tokens_to_ids(self, token):
+        return self.vocabulary.index(token)
+
+
+    def batch_decode(self, sequences):
+        return ["".join(self.vocabulary[i] for i in sequence) for sequence in sequences]
+
+
+def stop_ids(stop_at):
+    model = SimpleNamespace(tokenizer=SimpleNamespace(tokenizer=FixtureTokenizer()))
+    return ICModel._stop_ids(model, stop_at)
+
+
+@pytest.mark.parametrize("text, expected", [
+    (".", True), (" !", True), ("?\n", True), ('."', True), ("...", True), (")?", True),
+    (" Dr.", False), ("etc.", False), ("1.5", False), (",", False), (" ", False), ("", False), (" dog", False),
+])
+def test_ends_sentence(text, expected):
+    assert ends_sentence(text) is expected
+
+
+def test_sentence_stop_ids_are_punctuation_only_tokens():
+    vocabulary = FixtureTokenizer.vocabulary
+    assert sorted(vocabulary[i] for i in stop_ids("sentence")) == sorted(
+        ["<|eot_id|>", "<|end_of_text|>", ".", "!\n", '."', "?", "..."])
+
+
+def test_eot_stop_ids_are_the_end_tokens():
+    assert stop_ids("eot") == {0, 1}
+    with pytest.raises(ValueError):
+        stop_ids("paragraph")
+
+
+def test_stop_on_tokens_checks_the_last_token_of_each_sequence():
+    criteria = StopOnTokens({4, 9})
+    input_ids = torch.tensor([
+        [2, 3, 4],
+        [2, 4, 3],
+        [2, 3, 9],
+    ])
+    assert criteria(input_ids, None).tolist() == [True, False, True]
+
+
+def test_decode_image_rejects_an_invalid_upload():
+    with pytest.raises(HTTPException) as error:
+        ICModel.decode_image(b"not an image")
+    assert error.value.status_code == 422
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from config import settings
+from models.db_index import LOCAL_IMAGE_STORE_FOLDER
+from search import search_router
+
+
+IMAGE_ID = "Images/0000.jpg"
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def client(make_index, monkeypatch):
+    image_db_index = make_index({IMAGE_ID: "A dog runs on the grass"})
+    # Already in the image store, so it is served without the Hub
+    path = os.path.join(LOCAL_IMAGE_STORE_FOLDER, IMAGE_ID)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(CONTENT)
+
+    monkeypatch.setattr(settings, "SHARED", {"IMAGE_DB_INDEX": image_db_index})
+    app = FastAPI()
+    app.include_router(search_router)
+    return TestClient(app)
+
+
+def test_whole_image(client):
+    response = client.get(f"/images/flicker8k/{IMAGE_ID}")
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"]
+
+
+def test_matching_etag_is_not_modified(client):
+    etag = client.get(f"/images/flicker8k/{IMAGE_ID}").headers["etag"]
+
+    response = client.get(f"/images/flicker8k/{IMAGE_ID}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    assert client.get(f"/images/flicker8k/{IMAGE_ID}", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=1000-", 1000, 1023),
+    ("bytes=-24", 1000, 1023),
+    ("bytes=1000-5000", 1000, 1023),
+])
+def test_single_range(client, range_header, start, end):
+    response = client.get(f"/images/flicker8k/{IMAGE_ID}", headers={"Range": range_header})
+    assert response.status_code == 206
+    assert response.content == CONTENT[start:end + 1]
+    assert response.headers["content-range"] == f"bytes {start}-{end}/{len(CONTENT)}"
+
+
+@pytest.mark.parametrize("range_header", ["bytes=2000-", "bytes=-", "bytes=5-2", "items=0-1", "bytes=0-1,5-6"])
+def test_unsatisfiable_range(client, range_header):
+    response = client.get(f"/images/flicker8k/{IMAGE_ID}", headers={"Range": range_header})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+@pytest.mark.parametrize("image_ref", ["flicker8k/Images/missing.jpg", "user/missing.jpg", "other/Images/0000.jpg"])
+def test_unknown_image(client, image_ref):
+    assert client.get(f"/images/{image_ref}").status_code == 404
+
+
+def test_unknown_size(client):
+    assert client.get(f"/images/flicker8k/{IMAGE_ID}", params={"size": "huge"}).status_code == 422
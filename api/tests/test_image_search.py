@@ -0,0 +1,53 @@
+from io import BytesIO
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+
+class ColorEmbedder:
+    """Embeds a decoded image as its normalized mean color, in place of CLIP."""
+
+
+    def __init__(self):
+        self.calls = 0
+
+
+    def embed(self, images):
+        self.calls += 1
+        embeddings = []
+        for image in images:
+            color = [channel + 1.0 for channel in image.convert("RGB").resize((1, 1)).getpixel((0, 0))]
+            norm = sum(channel ** 2 for channel in color) ** 0.5
+            embeddings.append([channel / norm for channel in color])
+        return embeddings
+
+
+def jpeg(color):
+    buffer = BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_embedder():
+    return ColorEmbedder()
+
+
+@pytest.fixture
+def image_db_index(make_index, image_embedder):
+    return make_index({"Images/0000.jpg": "A dog"}, image_embedder=image_embedder)
+
+
+@pytest.mark.parametrize("paged", [False, True])
+def test_undecodable_upload_is_rejected(image_db_index, image_embedder, paged):
+    search = image_db_index.search_by_image_page if paged else image_db_index.search_by_image
+    with pytest.raises(HTTPException) as error:
+        search(b"not an image", 3)
+
+    assert error.value.status_code == 422
+    assert image_embedder.calls == 0
+
+
+def test_image_search_of_an_empty_index(image_db_index):
+    assert image_db_index.search_by_image(jpeg("red"), 3) == [[], []]
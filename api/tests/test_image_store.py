@@ -0,0 +1,124 @@
+import os
+import shutil
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import models.image_store
+from models.image_store import ImageStore
+from models.renditions import SIZES, rendition_path
+from prefetch_flicker8k import prefetch_flicker8k
+
+
+IMAGE_IDS = ["Images/1000268201_693b08cb0e.jpg", "Images/1001773457_577c3a7d70.jpg", "Images/1002674143_1b742ab4b8.jpg"]
+
+
+def jpeg(color):
+    buffer = BytesIO()
+    Image.new("RGB", (800, 600), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def hub(tmp_path, monkeypatch):
+    # A fixture directory standing in for the Hub dataset, recording every download
+    directory = tmp_path / "hub"
+    for i, image_id in enumerate(IMAGE_IDS):
+        (directory / image_id).parent.mkdir(parents=True, exist_ok=True)
+        (directory / image_id).write_bytes(jpeg((40 * i, 80, 160)))
+
+    downloads = []
+
+    def hf_hub_download(repo_id, filename, repo_type, local_dir, token):
+        assert (repo_id, repo_type) == ("fixture/flickr8k", "dataset")
+        downloads.append(filename)
+        target = os.path.join(local_dir, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(directory / filename, target)
+        return target
+
+    monkeypatch.setattr(models.image_store, "hf_hub_download", hf_hub_download)
+    return downloads
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ImageStore(tmp_path / "store", "fixture/flickr8k")
+
+
+class FixtureIndex:
+    """The part of ImageDatabaseIndex used by the prefetch script."""
+
+
+    def __init__(self, image_store):
+        self.image_store = image_store
+
+
+    def flicker8k_ids(self):
+        return list(IMAGE_IDS)
+
+
+def test_local_images_are_served_without_the_hub(store, hub):
+    path = os.path.join(store.directory, "uploads", "local.jpg")
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(jpeg("red"))
+
+    assert store.path("uploads/local.jpg") == path
+    assert store.read("uploads/local.jpg") == jpeg("red")
+    assert hub == []
+
+
+def test_missing_images_are_downloaded_once(store, hub):
+    assert not store.contains(IMAGE_IDS[0])
+
+    assert store.read(IMAGE_IDS[0]) == jpeg((0, 80, 160))
+    assert store.contains(IMAGE_IDS[0])
+    store.read(IMAGE_IDS[0])
+
+    assert hub == [IMAGE_IDS[0]]
+
+
+def test_renditions_of_downloaded_images(store, hub):
+    path = store.path(IMAGE_IDS[1], "thumbnail")
+
+    assert path == rendition_path(os.path.join(store.directory, IMAGE_IDS[1]), "thumbnail")
+    with Image.open(path) as image:
+        assert max(image.size) == 160
+    assert hub == [IMAGE_IDS[1]]
+
+
+@pytest.mark.parametrize("image_id", ["../outside.jpg", "Images/../../outside.jpg", "/etc/passwd"])
+def test_ids_outside_the_store_are_rejected(store, hub, image_id):
+    with pytest.raises(ValueError):
+        store.path(image_id)
+    assert hub == []
+
+
+def test_prefetch_downloads_only_missing_images(store, hub):
+    store.read(IMAGE_IDS[0])
+    hub.clear()
+
+    assert store.prefetch(IMAGE_IDS, workers=2) == 2
+    assert sorted(hub) == sorted(IMAGE_IDS[1:])
+    assert store.prefetch(IMAGE_IDS, workers=2) == 0
+    assert len(hub) == 2
+
+
+def test_prefetch_script(store, hub):
+    assert prefetch_flicker8k(FixtureIndex(store), workers=2) == len(IMAGE_IDS)
+
+    assert sorted(hub) == sorted(IMAGE_IDS)
+    for image_id in IMAGE_IDS:
+        assert store.contains(image_id)
+        assert not os.path.exists(rendition_path(os.path.join(store.directory, image_id), "thumbnail"))
+
+
+def test_prefetch_script_with_renditions(store, hub):
+    assert prefetch_flicker8k(FixtureIndex(store), workers=2, renditions=True) == len(IMAGE_IDS)
+
+    for image_id in IMAGE_IDS:
+        for size in SIZES:
+            assert os.path.exists(rendition_path(os.path.join(store.directory, image_id), size))
+    assert len(hub) == len(IMAGE_IDS)
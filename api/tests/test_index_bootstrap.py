@@ -0,0 +1,196 @@
+import hashlib
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+import models.index_bootstrap
+from models.index_bootstrap import INDEX_DIRNAME, MANIFEST_FILENAME, ensure_index, read_manifest
+
+
+REPO_ID = "fixture/flickr8k"
+FILENAME = "chromadb_index.zip"
+
+
+def make_archive(tmp_path, name, content):
+    # A zipped index holding a single file, like the one published on the Hub
+    source = tmp_path / f"{name}-source"
+    (source / INDEX_DIRNAME).mkdir(parents=True)
+    (source / INDEX_DIRNAME / "chroma.sqlite3").write_bytes(content)
+    return shutil.make_archive(str(tmp_path / name), "zip", source)
+
+
+def sha256(path):
+    with open(path, mode='rb') as _file:
+        return hashlib.sha256(_file.read()).hexdigest()
+
+
+def index_content(directory):
+    return (directory / INDEX_DIRNAME / "chroma.sqlite3").read_bytes()
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.startswith((".unpack-", ".previous-"))]
+
+
+class FixtureHub:
+    """Serves archives of the fixture directory as successive revisions of the index on the Hub."""
+
+
+    def __init__(self, monkeypatch):
+        self.archive = None
+        self.commit_hash = None
+        self.reachable = True
+        self.downloads = []
+
+        monkeypatch.setattr(models.index_bootstrap, "hf_hub_url", self.hf_hub_url)
+        monkeypatch.setattr(models.index_bootstrap, "get_hf_file_metadata", self.get_hf_file_metadata)
+        monkeypatch.setattr(models.index_bootstrap, "hf_hub_download", self.hf_hub_download)
+
+
+    def publish(self, archive, commit_hash):
+        self.archive, self.commit_hash = archive, commit_hash
+
+
+    def hf_hub_url(self, repo_id, filename, repo_type, revision):
+        return f"https://huggingface.co/datasets/{repo_id}/resolve/{revision or 'main'}/{filename}"
+
+
+    def get_hf_file_metadata(self, url, token=None):
+        if not self.reachable:
+            raise ConnectionError("Hub unreachable")
+        return SimpleNamespace(commit_hash=self.commit_hash, etag=sha256(self.archive))
+
+
+    def hf_hub_download(self, repo_id, filename, repo_type, revision, cache_dir, token=None):
+        assert (repo_id, filename, revision) == (REPO_ID, FILENAME, self.commit_hash)
+        self.downloads.append(revision)
+        return self.archive
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    return FixtureHub(monkeypatch)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return tmp_path / "chromadb"
+
+
+def test_local_archive_is_unpacked_once(tmp_path, directory, monkeypatch):
+    archive = make_archive(tmp_path, "v1", b"v1")
+
+    target = ensure_index(str(directory), REPO_ID, FILENAME, path=archive)
+    assert target == str(directory / INDEX_DIRNAME)
+    assert index_content(directory) == b"v1"
+    assert read_manifest(str(directory))["sha256"] == sha256(archive)
+
+    monkeypatch.setattr(models.index_bootstrap, "unpack_index", pytest.fail)
+    assert ensure_index(str(directory), REPO_ID, FILENAME, path=archive) == target
+
+
+def test_unpacked_index_directory_is_used_as_is(tmp_path, directory):
+    (tmp_path / "unpacked").mkdir()
+    assert ensure_index(str(directory), REPO_ID, FILENAME, path=str(tmp_path / "unpacked")) == str(tmp_path / "unpacked")
+
+
+def test_manifest_hit_skips_the_download(tmp_path, directory, hub, monkeypatch):
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+    assert hub.downloads == ["commit1"]
+
+    monkeypatch.setattr(models.index_bootstrap, "unpack_index", pytest.fail)
+    assert ensure_index(str(directory), REPO_ID, FILENAME) == str(directory / INDEX_DIRNAME)
+    assert hub.downloads == ["commit1"]
+
+
+def test_new_revision_is_swapped_in(tmp_path, directory, hub):
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+
+    hub.publish(make_archive(tmp_path, "v2", b"v2"), "commit2")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+
+    assert hub.downloads == ["commit1", "commit2"]
+    assert index_content(directory) == b"v2"
+    assert read_manifest(str(directory))["version"].startswith(f"{REPO_ID}@commit2:")
+    assert leftovers(directory) == []
+
+
+def test_unreachable_hub_falls_back_to_the_index_on_disk(tmp_path, directory, hub):
+    hub.reachable = False
+    with pytest.raises(ConnectionError):
+        ensure_index(str(directory), REPO_ID, FILENAME)
+
+    hub.reachable = True
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+
+    hub.reachable = False
+    assert ensure_index(str(directory), REPO_ID, FILENAME) == str(directory / INDEX_DIRNAME)
+    assert index_content(directory) == b"v1"
+
+
+def test_sha256_mismatch_keeps_the_current_index(tmp_path, directory, hub):
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+    manifest = read_manifest(str(directory))
+
+    hub.publish(make_archive(tmp_path, "v2", b"v2"), "commit2")
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        ensure_index(str(directory), REPO_ID, FILENAME, sha256="0" * 64)
+
+    assert index_content(directory) == b"v1"
+    assert read_manifest(str(directory)) == manifest
+
+
+def test_pinned_sha256_is_checked_against_the_manifest(tmp_path, directory):
+    archive = make_archive(tmp_path, "v1", b"v1")
+    ensure_index(str(directory), REPO_ID, FILENAME, path=archive, sha256=sha256(archive))
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        ensure_index(str(directory), REPO_ID, FILENAME, path=archive, sha256="0" * 64)
+
+
+def test_corrupt_archive_keeps_the_current_index(tmp_path, directory, hub):
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+    manifest = read_manifest(str(directory))
+
+    corrupt = tmp_path / "corrupt.zip"
+    corrupt.write_bytes(b"PK\x03\x04 not really a zip archive")
+    hub.publish(str(corrupt), "commit2")
+    with pytest.raises(Exception):
+        ensure_index(str(directory), REPO_ID, FILENAME)
+
+    assert index_content(directory) == b"v1"
+    assert read_manifest(str(directory)) == manifest
+    assert leftovers(directory) == []
+
+
+def test_failed_swap_rolls_back_to_the_previous_index(tmp_path, directory, hub, monkeypatch):
+    hub.publish(make_archive(tmp_path, "v1", b"v1"), "commit1")
+    ensure_index(str(directory), REPO_ID, FILENAME)
+    manifest = read_manifest(str(directory))
+
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        # Fails the rename of the unpacked index into place
+        if ".unpack-" in str(src):
+            raise OSError("rename failed")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    hub.publish(make_archive(tmp_path, "v2", b"v2"), "commit2")
+    with pytest.raises(OSError, match="rename failed"):
+        ensure_index(str(directory), REPO_ID, FILENAME)
+    monkeypatch.setattr(os, "replace", replace)
+
+    assert index_content(directory) == b"v1"
+    assert read_manifest(str(directory)) == manifest
+    assert leftovers(directory) == []
+    assert sorted(os.listdir(directory / INDEX_DIRNAME)) == ["chroma.sqlite3"]
+    assert MANIFEST_FILENAME in os.listdir(directory)
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from config import settings
+from indexing import index_job
+from models.index_jobs import IndexJobQueue
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"image{i}.jpg"
+        path.write_bytes(b"image")
+        paths.append(str(path))
+    return paths
+
+
+def caption(filenames):
+    return {filename: f"caption of {filename}" for filename in filenames}, {}
+
+
+def test_jobs_are_captioned(tmp_path, images):
+    jobs = IndexJobQueue(str(tmp_path / "jobs.db"), caption, chunk_size=2, poll_seconds=0.01)
+    try:
+        job_id = jobs.enqueue(images, ["a.jpg", "b.jpg", "c.jpg"])
+        wait_for(lambda: jobs.status(job_id)["status"] == "completed")
+    finally:
+        jobs.close()
+
+    status = jobs.status(job_id)
+    assert status["done"] == 3
+    assert [image["caption"] for image in status["images"]] == [f"caption of {image}" for image in images]
+
+
+def test_worker_survives_database_errors(tmp_path, images, monkeypatch):
+    next_chunk, failures = IndexJobQueue._next_chunk, []
+
+    def failing_next_chunk(self):
+        if len(failures) < 2:
+            failures.append(1)
+            raise RuntimeError("database is locked")
+        return next_chunk(self)
+
+    monkeypatch.setattr(IndexJobQueue, "_next_chunk", failing_next_chunk)
+    jobs = IndexJobQueue(str(tmp_path / "jobs.db"), caption, poll_seconds=0.01)
+    try:
+        job_id = jobs.enqueue(images, ["a.jpg", "b.jpg", "c.jpg"])
+        wait_for(lambda: jobs.status(job_id)["status"] == "completed")
+        assert jobs.worker.is_alive()
+    finally:
+        jobs.close()
+    assert len(failures) == 2
+
+
+def test_unknown_job(tmp_path):
+    jobs = IndexJobQueue(str(tmp_path / "jobs.db"), caption, poll_seconds=0.01)
+    try:
+        with pytest.raises(HTTPException) as error:
+            jobs.status("missing")
+    finally:
+        jobs.close()
+    assert error.value.status_code == 404
+
+
+def test_job_status_without_a_job_queue(monkeypatch):
+    monkeypatch.setattr(settings, "SHARED", {})
+    with pytest.raises(HTTPException) as error:
+        index_job(None, "missing")
+    assert error.value.status_code == 503
@@ -0,0 +1,32 @@
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import indexing
+from config import settings
+from models.batcher import BULK, INTERACTIVE, CaptionBatcher
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    batcher = CaptionBatcher(pytest.fail, max_queue_size={INTERACTIVE: 2, BULK: 3})
+    monkeypatch.setattr(settings, "SHARED", {"CAPTION_BATCHER": batcher})
+    yield batcher
+    batcher.close()
+
+
+def uploads(count):
+    return [SimpleNamespace(filename=f"{i}.jpg", file=BytesIO(b"image")) for i in range(count)]
+
+
+def test_an_upload_larger_than_the_bulk_queue_is_never_stored(batcher, monkeypatch):
+    monkeypatch.setattr(indexing, "persist_images", pytest.fail)
+
+    images = uploads(4)
+    with pytest.raises(HTTPException) as error:
+        indexing.index_images(images)
+    assert error.value.status_code == 413
+    # Not even read
+    assert all(image.file.tell() == 0 for image in images)
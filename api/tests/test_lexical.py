@@ -0,0 +1,126 @@
+import math
+from collections import Counter
+
+import pytest
+
+from models.lexical import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+CAPTIONS = {
+    "a": "A dog runs on the grass",
+    "b": "A black dog and a white dog play in the snow",
+    "c": "Two children visit the Konark Sun Temple",
+    "d": "A man rides a bike on a dirt road",
+    "e": "The sun sets over the sea",
+}
+
+
+def bm25(captions, query, k1=1.5, b=0.75):
+    # Okapi BM25 straight from its definition, as a reference for the index
+    documents = {doc_id: Counter(tokenize(text)) for doc_id, text in captions.items()}
+    average_length = sum(sum(terms.values()) for terms in documents.values()) / len(documents)
+    scores = {}
+    for doc_id, terms in documents.items():
+        length = sum(terms.values())
+        score = 0.0
+        for term in set(tokenize(query)):
+            containing = sum(1 for other in documents.values() if term in other)
+            if not terms[term]:
+                continue
+            idf = math.log(1 + (len(documents) - containing + 0.5) / (containing + 0.5))
+            score += idf * terms[term] * (k1 + 1) / (terms[term] + k1 * (1 - b + b * length / average_length))
+        if score:
+            scores[doc_id] = score
+    return scores
+
+
+def make_index(captions):
+    index = BM25Index()
+    for doc_id, text in captions.items():
+        index.add(doc_id, text)
+    return index
+
+
+def assert_exact(index, captions, query):
+    hits = dict(index.search(query, len(captions)))
+    expected = bm25(captions, query)
+    assert hits.keys() == expected.keys()
+    for doc_id, score in expected.items():
+        assert hits[doc_id] == pytest.approx(score, rel=1e-5)
+
+
+@pytest.mark.parametrize("query", ["dog", "black dog", "Konark Sun Temple", "the sun", "dog dog snow"])
+def test_scores_are_exact(query):
+    assert_exact(make_index(CAPTIONS), CAPTIONS, query)
+
+
+def test_hits_are_ranked_best_first_and_cut_at_num():
+    hits = make_index(CAPTIONS).search("dog", 2)
+    assert [doc_id for doc_id, _ in hits] == ["b", "a"]
+    assert hits[0][1] > hits[1][1]
+
+
+def test_queries_without_known_terms_match_nothing():
+    index = make_index(CAPTIONS)
+    assert index.search("the a of", 5) == []
+    assert index.search("zebra", 5) == []
+    assert BM25Index().search("dog", 5) == []
+
+
+def test_upsert_replaces_the_postings_of_a_document():
+    captions = dict(CAPTIONS)
+    index = make_index(captions)
+    index.search("dog", 5)
+
+    captions["a"] = "A cat sleeps on a long red sofa near the window"
+    index.add("a", captions["a"])
+
+    assert [doc_id for doc_id, _ in index.search("dog", 5)] == ["b"]
+    assert [doc_id for doc_id, _ in index.search("cat", 5)] == ["a"]
+    # The new length changes the average length, and with it the scores of the other captions
+    assert_exact(index, captions, "dog sun")
+    assert len(index) == len(captions)
+
+
+def test_delete_removes_a_document_and_reuses_its_slot():
+    captions = dict(CAPTIONS)
+    index = make_index(captions)
+    index.search("sun", 5)
+
+    index.remove("c")
+    del captions["c"]
+    index.remove("missing")
+    assert [doc_id for doc_id, _ in index.search("sun", 5)] == ["e"]
+    assert_exact(index, captions, "sun dog")
+
+    captions["f"] = "A sun hat on the beach"
+    index.add("f", captions["f"])
+    assert len(index.doc_ids) == len(CAPTIONS)
+    assert_exact(index, captions, "sun hat")
+
+
+def test_ties_are_broken_by_id():
+    index = make_index({doc_id: "A dog" for doc_id in ("c", "a", "b")})
+    assert [doc_id for doc_id, _ in index.search("dog", 3)] == ["a", "b", "c"]
+    assert [doc_id for doc_id, _ in index.search("dog", 2)] == ["a", "b"]
+
+
+def test_rrf_of_a_single_ranking_keeps_its_order():
+    assert reciprocal_rank_fusion([["c", "a", "b"]]) == ["c", "a", "b"]
+
+
+def test_rrf_ranks_ids_found_by_both_rankings_first():
+    # b: 1/62 + 1/62, then a and c: 1/61 each, in their order of appearance
+    assert reciprocal_rank_fusion([["a", "b"], ["c", "b"]]) == ["b", "a", "c"]
+
+
+def test_rrf_sums_reciprocal_ranks():
+    # c: 1/63 + 1/61 beats b: 1/62 + 1/62, ahead of a: 1/61 and d: 1/63
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["c", "b", "d"]]) == ["c", "b", "a", "d"]
+
+
+def test_rrf_k_damps_the_top_ranks():
+    rankings = [["a", "b"], ["c", "d", "e", "f", "g", "b"]]
+    # b: 1/62 + 1/66 beats a: 1/61, while with k=1 a: 1/2 beats b: 1/3 + 1/7
+    assert reciprocal_rank_fusion(rankings)[0] == "b"
+    assert reciprocal_rank_fusion(rankings, k=1)[0] == "a"
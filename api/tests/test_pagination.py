@@ -0,0 +1,93 @@
+import pytest
+from fastapi import HTTPException
+
+from models.pagination import decode_cursor, encode_cursor, query_key
+from models.vector_store import similarity
+
+
+COLORS = ("red", "green", "blue", "yellow", "black", "white")
+# 120 images sharing 6 captions, so most distances are tied
+CAPTIONS = {f"Images/{i:04d}.jpg": f"A {COLORS[i % len(COLORS)]} dog runs on the grass" for i in range(120)}
+QUERY = "a red dog on the grass"
+
+
+@pytest.fixture
+def image_db_index(make_index):
+    return make_index(CAPTIONS)
+
+
+def page_through(image_db_index, num, mode="vector", min_similarity=None):
+    # Ids and distances of the flicker8k hits of every page, following the cursors to the end
+    hits, cursor, pages = [], None, 0
+    while True:
+        page = image_db_index.search_page(QUERY, num, refs=True, mode=mode, cursor=cursor, min_similarity=min_similarity)
+        assert page["results"][0] == []
+        assert len(page["results"][1]) <= num
+        hits.extend(page["results"][1])
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return hits, pages
+
+
+@pytest.mark.parametrize("num", [4, 10, 7])
+@pytest.mark.parametrize("mode", ["vector", "keyword", "hybrid"])
+def test_pages_return_every_hit_once_despite_ties(image_db_index, num, mode):
+    hits, _ = page_through(image_db_index, num, mode)
+    ids = [hit["id"] for hit in hits]
+
+    expected = len(CAPTIONS) if mode != "hybrid" else 100
+    assert len(ids) == len(set(ids)) == expected
+
+
+@pytest.mark.parametrize("mode", ["vector", "keyword", "hybrid"])
+def test_pages_follow_the_ranking_of_a_plain_search(image_db_index, mode):
+    hits, _ = page_through(image_db_index, 4, mode)
+    plain = image_db_index.search(QUERY, 12, refs=True, mode=mode)[1]
+    assert [hit["id"] for hit in hits[:12]] == [hit["id"] for hit in plain]
+
+
+def test_vector_pages_are_ordered_by_distance_then_id(image_db_index):
+    hits, _ = page_through(image_db_index, 8)
+    keys = [(hit["distance"], hit["id"]) for hit in hits]
+    assert keys == sorted(keys)
+    # The red dogs are the exact caption matches
+    assert all(CAPTIONS[hit["id"].partition("/")[2]].startswith("A red") for hit in hits[:20])
+
+
+def test_exhaustion(image_db_index):
+    # 120 hits in pages of 40: the third page is full, and the fourth is empty without a cursor
+    hits, pages = page_through(image_db_index, 40)
+    assert len(hits) == 120 and pages == 4
+
+    hits, pages = page_through(image_db_index, 50)
+    assert len(hits) == 120 and pages == 3
+
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(query_key("x"), [None, None]), query_key("x"), 2)
+
+
+def test_min_similarity_ends_the_pages(image_db_index):
+    hits, _ = page_through(image_db_index, 6, min_similarity=0.8)
+
+    space = image_db_index.vector_stores["flicker8k"].space
+    assert [hit["id"] for hit in hits] == sorted(
+        f"flicker8k/{image_id}" for image_id, caption in CAPTIONS.items() if caption.startswith("A red"))
+    assert all(similarity(hit["distance"], space) >= 0.8 for hit in hits)
+
+
+@pytest.mark.parametrize("changed", [{"min_similarity": 0.5}, {"size": "thumbnail"}, {"mode": "keyword"}])
+def test_cursor_is_tied_to_its_filters(image_db_index, changed):
+    cursor = image_db_index.search_page(QUERY, 4, refs=True)["next_cursor"]
+
+    options = {"refs": True, "cursor": cursor, **changed}
+    with pytest.raises(HTTPException) as error:
+        image_db_index.search_page(QUERY, 4, **options)
+    assert error.value.status_code == 422
+
+
+def test_cursor_of_another_query_is_rejected(image_db_index):
+    cursor = image_db_index.search_page(QUERY, 4, refs=True)["next_cursor"]
+    with pytest.raises(HTTPException) as error:
+        image_db_index.search_page("a blue dog", 4, refs=True, cursor=cursor)
+    assert error.value.status_code == 422
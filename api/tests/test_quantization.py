@@ -0,0 +1,99 @@
+import chromadb
+import numpy as np
+import pytest
+from chromadb.config import Settings
+
+from models.quantization import QUANTIZERS, STORAGES, ProductQuantizer, ScalarQuantizer, load_quantizer
+from models.vector_store import MmapVectorStore, export_collection
+
+
+DIM = 64
+NUM = 10
+
+
+def clustered(rng, centers, count):
+    # Normalized vectors around a few centers, like the caption embeddings of similar images
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.5 * rng.normal(size=(count, centers.shape[1]))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(32, DIM))
+    return clustered(rng, centers, 3000), clustered(rng, centers, 50)
+
+
+@pytest.fixture(scope="module")
+def exports(data, tmp_path_factory):
+    # An export of the same collection in every storage
+    vectors, _ = data
+    directory = tmp_path_factory.mktemp("quantization")
+    client = chromadb.PersistentClient(path=str(directory / "index"), settings=Settings(anonymized_telemetry=False))
+    collection = client.create_collection(name="vectors", embedding_function=None)
+    ids = [f"{i:05d}" for i in range(len(vectors))]
+    for start in range(0, len(ids), 1000):
+        collection.upsert(ids=ids[start:start + 1000], embeddings=vectors[start:start + 1000])
+
+    yield {storage: export_collection(collection, str(directory / storage), storage=storage) for storage in STORAGES}
+    chromadb.api.client.SharedSystemClient.clear_system_cache()
+
+
+def recall(store, queries, exact):
+    ids, _ = store.query(queries, NUM)
+    return np.mean([len(set(hits) & set(expected)) / NUM for hits, expected in zip(ids, exact)])
+
+
+@pytest.mark.parametrize("storage, tolerance", [("float16", 1e-3), ("int8", 2e-2), ("pq", 0.3)])
+def test_scores_approximate_inner_products(data, storage, tolerance):
+    vectors, queries = data
+    quantizer = QUANTIZERS[storage].train(vectors)
+    scores = quantizer.scores(queries, quantizer.encode(vectors))
+
+    assert scores.shape == (len(queries), len(vectors))
+    assert np.abs(scores - queries @ vectors.T).max() < tolerance
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8", "pq"])
+def test_params_reload_the_same_quantizer(data, storage):
+    vectors, queries = data
+    quantizer = QUANTIZERS[storage].train(vectors)
+    codes = quantizer.encode(vectors)
+
+    reloaded = load_quantizer(storage, quantizer.params())
+    assert np.array_equal(reloaded.encode(vectors), codes)
+    assert np.allclose(reloaded.scores(queries, codes), quantizer.scores(queries, codes))
+
+
+def test_int8_codes_cover_the_range_of_every_dimension(data):
+    vectors, _ = data
+    codes = ScalarQuantizer.train(vectors).encode(vectors)
+    assert codes.dtype == np.uint8
+    assert (codes.min(axis=0) == 0).all() and (codes.max(axis=0) == 255).all()
+
+
+def test_pq_rejects_a_dimension_that_does_not_split(data):
+    vectors, _ = data
+    with pytest.raises(ValueError):
+        ProductQuantizer.train(vectors[:, :DIM - 1])
+
+
+@pytest.mark.parametrize("storage, without_rescoring", [("float16", 0.99), ("int8", 0.9), ("pq", 0.2)])
+def test_recall_of_the_quantized_storages(data, exports, storage, without_rescoring):
+    _, queries = data
+    exact, _ = MmapVectorStore(exports["float32"]).query(queries, NUM)
+
+    assert recall(MmapVectorStore(exports[storage], rescore=0), queries, exact) >= without_rescoring
+    # Rescoring 8 times more candidates on the float32 vectors recovers nearly all of the exact hits
+    assert recall(MmapVectorStore(exports[storage], rescore=8), queries, exact) >= 0.95
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8", "pq"])
+def test_rescored_distances_are_exact(data, exports, storage):
+    vectors, queries = data
+    ids, distances = MmapVectorStore(exports[storage], rescore=8).query(queries, NUM)
+
+    for query, hits, hit_distances in zip(queries, ids, distances):
+        exact = ((vectors[[int(hit) for hit in hits]] - query) ** 2).sum(axis=1)
+        assert np.allclose(hit_distances, exact, atol=1e-5)
+        assert hit_distances == sorted(hit_distances)
@@ -0,0 +1,70 @@
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from models.renditions import RENDITIONS, make_renditions, rendition_path
+
+
+DIRECTORY = "user_images_collection"
+
+
+def store_image(name, color):
+    # An image stored with its renditions, as by /index
+    path = os.path.join(DIRECTORY, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    buffer = BytesIO()
+    Image.new("RGB", (320, 240), color).save(buffer, format="JPEG")
+    with open(path, "wb") as f:
+        f.write(buffer.getvalue())
+    make_renditions(path)
+    return path
+
+
+def files(path):
+    return [path] + [rendition_path(path, size) for size in RENDITIONS]
+
+
+@pytest.fixture
+def image_db_index(make_index):
+    image_db_index = make_index({"Images/0000.jpg": "A dog runs on the grass"})
+    paths = [store_image("kept.jpg", "red"), store_image("deleted.jpg", "green")]
+    image_db_index.index(paths, ["A red square", "A green square"], [0, 2 ** 64 - 1])
+    return image_db_index
+
+
+def test_entry_of_a_missing_image_is_dropped_with_its_renditions(image_db_index):
+    deleted, kept = os.path.join(DIRECTORY, "deleted.jpg"), os.path.join(DIRECTORY, "kept.jpg")
+    os.remove(deleted)
+
+    report = image_db_index.reconcile_user_images(DIRECTORY)
+    assert "removed 1 index entries" in report and "0 image files" in report
+
+    assert image_db_index.collections["user"].get(include=[])['ids'] == [kept]
+    assert image_db_index.caption_of(deleted) is None
+    assert [image_id for image_id, _ in image_db_index.lexical_indexes["user"].search("square", 5)] == [kept]
+    assert image_db_index.find_duplicate(2 ** 64 - 1) is None
+    assert not any(os.path.exists(path) for path in files(deleted))
+    assert all(os.path.exists(path) for path in files(kept))
+
+
+def test_orphan_image_file_is_deleted_with_its_renditions(image_db_index):
+    orphan = store_image("nested/orphan.jpg", "blue")
+    pending = store_image("pending.jpg", "yellow")
+
+    report = image_db_index.reconcile_user_images(DIRECTORY, keep=[pending])
+    assert "removed 0 index entries" in report and "1 image files" in report
+
+    assert not any(os.path.exists(path) for path in files(orphan))
+    assert not os.path.exists(os.path.join(DIRECTORY, "nested"))
+    assert all(os.path.exists(path) for path in files(pending))
+    assert len(image_db_index.collections["user"].get(include=[])['ids']) == 2
+
+
+def test_reconciling_from_another_directory_changes_nothing(image_db_index, tmp_path, monkeypatch):
+    (tmp_path / "elsewhere").mkdir()
+    monkeypatch.chdir(tmp_path / "elsewhere")
+
+    assert image_db_index.reconcile_user_images(DIRECTORY).startswith("Skipped reconciling")
+    assert len(image_db_index.collections["user"].get(include=[])['ids']) == 2
@@ -0,0 +1,62 @@
+import chromadb
+import numpy as np
+import pytest
+from chromadb.config import Settings
+
+from models.vector_store import ChromaVectorStore, RefreshingVectorStore, ensure_mmap_store
+
+
+DIM = 32
+
+
+@pytest.fixture
+def client(tmp_path):
+    yield chromadb.PersistentClient(path=str(tmp_path / "index"), settings=Settings(anonymized_telemetry=False))
+    chromadb.api.client.SharedSystemClient.clear_system_cache()
+
+
+def make_collection(client, space, vectors):
+    collection = client.create_collection(name=f"vectors-{space}", embedding_function=None, metadata={"hnsw:space": space})
+    collection.upsert(ids=[f"{i:04d}" for i in range(len(vectors))], embeddings=vectors)
+    return collection
+
+
+@pytest.mark.parametrize("space", ["l2", "cosine", "ip"])
+def test_mmap_distances_match_chroma(client, tmp_path, space):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, DIM)).astype(np.float32)
+    if space == "ip":
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.normal(size=(5, DIM)).astype(np.float32)
+    collection = make_collection(client, space, vectors)
+
+    mmap_ids, mmap_distances = ensure_mmap_store(collection, str(tmp_path / space)).query(queries, 10)
+    chroma_ids, chroma_distances = ChromaVectorStore(collection).query(queries, 10)
+
+    assert mmap_ids == chroma_ids
+    assert np.allclose(mmap_distances, chroma_distances, atol=1e-4)
+
+
+def test_refresh_notices_re_embedded_vectors(client, tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(20, DIM)).astype(np.float32)
+    collection = make_collection(client, "l2", vectors)
+    store = RefreshingVectorStore(collection, str(tmp_path / "export"))
+
+    # The same ids with new embeddings: the count is unchanged, the fingerprint is not
+    collection.upsert(ids=["0000"], embeddings=[-vectors[0]])
+    store.refreshing.acquire()
+    store._refresh()
+
+    ids, distances = store.query([-vectors[0]], 1)
+    assert ids == [["0000"]] and distances[0][0] == pytest.approx(0, abs=1e-4)
+
+
+def test_refresh_keeps_an_unchanged_export(client, tmp_path):
+    collection = make_collection(client, "l2", np.eye(DIM, dtype=np.float32))
+    store = RefreshingVectorStore(collection, str(tmp_path / "export"))
+    current = store.store
+
+    store.refreshing.acquire()
+    store._refresh()
+    assert store.store is current